@@ -0,0 +1,51 @@
+"""Compares the cost of assembling the jacobian of a model by stacking the
+gradients of each free parameter (the old Model._jacobian implementation)
+with assembling it in the preallocated buffer used by Model._jacobian.
+
+The model contains four gaussians and an offset (13 free parameters) and the
+spectrum 2048 channels, the size of a typical EELS core-loss model.
+
+"""
+
+import timeit
+
+import numpy as np
+
+from hyperspy.hspy import *
+from hyperspy.model import Model
+
+nchannels = 2048
+s = Spectrum({'data' : np.random.random(nchannels)})
+m = Model(s)
+for centre in (200, 700, 1200, 1700):
+    g = components.Gaussian(A=1000., sigma=20., centre=centre)
+    m.append(g)
+m.append(components.Offset())
+m._set_p0()
+p0 = np.array(m.p0)
+axis = m.axis.axis
+
+def stacked_jacobian():
+    grad = axis
+    for component in m:
+        for parameter in component.free_parameters:
+            grad = np.vstack((grad, parameter.grad(axis)))
+    return grad[1:,:]
+
+def preallocated_jacobian():
+    return m._jacobian(p0, None)
+
+assert np.allclose(stacked_jacobian(), preallocated_jacobian())
+
+nfree = len(p0)
+# Each vstack copies all the rows assembled so far plus the new one
+stacked_bytes = sum((k + 1) * nchannels * 8 for k in xrange(1, nfree + 1))
+print "Free parameters: %i, channels: %i" % (nfree, nchannels)
+print "Bytes allocated to assemble the jacobian per iteration"
+print "\tstacked:\t%i" % stacked_bytes
+print "\tpreallocated:\t0 (the buffer is allocated once, %i bytes)" % (
+    nfree * nchannels * 8)
+print "Time per iteration (including the gradients evaluation)"
+for function in (stacked_jacobian, preallocated_jacobian):
+    t = min(timeit.repeat(function, repeat=5, number=200)) / 200
+    print "\t%s:\t%.1f us" % (function.__name__, t * 1e6)
@@ -0,0 +1,68 @@
+"""Compares the bundled pure-Python mpfit with the LAPACK based mpfit of
+hyperspy.misc.mpfit.mpfit_lapack, with and without the vectorized finite
+differences jacobian.
+
+The problem is the fit of four gaussians and an offset (13 free
+parameters) to a 2048 channels spectrum, with the amplitudes bounded to be
+positive and the finite differences of the centres computed on both sides.
+
+"""
+
+import copy
+import timeit
+
+import numpy as np
+
+from hyperspy.misc.mpfit.mpfit import mpfit as python_mpfit
+from hyperspy.misc.mpfit.mpfit_lapack import mpfit as lapack_mpfit
+
+nchannels = 2048
+x = np.arange(nchannels, dtype='float')
+centres = (200., 700., 1200., 1700.)
+
+def model(p):
+    p = np.atleast_2d(p)
+    y = p[:, 12, np.newaxis] * np.ones(nchannels)
+    for i in xrange(4):
+        A, sigma, centre = [p[:, 3 * i + j, np.newaxis] for j in xrange(3)]
+        y = y + A / (sigma * np.sqrt(2 * np.pi)) * np.exp(
+            -(x - centre) ** 2 / (2 * sigma ** 2))
+    return y
+
+ptrue = np.array(sum([[1000., 20., centre] for centre in centres], []) +
+                 [10.])
+np.random.seed(0)
+y = np.random.poisson(model(ptrue)[0]).astype('float')
+err = np.sqrt(np.maximum(y, 1))
+
+def deviates(p, fjac=None):
+    res = (model(p) - y) / err
+    if np.ndim(p) == 1:
+        res = res[0]
+    return [0, res]
+
+parinfo = []
+for i in xrange(13):
+    parinfo.append({'limited' : [0, 0], 'limits' : [0., 0.], 'mpside' : 0})
+for i in xrange(4):
+    parinfo[3 * i]['limited'] = [1, 0]
+    parinfo[3 * i + 2]['mpside'] = 2
+p0 = ptrue * 1.05
+
+engines = (
+    ('python', lambda : python_mpfit(deviates, p0,
+                                     parinfo=copy.deepcopy(parinfo), quiet=1)),
+    ('lapack', lambda : lapack_mpfit(deviates, p0,
+                                     parinfo=copy.deepcopy(parinfo), quiet=1)),
+    ('lapack+vectorized', lambda : lapack_mpfit(deviates, p0,
+        parinfo=copy.deepcopy(parinfo), quiet=1, vectorized=True)),)
+
+reference = engines[0][1]()
+print "Free parameters: %i, channels: %i" % (len(p0), nchannels)
+print "engine\t\t\titerations\tnfev\ttime per fit"
+for name, engine in engines:
+    m = engine()
+    assert np.allclose(m.params, reference.params, rtol=1e-5)
+    assert np.allclose(m.perror, reference.perror, rtol=1e-3)
+    t = min(timeit.repeat(engine, repeat=3, number=5)) / 5
+    print "%-24s%i\t\t%i\t%.1f ms" % (name, m.niter, m.nfev, t * 1e3)
@@ -0,0 +1,38 @@
+"""Compares the number of function evaluations and the time needed to fit a
+spectrum of 4096 channels with three gaussians at full resolution and
+first on the signal binned by 8 channels and then refined at full
+resolution (signal_binning=8).
+
+"""
+
+import time
+
+import numpy as np
+
+from hyperspy.hspy import *
+from hyperspy.model import Model
+
+nchannels = 4096
+x = np.arange(nchannels, dtype='float')
+data = np.random.poisson(5. +
+    800. * np.exp(-(x - 1000.) ** 2 / (2 * 40. ** 2)) +
+    500. * np.exp(-(x - 2200.) ** 2 / (2 * 60. ** 2)) +
+    300. * np.exp(-(x - 2500.) ** 2 / (2 * 30. ** 2))).astype('float')
+s = Spectrum({'data' : data})
+m = Model(s)
+gaussians = [components.Gaussian(A=10000., sigma=50., centre=centre)
+             for centre in (950., 2150., 2550.)]
+m.extend(gaussians)
+m.append(components.Offset())
+m._set_p0()
+p0 = np.array(m.p0)
+
+print "Channels: %i" % nchannels
+for signal_binning in (None, 8):
+    m.p0 = p0.copy()
+    m._charge_p0()
+    t = time.time()
+    m.fit(fitter='leastsq', signal_binning=signal_binning, compute_cost=True)
+    t = time.time() - t
+    print "signal_binning=%s:\tnfev=%i\tcost=%.1f\ttime=%.1f ms" % (
+        signal_binning, m._nfev, m.fit_cost, t * 1e3)
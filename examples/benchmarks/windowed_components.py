@@ -0,0 +1,49 @@
+"""Compares the evaluation of a multi-peak model and its jacobian over the
+whole axis with the evaluation restricted to the support of the gaussians
+(centre +- support_widths * sigma, see Component.get_support).
+
+The model contains 24 narrow gaussians and an offset (73 free parameters)
+and the spectrum 2048 channels, like a multi-peak XPS model.
+
+"""
+
+import timeit
+
+import numpy as np
+
+from hyperspy.hspy import *
+from hyperspy.model import Model
+
+nchannels = 2048
+s = Spectrum({'data' : np.random.random(nchannels)})
+m = Model(s)
+gaussians = []
+for centre in np.linspace(50, 2000, 24):
+    g = components.Gaussian(A=1000., sigma=4., centre=centre)
+    gaussians.append(g)
+m.extend(gaussians)
+m.append(components.Offset())
+m._set_p0()
+p0 = np.array(m.p0)
+
+def set_support_widths(value):
+    for g in gaussians:
+        g.support_widths = value
+
+def model_and_jacobian():
+    m._model_function(p0)
+    m._jacobian(p0, None)
+
+set_support_widths(None)
+full = m._model_function(p0), m._jacobian(p0, None).copy()
+set_support_widths(8.)
+windowed = m._model_function(p0), m._jacobian(p0, None).copy()
+assert np.allclose(full[0], windowed[0])
+assert np.allclose(full[1], windowed[1])
+
+print "Free parameters: %i, channels: %i" % (len(p0), nchannels)
+print "Time per model and jacobian evaluation"
+for support_widths in (None, 8.):
+    set_support_widths(support_widths)
+    t = min(timeit.repeat(model_and_jacobian, repeat=5, number=50)) / 50
+    print "\tsupport_widths=%s:\t%.2f ms" % (support_widths, t * 1e3)
@@ -24,6 +24,12 @@ from hyperspy.defaults_parser import preferences
 from hyperspy.misc.utils import incremental_filename, append2pathname, slugify
 from hyperspy.exceptions import NavigationDimensionError
 
+_scalar_types = (bool, int, long, float, complex, basestring, type(None))
+
+def _identity(x):
+    """The default twin function"""
+    return x
+
 class Parameter(object):
     """
     class_documentation
@@ -33,18 +39,29 @@ class Parameter(object):
                  twin=None):
         
         self.component = None
+        # When the parameter belongs to a model, the model may store its 
+        # value and std in contiguous arrays (see Model._build_parameter_store)
+        self._store_model = None
+        self._store_offset = 0
+        self._in_store = False
+        self.__std = None
         self.connection_active = False
         self.connected_functions = list()
         self.ext_bounded = False
-        self._number_of_elements = 1
+        self.__number_of_elements = 1
         self._bounds = (None, None)
         self.bmin = None
         self.bmax = None
         self.__twin = None
+        # The root of the chain of twins when its value can be read 
+        # directly (see Model._get_twin_graph)
+        self._twin_root = None
         self.twin = twin
-        self.twin_function = lambda x: x
+        self.twin_function = _identity
         self._twins = []
         self.ext_force_positive = False
+        # True if the component function is linear in the parameter
+        self.is_linear = False
         self.value = value
         self.free = free
         self.map = None
@@ -75,9 +92,84 @@ class Parameter(object):
             
     def _coerce(self):
         if self.twin is None:
+            if self._in_store is True:
+                values = self._store_model._parameter_values
+                if self._number_of_elements == 1:
+                    return values[self._store_offset]
+                else:
+                    return values[self._store_offset:self._store_offset + 
+                                  self._number_of_elements].tolist()
             return self.__value
         else:
+            root = self._twin_root
+            if root is not None and root._in_store is True:
+                return root._coerce()
             return self.twin_function(self.twin.value)
+            
+    def _value_to_store(self):
+        """Write the value in the model parameter store if its shape fits,
+        otherwise (e.g. when evaluating several pixels at once) keep it in 
+        the parameter until it fits again."""
+        model = self._store_model
+        if model is None:
+            return
+        n = self._number_of_elements
+        shape = np.shape(self.__value)
+        if (n == 1 and shape == ()) or (n > 1 and shape == (n,)):
+            model._parameter_values[self._store_offset:
+                                    self._store_offset + n] = self.__value
+            if self._in_store is False:
+                self._in_store = True
+                model._store_detached.discard(self)
+        else:
+            self._in_store = False
+            model._store_detached.add(self)
+            
+    def _bind_store(self, model, offset):
+        """Move the value and std to the parameter store of the model."""
+        self._unbind_store()
+        std = self.__std
+        self._store_model = model
+        self._store_offset = offset
+        self._value_to_store()
+        self.std = std
+        
+    def _unbind_store(self):
+        """Move the value and std from the parameter store of the model 
+        back to the parameter."""
+        model = self._store_model
+        if model is None:
+            return
+        n = self._number_of_elements
+        if self._in_store is True:
+            value = model._parameter_values[self._store_offset:
+                                            self._store_offset + n]
+            self.__value = value[0] if n == 1 else value.tolist()
+        self.__std = self.std
+        model._store_detached.discard(self)
+        self._store_model = None
+        self._in_store = False
+        
+    def _getstd(self):
+        if self._store_model is None:
+            return self.__std
+        std = self._store_model._parameter_std[self._store_offset:
+            self._store_offset + self._number_of_elements]
+        if np.isnan(std).all():
+            return None
+        return std[0] if self._number_of_elements == 1 else std.tolist()
+    def _setstd(self, arg):
+        self.__std = arg
+        if self._store_model is not None:
+            n = self._number_of_elements
+            std = self._store_model._parameter_std[self._store_offset:
+                                                   self._store_offset + n]
+            if arg is None or np.shape(arg) not in ((), (n,)):
+                std[:] = np.nan
+            else:
+                std[:] = arg
+    std = property(_getstd, _setstd)
+        
     def _decoerce(self, arg):
 
         if self.ext_bounded is False:
@@ -95,6 +187,7 @@ class Parameter(object):
                         self.__value=arg
                 else :
                     self.__value=ar
+        self._value_to_store()
         if self.connection_active is True:
             for f in self.connected_functions:
                 try:
@@ -103,6 +196,17 @@ class Parameter(object):
                     self.disconnect(f)
     value = property(_coerce, _decoerce)
 
+    def _get_number_of_elements(self):
+        return self.__number_of_elements
+    def _set_number_of_elements(self, arg):
+        if arg != self.__number_of_elements and self._store_model is not None:
+            # The parameter store must be rebuilt for the new size. It is 
+            # unbound first so that the value is read with the old size.
+            self._store_model._invalidate_parameter_store()
+        self.__number_of_elements = arg
+    _number_of_elements = property(_get_number_of_elements, 
+                                   _set_number_of_elements)
+
     # Fix the parameter when coupled
     def _getfree(self):
         if self.twin is None:
@@ -113,6 +217,8 @@ class Parameter(object):
         self.__free = arg
         if self.component is not None:
             self.component._update_free_parameters()
+        if self._store_model is not None:
+            self._store_model._configuration_version += 1
     free = property(_getfree,_setfree)
 
     def _set_twin(self,arg):
@@ -124,11 +230,25 @@ class Parameter(object):
             if self not in arg._twins :
                 arg._twins.append(self)
         self.__twin = arg
+        # The twinned parameters are not free
+        if self.component is not None:
+            self.component._update_free_parameters()
+        if self._store_model is not None:
+            self._store_model._evaluation_plan = None
+            self._store_model._invalidate_twin_graph()
 
     def _get_twin(self):
         return self.__twin
     twin = property(_get_twin, _set_twin)
 
+    def _get_twin_function(self):
+        return self.__twin_function
+    def _set_twin_function(self, arg):
+        self.__twin_function = arg
+        if self._store_model is not None:
+            self._store_model._invalidate_twin_graph()
+    twin_function = property(_get_twin_function, _set_twin_function)
+
     def _get_bmin(self):
         if isinstance(self._bounds, tuple):
             return self._bounds[0]
@@ -170,11 +290,17 @@ class Parameter(object):
         self.map['values'][mask == False] = self.value
         self.map['is_set'][mask == False] = True
         
-    def create_array(self, shape):
-        dtype_ = np.dtype([
+    def _get_map_dtype(self):
+        return np.dtype([
             ('values','float', self._number_of_elements), 
             ('std', 'float', self._number_of_elements), 
             ('is_set', 'bool', 1)])
+            
+    def create_array(self, shape):
+        if self._store_model is not None:
+            # The map is a view of the model parameter store
+            self._store_model._invalidate_parameter_store()
+        dtype_ = self._get_map_dtype()
         if self.map is None  or self.map.shape != shape or \
         self.map.dtype != dtype_:
             self.map = np.zeros(shape, dtype_)       
@@ -247,10 +373,24 @@ class Parameter(object):
                 filename,'_std'))
                     
 class Component(object):
+    # Maximum number of evaluations stored by _function_cached
+    _evaluation_cache_size = 8
+    # Attributes whose value does not change the result of the function, 
+    # e.g. internal caches, and therefore do not invalidate the evaluation
+    # cache when they are set
+    _cache_independent_attributes = frozenset((
+        '_evaluation_cache', '_evaluation_cache_keys', '_state_version',
+        'free_parameters', '_nfree_param'))
+    # Increased every time that the state of the component changes
+    _state_version = 0
+    
     def __init__(self, parameter_name_list):
+        self._evaluation_cache = {}
+        self._evaluation_cache_keys = []
         self.parameters = []
         self.init_parameters(parameter_name_list)
         self._update_free_parameters()
+        self.active_map = None
         self.active = True
         self.isbackground = False
         self.convolved = True
@@ -289,6 +429,44 @@ class Component(object):
         text = '<%s>' % self._get_long_description()
         return text
 
+    def _get_active(self):
+        return self.__active
+    def _set_active(self, arg):
+        self.__active = arg
+        if self.active_map is not None and self.active_map.size and \
+        self.parameters[0]._axes_manager is not None:
+            self.active_map[tuple(
+                self.parameters[0]._axes_manager._indexes)] = arg
+        # The model must use the evaluation plan of the new configuration
+        for parameter in self.parameters:
+            if parameter._store_model is not None:
+                parameter._store_model._configuration_version += 1
+                break
+    active = property(_get_active, _set_active)
+
+    def _get_active_is_multidimensional(self):
+        return self.active_map is not None
+    def _set_active_is_multidimensional(self, arg):
+        """If True, the active state of the component is stored for every
+        pixel in `active_map`, a boolean array with the navigation shape
+        that is initialised with the current active state. The model 
+        charges the active state of every pixel with the parameters and
+        the inactive components are not evaluated nor fitted in it."""
+        if arg is False:
+            self.active_map = None
+        elif self.active_map is None:
+            self.active_map = np.empty(self.parameters[0].map.shape, 
+                                       dtype = 'bool')
+            self.active_map[:] = self.active
+    active_is_multidimensional = property(_get_active_is_multidimensional,
+                                          _set_active_is_multidimensional)
+
+    def _get_linear_parameters(self):
+        """Returns the parameters in which the component is linear and
+        that can be solved together by linear least squares."""
+        return [parameter for parameter in self.parameters 
+                if parameter.is_linear is True]
+
     def _update_free_parameters(self):
         self.free_parameters = set()
         for parameter in self.parameters:
@@ -325,6 +503,10 @@ class Component(object):
     def create_arrays(self, shape):
         for parameter in self.parameters:
             parameter.create_array(shape)
+        if self.active_map is not None and \
+        self.active_map.shape != tuple(shape):
+            self.active_map = np.empty(shape, dtype = 'bool')
+            self.active_map[:] = self.active
     
     def store_current_parameters_in_map(self, indexes):
         for parameter in self.parameters:
@@ -408,6 +590,93 @@ class Component(object):
     def __call__(self, p, x, onlyfree = True) :
         self.charge(p , onlyfree = onlyfree)
         return self.function(x)
+
+    def get_support(self):
+        """Returns the interval (xmin, xmax) outside of which the function
+        and its gradients are negligible for the current parameter values,
+        or None if the component must be evaluated over the whole axis.
+
+        The model only evaluates the component and its gradients inside
+        this interval when fitting. Localized components, e.g. peaks,
+        override this method.
+
+        """
+        return None
+
+    def __setattr__(self, name, value):
+        # Setting any attribute other than the parameter values may change
+        # the result of the function, therefore it invalidates the cached 
+        # evaluations unless the value is the same
+        if name not in self._cache_independent_attributes:
+            try:
+                old = self.__dict__[name]
+                changed = old is not value and not (
+                    isinstance(value, _scalar_types) and 
+                    type(old) is type(value) and old == value)
+            except KeyError:
+                changed = True
+            if changed is True:
+                self.__dict__['_state_version'] = self._state_version + 1
+        object.__setattr__(self, name, value)
+        
+    def _get_cache_key(self, x):
+        """Returns the key of the evaluation cache for the given axis. 
+        
+        It consists of the identity of the axis, the version of the state 
+        of the component, which is increased every time that an attribute 
+        is set, and the parameter values. Components that modify arrays or 
+        other mutable attributes in place must call 
+        `_clear_evaluation_cache`.
+        
+        """
+        key = [id(x), self._state_version]
+        for parameter in self.parameters:
+            value = parameter.value
+            if isinstance(value, list):
+                value = tuple(value)
+            elif isinstance(value, np.ndarray):
+                value = (value.shape, value.tostring())
+            key.append(value)
+        return tuple(key)
+        
+    def _function_cached(self, x):
+        """Returns function(x) reusing the result of a previous evaluation
+        if neither the parameter values nor the axis have changed since.
+        
+        The cache is bounded to `_evaluation_cache_size` evaluations. The
+        returned array is shared with the cache and must not be modified.
+        
+        Parameters
+        ----------
+        x : array
+            The axis. Its identity, not its content, is used to validate the
+            cache, therefore the caller must not modify it in place.
+            
+        """
+        key = self._get_cache_key(x)
+        try:
+            cached_x, result = self._evaluation_cache[key]
+        except KeyError:
+            cached_x = None
+        if cached_x is not x:
+            result = self.function(x)
+            if key not in self._evaluation_cache:
+                self._evaluation_cache_keys.append(key)
+                if (len(self._evaluation_cache_keys) > 
+                    self._evaluation_cache_size):
+                    del self._evaluation_cache[
+                        self._evaluation_cache_keys.pop(0)]
+            # The reference to x prevents its id from being reused
+            self._evaluation_cache[key] = (x, result)
+        return result
+        
+    def _clear_evaluation_cache(self):
+        """Discard the cached evaluations, e.g. after modifying in place 
+        an array that the function depends on."""
+        self._evaluation_cache = {}
+        self._evaluation_cache_keys = []
+        # Also invalidates the results that the model derives from them
+        self._state_version += 1
         
     def set_axes(self, axes_manager):
         for parameter in self.parameters:
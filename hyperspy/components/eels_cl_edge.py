@@ -17,13 +17,13 @@
 # along with  Hyperspy.  If not, see <http://www.gnu.org/licenses/>.
 
 
-import math, copy, os, csv
+import math, copy, os, csv, zipfile, hashlib
 
 import numpy as np
-import scipy as sp
-from scipy.interpolate import splev,splrep,splint
+from scipy.interpolate import splev,splrep
 from numpy import log, exp
 from scipy.signal import cspline1d_eval
+from scipy import sparse
 
 from hyperspy.defaults_parser import preferences
 from hyperspy.component import Component
@@ -39,56 +39,297 @@ a0 = 5.2917720859e-11 #Bohr radius in m
 c = 2997.92458e8 #speed of light in m/s
 
 file_path = os.path.join(config_path, 'edges_db.csv') 
-f = open(file_path, 'r')
-reader = csv.reader(f)
-edges_dict = {}
 
-for row in reader:
-    twin_subshell = None
-    element, subshell = row[0].split('.')
-    Z = row[1]
-    if edges_dict.has_key(element) is not True :
-        edges_dict[element]={}
-        edges_dict[element]['subshells'] = {}
-        edges_dict[element]['Z'] = Z
-    if row[3] is not '':
-        if subshell == "L3":
-            twin_subshell = "L2"
-            factor = 0.5
-        if subshell == "M3":
-            twin_subshell = "M2"
-            factor = 0.5
-        if subshell == "M5":
-            twin_subshell = "M4"
-            factor = 4/6.
-        if subshell == "N3":
-            twin_subshell = "N2"
-            factor = 2/4.
-        if subshell == "N5":
-            twin_subshell = "N4"
-            factor = 4/6.
-        if subshell == "N7":
-            twin_subshell = "N6"
-            factor = 6/8.
-        if subshell == "O5":
-            twin_subshell = "O4"
-            factor = 4/6.
-            
-    edges_dict[element]['subshells'][subshell] = {}
-    edges_dict[element]['subshells'][subshell]['onset_energy'] = float(row[2])
-    edges_dict[element]['subshells'][subshell]['filename'] = row[0]
-    edges_dict[element]['subshells'][subshell]['relevance'] = row[4]
-    edges_dict[element]['subshells'][subshell]['factor'] = 1
+# The parsed GOS tables are stored in binary form in this folder. A cache file is only used if it was written with the current
+# cache version from a source file with the same path and modification time.
+cache_path = os.path.join(config_path, 'cache')
+_cache_version = 1
+
+def _load_cache(source):
+    """Returns a dictionary with the arrays stored in the cache of the 
+    source file or None if there is no valid cache."""
+    filename = os.path.join(cache_path, os.path.basename(source) + '.npz')
+    try:
+        f = np.load(filename)
+        arrays = dict([(key, f[key]) for key in f.files])
+        f.close()
+        if int(arrays.pop('version')) != _cache_version or \
+        str(arrays.pop('source')) != source or \
+        float(arrays.pop('mtime')) != os.path.getmtime(source):
+            return None
+    except (IOError, OSError, KeyError, ValueError, zipfile.BadZipfile):
+        return None
+    return arrays
     
-    if twin_subshell is not None :
-        edges_dict[element]['subshells'][twin_subshell] = {}
-        edges_dict[element]['subshells'][twin_subshell]['onset_energy'] = \
-        float(row[3])
-        edges_dict[element]['subshells'][twin_subshell]['filename'] = row[0]
-        edges_dict[element]['subshells'][twin_subshell]['relevance'] = row[4]
-        edges_dict[element]['subshells'][twin_subshell]['factor'] = factor
+def _write_npz(filename, **arrays):
+    """Writes the arrays to a npz file, creating its folder if needed. The 
+    file is not written if the folder is not writable."""
+    temporary = '%s.%i.tmp' % (filename, os.getpid())
+    try:
+        if os.path.isdir(os.path.dirname(filename)) is False:
+            os.makedirs(os.path.dirname(filename))
+        f = open(temporary, 'wb')
+        try:
+            np.savez(f, **arrays)
+        finally:
+            f.close()
+        # Other processes never read a partially written file
+        os.rename(temporary, filename)
+    except (IOError, OSError):
+        if os.path.isfile(temporary):
+            os.remove(temporary)
+
+def _save_cache(source, **arrays):
+    """Stores the arrays in the cache of the source file."""
+    _write_npz(os.path.join(cache_path, os.path.basename(source) + '.npz'),
+               version = _cache_version, source = source, 
+               mtime = os.path.getmtime(source), **arrays)
+
+def _parse_edges_rows(rows):
+    """Returns the edges dictionary from the rows of edges_db.csv"""
+    edges = {}
+    for row in rows:
+        twin_subshell = None
+        element, subshell = row[0].split('.')
+        Z = row[1]
+        if edges.has_key(element) is not True :
+            edges[element]={}
+            edges[element]['subshells'] = {}
+            edges[element]['Z'] = Z
+        if row[3] != '':
+            if subshell == "L3":
+                twin_subshell = "L2"
+                factor = 0.5
+            if subshell == "M3":
+                twin_subshell = "M2"
+                factor = 0.5
+            if subshell == "M5":
+                twin_subshell = "M4"
+                factor = 4/6.
+            if subshell == "N3":
+                twin_subshell = "N2"
+                factor = 2/4.
+            if subshell == "N5":
+                twin_subshell = "N4"
+                factor = 4/6.
+            if subshell == "N7":
+                twin_subshell = "N6"
+                factor = 6/8.
+            if subshell == "O5":
+                twin_subshell = "O4"
+                factor = 4/6.
+                
+        edges[element]['subshells'][subshell] = {}
+        edges[element]['subshells'][subshell]['onset_energy'] = \
+        float(row[2])
+        edges[element]['subshells'][subshell]['filename'] = row[0]
+        edges[element]['subshells'][subshell]['relevance'] = row[4]
+        edges[element]['subshells'][subshell]['factor'] = 1
+        
+        if twin_subshell is not None :
+            edges[element]['subshells'][twin_subshell] = {}
+            edges[element]['subshells'][twin_subshell]['onset_energy'] = \
+            float(row[3])
+            edges[element]['subshells'][twin_subshell]['filename'] = row[0]
+            edges[element]['subshells'][twin_subshell]['relevance'] = row[4]
+            edges[element]['subshells'][twin_subshell]['factor'] = factor
+    return edges
 
+class _EdgesDatabase(dict):
+    """The dictionary of the ionisation edges, which is read from 
+    edges_db.csv the first time that it is used.
+    
+    All the methods of dict load the database before they run (see 
+    `_loading_methods`)."""
+    
+    def __init__(self):
+        dict.__init__(self)
+        self._loaded = False
+        
+    def load(self):
+        # The file is small, parsing it is as fast as reading a cache
+        f = open(file_path, 'r')
+        try:
+            rows = [row for row in csv.reader(f) if row]
+        finally:
+            f.close()
+        dict.update(self, _parse_edges_rows(rows))
+        self._loaded = True
+        
+    def has_key(self, key):
+        return self.__contains__(key)
+        
+# The methods of dict that read or modify the contents of the database
+_loading_methods = (
+    '__getitem__', '__setitem__', '__delitem__', '__contains__', 
+    '__iter__', '__len__', '__repr__', '__eq__', '__ne__', 'get', 'keys', 
+    'items', 'values', 'iterkeys', 'itervalues', 'iteritems', 'viewkeys', 
+    'viewitems', 'viewvalues', 'copy', 'update', 'setdefault', 'pop', 
+    'popitem', 'clear')
 
+def _loading_method(name):
+    method = getattr(dict, name)
+    def loading_method(self, *args, **kwargs):
+        if self._loaded is False:
+            self.load()
+        return method(self, *args, **kwargs)
+    loading_method.__name__ = name
+    loading_method.__doc__ = method.__doc__
+    return loading_method
+
+for _name in _loading_methods:
+    setattr(_EdgesDatabase, _name, _loading_method(_name))
+del _name
+
+edges_dict = _EdgesDatabase()
+
+# The GOS tables read in this session by path
+_gos_tables = {}
+
+def read_gos_table(filename):
+    """Reads a Hartree-Slater GOS table in the Gatan format.
+    
+    The table is read from its binary cache if it is valid and it is only
+    read once per session unless the file is modified.
+    
+    Parameters
+    ----------
+    filename : str
+    
+    Returns
+    -------
+    Dictionary with the 'material', the 'info1' and 'info2' parameters of
+    the q and energy axes, the 'gos' array, of shape (energy, q), and the 
+    'energy_axis' and 'q_axis'.
+    
+    """
+    mtime = os.path.getmtime(filename)
+    if filename in _gos_tables and _gos_tables[filename][0] == mtime:
+        return _gos_tables[filename][1]
+    table = _load_cache(filename)
+    if table is None:
+        f = open(filename)
+        try:
+            #Tranfer the content of the file to a list
+            GosList = f.read().replace('\r','').split()
+        finally:
+            f.close()
+        ncol = int(GosList[5])
+        nrow = int(GosList[8])
+        info1 = np.array(GosList[2:5], dtype = 'float')
+        info2 = np.array(GosList[6:8], dtype = 'float')
+        table = {
+            'material' : np.array(GosList[0]),
+            'info1' : info1,
+            'info2' : info2,
+            'gos' : np.array(GosList[9:]).reshape(nrow, ncol).astype(
+                np.float64),
+            # Calculate the scale of the matrix
+            'energy_axis' : info2[0] * (exp(np.linspace(0, nrow - 1, nrow) 
+                                        * info2[1] / info2[0]) - 1.0),
+            'q_axis' : (info1[0] * (exp(np.linspace(1, ncol, ncol) * 
+                                        info1[1]) - 1.0)) * 1.0e10,}
+        _save_cache(filename, **table)
+    table['material'] = str(table['material'])
+    _gos_tables[filename] = (mtime, table)
+    return table
+
+class CrossSectionRegistry(object):
+    """Registry of the cross sections integrated over q shared by all the
+    EELSCLEdge instances of the session.
+    
+    It is the only store of the integrated cross sections: an edge takes
+    them from the registry when the microscope parameters or delta change,
+    e.g. while fitting delta, and the edges of a new model, e.g. built for 
+    another spectrum image acquired with the same microscope parameters, 
+    do not integrate the GOS tables again. If `on_disk` is True, the cross
+    sections are also read from `path`, where `save` stores them to share 
+    them between sessions. The registry never writes to disk by itself, 
+    therefore fitting does not access the disk.
+    
+    The cross sections are identified by the GOS file and its modification
+    time, the element, the subshell, the beam energy, the convergence and
+    collection angles and delta rounded to the tolerance of the edges.
+    
+    Attributes
+    ----------
+    max_size : int
+        The maximum number of cross sections kept in memory. The least 
+        recently used are discarded first.
+    on_disk : bool
+    path : str
+    
+    """
+    
+    def __init__(self, max_size = 1024, on_disk = False, 
+                 path = os.path.join(cache_path, 'cross_sections')):
+        self.max_size = max_size
+        self.on_disk = on_disk
+        self.path = path
+        self._cross_sections = {}
+        self._keys = []
+        self._unsaved = set()
+        
+    def _get_filename(self, key):
+        return os.path.join(self.path, 
+                            hashlib.md5(repr(key)).hexdigest() + '.npz')
+        
+    def get(self, key):
+        """Returns the cross section, a tuple with the cross section in the
+        energies of the GOS table and its spline, or None if it is not 
+        registered."""
+        if key in self._cross_sections:
+            self._keys.remove(key)
+            self._keys.append(key)
+            return self._cross_sections[key]
+        if self.on_disk is True:
+            try:
+                f = np.load(self._get_filename(key))
+                try:
+                    if str(f['key']) != repr(key):
+                        return None
+                    cross_section = (f['qint'], (f['knots'], 
+                        f['coefficients'], int(f['degree'])))
+                finally:
+                    f.close()
+            except (IOError, OSError, KeyError, zipfile.BadZipfile):
+                return None
+            self._add(key, cross_section)
+            return cross_section
+        return None
+        
+    def add(self, key, cross_section):
+        """Registers the cross section, a tuple with the cross section in 
+        the energies of the GOS table and its spline."""
+        self._add(key, cross_section)
+        self._unsaved.add(key)
+            
+    def _add(self, key, cross_section):
+        if key not in self._cross_sections:
+            if len(self._keys) >= self.max_size:
+                removed = self._keys.pop(0)
+                del self._cross_sections[removed]
+                self._unsaved.discard(removed)
+            self._keys.append(key)
+        self._cross_sections[key] = cross_section
+        
+    def save(self):
+        """Writes the cross sections registered in memory since the last 
+        call to `path`."""
+        for key in self._unsaved:
+            qint, (knots, coefficients, degree) = self._cross_sections[key]
+            _write_npz(self._get_filename(key), key = repr(key), qint = qint,
+                       knots = knots, coefficients = coefficients, 
+                       degree = degree)
+        self._unsaved = set()
+
+    def clear(self):
+        """Removes all the cross sections from memory."""
+        self._cross_sections = {}
+        self._keys = []
+        self._unsaved = set()
+
+cross_sections = CrossSectionRegistry()
 
 def EffectiveAngle(E0,E,alpha,beta):
     """Calculates the effective collection angle
@@ -144,7 +385,24 @@ class EELSCLEdge(Component):
     Currently it only supports P. Rez Hartree Slater cross sections parametrised
     as distributed by Gatan in their Digital Micrograph software.
     
+    The fine structure is linear in the `fslist` coefficients, which are
+    evaluated and differentiated with a basis precomputed on the energy
+    axis. When the fine structure is free, they can be solved by linear
+    least squares with `linear_parameters='auto'` instead of the 
+    intensity.
+    
     """
+    # The cross sections are integrated and stored in the cross_sections
+    # registry for delta rounded to this tolerance in eV
+    _gos_cache_delta_tolerance = 1e-3
+    # The cross section, knots and fine structure basis are derived from 
+    # the parameter values and microscope parameters when the function is
+    # evaluated, therefore they do not invalidate the evaluation cache
+    _cache_independent_attributes = \
+        Component._cache_independent_attributes | frozenset((
+        '_previous_delta', '_previous_effective_angle', 
+        '_EELSCLEdge__qint', '_EELSCLEdge__goscoeff', 'r', 'A', 
+        '_EELSCLEdge__knots', '_fs_basis', '_gos_polynomials'))
 
     def __init__(self, element_subshell, intensity=1.,delta=0.):
         # Check if the Peter Rez's Hartree Slater GOS distributed by Gatan 
@@ -169,10 +427,12 @@ class EELSCLEdge(Component):
         self.E0 = None
         self.effective_angle.value = 0
         self.effective_angle.free = False
+        self._fs_basis = {}
         self.fs_state = preferences.EELS.fs_state
         self.fs_emax = preferences.EELS.fs_emax
         self.fs_mode = "new_spline"
         self.fslist.ext_force_positive = False
+        self.fslist.is_linear = True
         
         self.delta.value = delta
         self.delta.free = False
@@ -185,6 +445,7 @@ class EELSCLEdge(Component):
         self.intensity.value = intensity
         self.intensity.bmin = 0.
         self.intensity.bmax = None
+        self.intensity.is_linear = True
 
         self.knots_factor = preferences.EELS.knots_factor
 
@@ -262,32 +523,21 @@ class EELSCLEdge(Component):
         #Read file
         file = os.path.join(preferences.EELS.eels_gos_files_path, 
         edges_dict[element]['subshells'][subshell]['filename'])
-        f = open(file)
- 
-        #Tranfer the content of the file to a list
-        GosList = f.read().replace('\r','').split()
+        table = read_gos_table(file)
+        self.__gos_file = (file, os.path.getmtime(file))
 
         #Extract the parameters
 
-        self.material = GosList[0]
-        self.__info1_1 = float(GosList[2])
-        self.__info1_2 = float(GosList[3])
-        self.__info1_3 = float(GosList[4])
-        self.__ncol    = int(GosList[5])
-        self.__info2_1 = float(GosList[6])
-        self.__info2_2 = float(GosList[7])
-        self.__nrow    = int(GosList[8])
-        self.__gos_array = np.array(GosList[9:]).reshape(self.__nrow, 
-        self.__ncol).astype(np.float64)
-        
-        # Calculate the scale of the matrix
-        self.energyaxis = self.__info2_1 * (exp(np.linspace(0, 
-        self.__nrow-1,self.__nrow) * self.__info2_2 / self.__info2_1) - 1.0)
-        
-        self.__qaxis=(self.__info1_1 * (exp(np.linspace(1, self.__ncol, 
-        self.__ncol) * self.__info1_2) - 1.0)) * 1.0e10
+        self.material = table['material']
+        self.__info1_1, self.__info1_2, self.__info1_3 = table['info1']
+        self.__info2_1, self.__info2_2 = table['info2']
+        self.__gos_array = table['gos']
+        self.__nrow, self.__ncol = self.__gos_array.shape
+        self.energyaxis = table['energy_axis']
+        self.__qaxis = table['q_axis']
         self.__sqa0qaxis = (a0 * self.__qaxis)**2
         self.__logsqa0qaxis = log((a0 * self.__qaxis)**2)
+        self._gos_polynomials = None
         
     def integrategos(self, delta = 0):
         """
@@ -296,54 +546,27 @@ class EELSCLEdge(Component):
         (Ek-Ekrange,Ek+Ekrange) for optimizing the time of the fitting. 
         For a value outside of the range it returns the closer limit, 
         however this is not likely to happen in real data
-        """	
         
-        def getgosenergy(i):
-            """
-            Given the row number i (starting from 0) returns the corresponding 
-            energy
-            """	
-            return self.__info2_1 * (math.exp(i * self.__info2_2 / \
-            self.__info2_1) - 1.0)
-        
-        def emax(edgeenergy,i): return self.energyaxis[i] + edgeenergy
-        qint = sp.zeros((self.__nrow))
-        
-        # Integration over q using splines
+        The integrated cross sections are stored in the `cross_sections` 
+        registry that all the edges share for every microscope parameters
+        and value of delta, rounded to `_gos_cache_delta_tolerance`, and 
+        reused.
+        """	
         self.effective_angle.value = EffectiveAngle(self.E0, self.edgeenergy, 
             self.convergence_angle, self.collection_angle)
         self._previous_effective_angle = self.effective_angle.value
-        effective_angle = self.effective_angle.value
-        for i in xrange(0,self.__nrow):
-            qtck = splrep(self.__logsqa0qaxis, self.__gos_array[i, :], s=0)
-            qa0sqmin = (emax(self.edgeenergy + self.delta.value, i)**2) / (
-            4.0 * R * self.T) + (emax(self.edgeenergy + self.delta.value, 
-            i)**3) / (8.0 * self.gamma ** 3.0 * R * self.T**2)
-            qa0sqmax = qa0sqmin + 4.0 * self.gamma**2 * (self.T/R) * math.sin(
-            effective_angle / 2.0)**2.0
-            qmin = math.sqrt(qa0sqmin) / a0
-            qmax=math.sqrt(qa0sqmax) / a0
-            
-            # Error messages for out of tabulated data
-            if qmax > self.__qaxis[-1] :
-                print "i=",i
-                print "Maximum tabulated q reached!!"
-                print "qa0sqmax=",qa0sqmax
-                qa0sqmax = self.__sqa0qaxis[self.__ncol-1]
-                print "qa0sqmax tabulated maximum", 
-                self.__sqa0qaxis[self.__ncol-1]
-                
-            if qmin < self.__qaxis[0] :
-                print "i=",i
-                print "Minimum tabulated q reached!! Accuracy not garanteed"
-                print "qa0sqmin",qa0sqmin
-                qa0sqmin = self.__sqa0qaxis[0]
-                print "qa0sqmin tabulated minimum", qa0sqmin
-            
-            # Writes the integrated values to the qint array.
-            qint[i] = splint(math.log(qa0sqmin), math.log(qa0sqmax), qtck)
-        self.__qint = qint        
-        self.__goscoeff = splrep(self.energyaxis,qint,s=0)
+        tolerance = self._gos_cache_delta_tolerance
+        key = self.__gos_file + (self.__element, self.__subshell, self.E0, 
+            self.convergence_angle, self.collection_angle, 
+            int(round(self.delta.value / tolerance)))
+        cross_section = cross_sections.get(key)
+        if cross_section is None:
+            qint = self._integrate_q(key[-1] * tolerance, 
+                                     self.effective_angle.value)
+            cross_section = (qint, splrep(self.energyaxis, qint, s=0))
+            cross_sections.add(key, cross_section)
+        self.__qint, self.__goscoeff = cross_section
+        self._fs_basis = {}
         
         # Calculate extrapolation powerlaw extrapolation parameters
         E1 = self.energyaxis[-2] + self.edgeenergy + self.delta.value
@@ -357,6 +580,84 @@ class EELSCLEdge(Component):
         self.r = math.log(y2 / y1) / math.log(E1 / E2)
         self.A = y1 / E1**-self.r
         
+    def _get_gos_polynomials(self):
+        """Returns the cubic splines that interpolate the rows of the GOS 
+        table in log(q**2 a0**2) as Taylor coefficients around the middle
+        of every tabulated interval.
+        
+        They are computed once per table and used by `_integrate_q` to 
+        integrate all the rows at once.
+        
+        Returns
+        -------
+        middle : array
+            The middle of the intervals.
+        half_width : array
+            The half width of the intervals.
+        derivatives : array
+            The derivatives of order 0 to 3 of the splines of every row in
+            the middle of the intervals, shape (4, nrow, nintervals).
+        cumulative : array
+            The integral of the splines of every row from the first 
+            tabulated point to every tabulated point, shape (nrow, ncol).
+            
+        """
+        if self._gos_polynomials is None:
+            x = self.__logsqa0qaxis
+            half_width = np.diff(x) / 2.
+            middle = x[:-1] + half_width
+            derivatives = np.empty((4, self.__nrow, len(middle)))
+            for i in xrange(self.__nrow):
+                qtck = splrep(x, self.__gos_array[i, :], s=0)
+                for order in xrange(4):
+                    derivatives[order, i] = splev(middle, qtck, order)
+            # The odd terms vanish in the integral over a whole interval
+            intervals = 2. * derivatives[0] * half_width + \
+                derivatives[2] * half_width ** 3 / 3.
+            cumulative = np.zeros((self.__nrow, len(x)))
+            cumulative[:, 1:] = np.cumsum(intervals, 1)
+            self._gos_polynomials = (middle, half_width, derivatives, 
+                                     cumulative)
+        return self._gos_polynomials
+        
+    def _integrate_q(self, delta, effective_angle):
+        """Integrates all the rows of the GOS table over q between the 
+        minimum momentum transfer of the energy of the row and the maximum
+        allowed by the effective collection angle."""
+        middle, half_width, derivatives, cumulative = \
+            self._get_gos_polynomials()
+        x = self.__logsqa0qaxis
+        emax = self.energyaxis + self.edgeenergy + delta
+        qa0sqmin = (emax**2) / (4.0 * R * self.T) + (emax**3) / (
+            8.0 * self.gamma ** 3.0 * R * self.T**2)
+        qa0sqmax = qa0sqmin + 4.0 * self.gamma**2 * (self.T/R) * math.sin(
+            effective_angle / 2.0)**2.0
+        
+        # Error messages for out of tabulated data
+        if (qa0sqmax > self.__sqa0qaxis[-1]).any():
+            print "Maximum tabulated q reached in %i rows!!" % (
+                qa0sqmax > self.__sqa0qaxis[-1]).sum()
+            print "qa0sqmax tabulated maximum", self.__sqa0qaxis[-1]
+        if (qa0sqmin < self.__sqa0qaxis[0]).any():
+            print "Minimum tabulated q reached in %i rows!! Accuracy not " \
+                "garanteed" % (qa0sqmin < self.__sqa0qaxis[0]).sum()
+            print "qa0sqmin tabulated minimum", self.__sqa0qaxis[0]
+        
+        rows = np.arange(self.__nrow)
+        def primitive(z):
+            # The integral of the spline of every row from the first
+            # tabulated point to z, which is clipped to the table
+            z = np.clip(np.log(z), x[0], x[-1])
+            k = np.clip(np.searchsorted(x, z, 'right') - 1, 0, 
+                        len(middle) - 1)
+            d = derivatives[:, rows, k]
+            def taylor(h):
+                return h * (d[0] + h * (d[1] / 2. + h * (d[2] / 6. + 
+                                                        h * d[3] / 24.)))
+            return cumulative[rows, k] + taylor(z - middle[k]) - \
+                taylor(-half_width[k])
+        return primitive(qa0sqmax) - primitive(qa0sqmin)
+        
     def calculate_knots(self):    
         # Recompute the knots
         start = self.edgeenergy + self.delta.value
@@ -364,6 +665,69 @@ class EELSCLEdge(Component):
         self.__knots = np.r_[[start]*4,
         np.linspace(start, stop, self.fslist._number_of_elements)[2:-2], 
         [stop]*4]
+        self._fs_basis = {}
+        
+    def _fine_structure(self, E, coefficients):
+        """Returns the fine structure for the given coefficients in the 
+        energies E, which must be in the fine structure window."""
+        if self.fs_mode == "new_spline" :
+            return 1E-25*splev(E,(self.__knots,coefficients,3),0)
+        elif self.fs_mode == "spline" :
+            return cspline1d_eval(coefficients, E, 
+                dx = self.energy_scale / self.knots_factor, 
+                x0 = self.edgeenergy+self.delta.value)
+        elif self.fs_mode == "spline_times_edge" :
+            factor = 4.0 * np.pi * a0 ** 2.0 * R**2 / E / self.T
+            return factor*splev((E-self.edgeenergy-self.delta.value), 
+                self.__goscoeff)*cspline1d_eval(coefficients, 
+                E,dx = self.energy_scale / self.knots_factor, 
+                x0 = self.edgeenergy+self.delta.value)
+        return np.zeros(len(E))
+        
+    def _get_fs_basis(self, E):
+        """Returns the basis of the fine structure in the energies E, a 
+        sparse matrix of shape (len(E), number of fslist coefficients) 
+        that is zero outside of the fine structure window.
+        
+        The fine structure is the product of the basis and the fslist 
+        coefficients. The basis is computed once per energy axis until 
+        delta, fs_emax, fs_mode, the number of coefficients, the energy
+        scale, knots_factor or the microscope parameters change.
+        """
+        n = self.fslist._number_of_elements
+        key = (self.fs_mode, self.delta.value, self.fs_emax, n, 
+               self.energy_scale, self.knots_factor)
+        cached = self._fs_basis.get(id(E))
+        if cached is not None and cached[0] is E and cached[1] == key:
+            return cached[2]
+        start = self.edgeenergy + self.delta.value
+        window = np.where(np.logical_and(np.greater_equal(E, start), 
+            np.less(E, start + self.fs_emax)))[0]
+        rows, columns, values = [np.array([], dtype = 'int')], \
+            [np.array([], dtype = 'int')], [np.array([])]
+        coefficients = np.zeros(n)
+        for i in xrange(n):
+            coefficients[i] = 1.
+            column = self._fine_structure(E[window], coefficients)
+            coefficients[i] = 0.
+            nonzero = np.nonzero(column)[0]
+            rows.append(window[nonzero])
+            columns.append(np.repeat(i, len(nonzero)))
+            values.append(column[nonzero])
+        basis = sparse.csr_matrix((np.concatenate(values), 
+            (np.concatenate(rows), np.concatenate(columns))), 
+            shape = (len(E), n))
+        if len(self._fs_basis) >= 4:
+            self._fs_basis = {}
+        self._fs_basis[id(E)] = (E, key, basis)
+        return basis
+        
+    def _get_linear_parameters(self):
+        if self.fs_state is True and self.fslist.free is True:
+            # The fine structure is multiplied by the intensity, therefore
+            # both cannot be solved together
+            return [self.fslist]
+        return [self.intensity]
         
     def function(self,E) :
         """ Calculates the number of counts in barns"""
@@ -383,29 +747,11 @@ class EELSCLEdge(Component):
         
         if self.fs_state is True:
             if self.__knots[-1] > Emax : Emax = self.__knots[-1]
-            fine_structure_indices=np.logical_and(np.greater_equal(E, 
-            self.edgeenergy+self.delta.value), 
-            np.less(E, self.edgeenergy + self.delta.value + self.fs_emax))
             tabulated_indices = np.logical_and(np.greater_equal(E, 
             self.edgeenergy + self.delta.value + self.fs_emax), 
             np.less(E, Emax))
-            if self.fs_mode == "new_spline" :
-                cts = np.where(fine_structure_indices, 
-                1E-25*splev(E,(self.__knots,self.fslist.value,3),0), cts)
-            elif self.fs_mode == "spline" :
-                cts = np.where(fine_structure_indices, 
-                cspline1d_eval(self.fslist.value, 
-                E, 
-                dx = self.energy_scale / self.knots_factor, 
-                x0 = self.edgeenergy+self.delta.value), 
-                cts)
-            elif self.fs_mode == "spline_times_edge" :
-                cts = np.where(fine_structure_indices, 
-                factor*splev((E-self.edgeenergy-self.delta.value), 
-                self.__goscoeff)*cspline1d_eval(self.fslist.value, 
-                E,dx = self.energy_scale / self.knots_factor, 
-                x0 = self.edgeenergy+self.delta.value), 
-                cts )
+            cts = self._get_fs_basis(E).dot(np.asarray(self.fslist.value, 
+                                                       dtype = 'float'))
         else:
             tabulated_indices = np.logical_and(np.greater_equal(E, 
             self.edgeenergy + self.delta.value), np.less(E, Emax))            
@@ -437,29 +783,11 @@ class EELSCLEdge(Component):
         
         if self.fs_state is True:
             if self.__knots[-1] > Emax : Emax = self.__knots[-1]
-            fine_structure_indices=np.logical_and(np.greater_equal(E, 
-            self.edgeenergy+self.delta.value), 
-            np.less(E, self.edgeenergy + self.delta.value + self.fs_emax))
             tabulated_indices = np.logical_and(np.greater_equal(E, 
             self.edgeenergy + self.delta.value + self.fs_emax), 
             np.less(E, Emax))
-            if self.fs_mode == "new_spline" :
-                cts = np.where(fine_structure_indices, 
-                1E-25*splev(E,(self.__knots,self.fslist.value,3),0), cts)
-            elif self.fs_mode == "spline" :
-                cts = np.where(fine_structure_indices, 
-                cspline1d_eval(self.fslist.value, 
-                E, 
-                dx = self.energy_scale / self.knots_factor, 
-                x0 = self.edgeenergy+self.delta.value), 
-                cts)
-            elif self.fs_mode == "spline_times_edge" :
-                cts = np.where(fine_structure_indices, 
-                factor*splev((E-self.edgeenergy-self.delta.value), 
-                self.__goscoeff)*cspline1d_eval(self.fslist.value, 
-                E,dx = self.energy_scale / self.knots_factor, 
-                x0 = self.edgeenergy+self.delta.value), 
-                cts )
+            cts = self._get_fs_basis(E).dot(np.asarray(self.fslist.value, 
+                                                       dtype = 'float'))
         else:
             tabulated_indices = np.logical_and(np.greater_equal(E, 
             self.edgeenergy + self.delta.value), np.less(E, Emax))
@@ -476,6 +804,18 @@ class EELSCLEdge(Component):
         return ((1.0e28 *self.__subshell_factor * self.energy_scale)/R)*cts        
 
     
+    def grad_fslist(self, E):
+        
+        if self.delta.value != self._previous_delta :
+            self._previous_delta = copy.copy(self.delta.value)
+            self.integrategos(self.delta.value)
+            self.calculate_knots()
+            
+        if self.fs_state is not True:
+            return np.zeros((self.fslist._number_of_elements, len(E)))
+        return (self.__subshell_factor * self.intensity.value * 
+            self.energy_scale * 1.0e28 / R) * self._get_fs_basis(E).T.toarray()
+    
     def grad_delta(self,E) :
         """ Calculates the number of counts in barns"""
         
@@ -54,12 +54,18 @@ class Gaussian(Component):
         # Boundaries
         self.A.bmin = 0.
         self.A.bmax = None
+        self.A.is_linear = True
 
         self.sigma.bmin = None
         self.sigma.bmax = None
 
         self.isbackground = False
         self.convolved = True
+        # If not None, the function is evaluated only in
+        # centre +- support_widths * sigma when fitting, e.g. 8 evaluates it
+        # where it is above 1e-14 times its maximum. It is disabled by
+        # default because the model outside of the support is then zero.
+        self.support_widths = None
 
         # Gradients
         self.A.grad = self.grad_A
@@ -77,16 +83,26 @@ class Gaussian(Component):
         return self.function(x) / self.A.value
     
     def grad_sigma(self,x):
-        return ((x - self.centre.value)**2 * np.exp(-(x - self.centre.value)**2 
-        /(2 * self.sigma.value**2)) * self.A.value) / (sqrt2pi * 
-        self.sigma.value**4)-(np.exp(-(x - self.centre.value)**2 / (2 * 
-        self.sigma.value**2)) * self.A.value) / (sqrt2pi * self.sigma.value**2)
+        sigma = self.sigma.value
+        d2 = (x - self.centre.value)**2
+        return self.A.value * np.exp(-d2 / (2 * sigma**2)) * (
+            d2 / sigma**2 - 1) / (sqrt2pi * sigma**2)
     
     def grad_centre(self,x):
         return ((x - self.centre.value) * np.exp(-(x - self.centre.value)**2/(2 
         * self.sigma.value**2)) * self.A.value) / (sqrt2pi * 
         self.sigma.value**3)
         
+    def get_support(self):
+        """Returns centre +- support_widths * sigma or None if 
+        support_widths is None."""
+        centre = self.centre.value
+        sigma = self.sigma.value
+        if self.support_widths is None or np.ndim(centre) or np.ndim(sigma):
+            return None
+        width = self.support_widths * abs(sigma)
+        return centre - width, centre + width
+        
     def estimate_parameters(self, signal, E1, E2, only_current = False):
         """Estimate the gaussian by calculating the momenta.
 
@@ -49,11 +49,17 @@ class Lorentzian(Component):
         # Boundaries
         self.A.bmin = 0.
         self.A.bmax = None
+        self.A.is_linear = True
         self.gamma.bmin = None
         self.gamma.bmax = None
 
         self.isbackground = False
         self.convolved = True
+        # If not None, the function is evaluated only in
+        # centre +- support_widths * gamma when fitting. The tails of the
+        # lorentzian decay slowly, e.g. with 100 the function is truncated
+        # at 1e-4 times its maximum, therefore it is disabled by default.
+        self.support_widths = None
         
         # Gradients
         self.A.grad = self.grad_A
@@ -87,4 +93,12 @@ class Lorentzian(Component):
         return (2 * (x - self.centre.value) * self.A.value * self.gamma.value
         )/(np.pi * (self.gamma.value**2 + (x - self.centre.value)**2)**2)
         
-        
+    def get_support(self):
+        """Returns centre +- support_widths * gamma or None if 
+        support_widths is None."""
+        centre = self.centre.value
+        gamma = self.gamma.value
+        if self.support_widths is None or np.ndim(centre) or np.ndim(gamma):
+            return None
+        width = self.support_widths * abs(gamma)
+        return centre - width, centre + width
@@ -39,6 +39,7 @@ class Offset(Component):
         Component.__init__(self, ('offset',))
         self.offset.free = True
         self.offset.value = offset
+        self.offset.is_linear = True
 
         self.isbackground = True
         self.convolved = False
@@ -26,6 +26,10 @@ sqrt2pi = np.sqrt(2*np.pi)
 class PESCoreLineShape(Component):
     """
     """
+    # The Shirley background of the last evaluation is stored in cf, which
+    # does not invalidate the evaluation cache
+    _cache_independent_attributes = \
+        Component._cache_independent_attributes | frozenset(('cf',))
 
     def __init__(self, A=1., FWHM=1.,origin = 0.):
         Component.__init__(self, ['A', 'FWHM', 'origin', 'ab', 'shirley'])
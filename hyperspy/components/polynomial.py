@@ -96,6 +96,8 @@ class Polynomial(Component):
         self.coefficients.value = np.zeros((order + 1,))
         self.coefficients.grad = self.grad_coefficients
         self.coefficients._number_of_elements = order + 1
+        self.coefficients.is_linear = True
+        self._update_free_parameters()
         
     def get_polynomial_order(self):
         return len(self.coefficients.value) - 1
@@ -109,11 +111,7 @@ class Polynomial(Component):
         self.diff_coefficients = coeff[:-1]
 
     def grad_coefficients(self, x):
-        self.compute_grad_coefficients()
-        if self.diff_coefficients is not None:
-            return np.polyval(self.diff_coefficients, x)
-        else:
-            return x * 0
+        return np.vander(x, self.get_polynomial_order() + 1).T
 
     def __repr__(self):
         return 'Component <%s order polynomial>' % (
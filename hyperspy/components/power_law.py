@@ -55,6 +55,7 @@ class PowerLaw(Component):
         # Boundaries
         self.A.bmin = 0.
         self.A.bmax = None
+        self.A.is_linear = True
         self.r.bmin = 1.
         self.r.bmax = 5.
 
@@ -74,6 +74,8 @@ class ScalableFixedPattern(Component):
         self.xscale.value = 1.
         self.offset.value = 0.
         self.shift.value = 0.
+        self.yscale.is_linear = True
+        self.offset.is_linear = True
         
         self.prepare_interpolator()
         # Options
@@ -79,6 +79,10 @@ class Voigt(Component):
     spin_orbit_splitting_energy : float
     
     """
+    # The Shirley background of the last evaluation is stored in cf, which
+    # does not invalidate the evaluation cache
+    _cache_independent_attributes = \
+        Component._cache_independent_attributes | frozenset(('cf',))
 
     def __init__(self):
         Component.__init__(self, (
@@ -109,6 +113,10 @@ class Voigt(Component):
         
         self.isbackground = False
         self.convolved = True
+        # If not None, the function is evaluated only in
+        # origin +- support_widths * (FWHM + gamma) when fitting. Because of
+        # the lorentzian tails it is disabled by default.
+        self.support_widths = None
 
     def function(self, x):
         area = self.area.value * self.transmission_function.value
@@ -136,3 +144,19 @@ class Voigt(Component):
         else:
             return f
 
+    def get_support(self):
+        """Returns the interval of support_widths * (FWHM + gamma) around
+        the peak, extended to the spin-orbit split peak, or None if 
+        support_widths is None or the shirley background is active."""
+        if self.support_widths is None or self.shirley_background.active:
+            return None
+        values = [parameter.value for parameter in self.parameters]
+        if [value for value in values if np.ndim(value)]:
+            return None
+        centres = [self.origin.value - self.non_isochromaticity.value]
+        if self.spin_orbit_splitting is True:
+            centres.append(centres[0] - self.spin_orbit_splitting_energy)
+        width = self.support_widths * (
+            math.sqrt(self.FWHM.value**2 + self.resolution.value**2) + 
+            abs(self.gamma.value))
+        return min(centres) - width, max(centres) + width
@@ -22,38 +22,58 @@ import math
 import scipy.optimize
 import numpy.linalg
 
-_epsilon = (np.finfo(float).eps)**(1/4.)
-
-def approx_fprime_k(xk,f,k,*args):
-    f0 = f(*((xk,)+args))
-    ei = np.zeros((len(xk),), float)
-    ei[k] = _epsilon
-    return (f(*((xk+ei,)+args)) - f0) / _epsilon
-
-def approx_hessian(xk,f,*args):
-    num_par = len(xk)
-    hess = np.zeros((num_par, num_par))
-    for k in xrange(num_par):
-        for l in xrange(num_par):
-            hess[k,l] = approx_fprime_k(xk, approx_fprime_k,k,f,l,*args)
-    return hess  
-
 class Estimators:
     """
     """
     def calculate_p_std(self, p0, method, *args):
-        print "Estimating the standard deviation"
-        f = self._poisson_likelihood_function if method == 'ml' \
-        else self._errfunc2
-        hess = approx_hessian(p0,f,*args)
-        ihess = np.linalg.inv(hess)
-        p_std = np.sqrt(1./np.diag(ihess))
-        return p_std
+        """Estimate the standard deviation of the free parameters from the
+        inverse of the Fisher information matrix.
+        
+        For the least squares method the Gauss-Newton approximation of the
+        hessian, J W^2 J^T, is used and for the Poisson maximum likelihood 
+        method the Fisher information, J diag(1/model) J^T, where J is the 
+        jacobian of the model and W the weights. The analytical jacobian 
+        is used when all the free parameters define their gradient, 
+        otherwise it is computed by forward differences.
+        
+        Parameters
+        ----------
+        p0 : array
+            The free parameters.
+        method : {'ls', 'ml'}
+        *args : 
+            The data and, optionally, the weights.
+            
+        Returns
+        -------
+        The array of standard deviations or None if the information matrix
+        is singular.
+        
+        """
+        p0 = np.atleast_1d(np.asarray(p0, dtype = 'float'))
+        y = args[0]
+        weights = args[1] if len(args) > 1 and method == 'ls' else None
+        if self._has_analytical_jacobian():
+            jacobian = self._jacobian(p0, y).copy()
+        else:
+            jacobian = self._approx_jacobian(p0)
+        if method == 'ml':
+            model = self._model_function(p0)
+            jacobian /= np.sqrt(np.clip(model, np.finfo(float).tiny, 
+                                        np.inf))
+        elif weights is not None:
+            jacobian *= weights
+        try:
+            covariance = np.linalg.inv(np.dot(jacobian, jacobian.T))
+        except np.linalg.LinAlgError:
+            return None
+        return np.sqrt(np.abs(np.diag(covariance)))
 
     def _poisson_likelihood_function(self,param,y, weights = None):
         """Returns the likelihood function of the model for the given
         data and parameters
         """
+        self._nfev += 1
         mf = self._model_function(param)
         return -(y*np.log(mf) - mf).sum()
 
@@ -63,6 +83,7 @@ class Estimators:
 
 
     def _errfunc(self,param, y, weights = None):
+        self._nfev += 1
         errfunc = self._model_function(param) - y
         if weights is None:
             return errfunc
@@ -78,10 +99,42 @@ class Estimators:
         gls =(2*self._errfunc(param, y, weights) * 
         self._jacobian(param, y)).sum(1)
         return gls
-        
+
+    # Finite differences derivatives used when grad is False. All the
+    # displaced parameters are evaluated in a single vectorized call, which
+    # counts as len(param) + 1 function evaluations. The gradients reuse 
+    # the model evaluated at param in that call.
+
+    def _approx_jacobian_ls(self, param, y, weights = None):
+        self._nfev += len(param) + 1
+        jacobian = self._approx_jacobian(param)
+        if weights is not None:
+            jacobian *= weights
+        return jacobian
+
+    def _approx_gradient_ml(self, param, y, weights = None):
+        self._nfev += len(param) + 1
+        jacobian, mf = self._approx_jacobian(param, full_output = True)
+        return -(jacobian * (y / mf - 1)).sum(1)
+
+    def _approx_gradient_ls(self, param, y, weights = None):
+        self._nfev += len(param) + 1
+        jacobian, errfunc = self._approx_jacobian(param, full_output = True)
+        errfunc = errfunc - y
+        if weights is not None:
+            errfunc *= weights
+            jacobian *= weights
+        return (2 * errfunc * jacobian).sum(1)
+
     def _errfunc4mpfit(self, p, fjac = None, x = None, y = None, weights = None):
         if fjac is None:
-            errfunc = self._model_function(p) - y
+            if np.ndim(p) == 2:
+                # Several sets of parameters at once
+                self._nfev += len(p)
+                errfunc = self._model_function_vectorized(p) - y
+            else:
+                self._nfev += 1
+                errfunc = self._model_function(p) - y
             if weights is not None:
                 errfunc *= weights
             jacobian = None
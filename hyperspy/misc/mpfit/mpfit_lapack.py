@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+# Copyright 2007-2011 The Hyperspy developers
+#
+# This file is part of  Hyperspy.
+#
+#  Hyperspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+#  Hyperspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with  Hyperspy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""mpfit with the linear algebra performed by LAPACK.
+
+The :py:class:`mpfit` class of this module is a drop-in replacement of
+:py:class:`hyperspy.misc.mpfit.mpfit.mpfit`. It uses the same
+Levenberg-Marquardt iteration, parinfo and outputs but the QR
+factorisations of `qrfac` and `qrsolv`, which are Python loops over the
+elements in the original, are computed by LAPACK through scipy.linalg.
+
+In addition, if `vectorized` is True the finite differences jacobian is
+computed in a single call to the user function, which must then accept a
+two dimensional array of parameters, one set of parameters per row, and
+return the deviations as an array with one row per set of parameters.
+
+"""
+
+import numpy
+import scipy.linalg
+
+from hyperspy.misc.mpfit.mpfit import mpfit as _mpfit
+
+class mpfit(_mpfit):
+    """mpfit with the linear algebra performed by LAPACK.
+    
+    See :py:class:`hyperspy.misc.mpfit.mpfit.mpfit` for the description of
+    the arguments. If `vectorized` is True, `fcn` must accept a two 
+    dimensional array of parameters.
+    
+    """
+
+    def __init__(self, fcn, xall = None, functkw = {}, parinfo = None,
+                 vectorized = False, **kwargs):
+        self.vectorized = vectorized
+        _mpfit.__init__(self, fcn, xall = xall, functkw = functkw,
+                        parinfo = parinfo, **kwargs)
+
+    def call(self, fcn, x, functkw, fjac = None):
+        if fjac is not None or numpy.ndim(x) == 1:
+            return _mpfit.call(self, fcn, x, functkw, fjac = fjac)
+        # Several sets of parameters at once
+        if self.qanytied:
+            x = x.copy()
+            for row in x:
+                self.tie(row, self.ptied)
+        self.nfev = self.nfev + len(x)
+        [status, f] = fcn(x, fjac = None, **functkw)
+        if self.damp > 0:
+            f = numpy.tanh(f / self.damp)
+        return [status, f]
+
+    def fdjac2(self, fcn, x, fvec, step = None, ulimited = None,
+               ulimit = None, dside = None, epsfcn = None, autoderivative = 1,
+               functkw = None, xall = None, ifree = None, dstep = None):
+        if self.vectorized is False or autoderivative == 0:
+            return _mpfit.fdjac2(self, fcn, x, fvec, step = step,
+                ulimited = ulimited, ulimit = ulimit, dside = dside,
+                epsfcn = epsfcn, autoderivative = autoderivative,
+                functkw = functkw, xall = xall, ifree = ifree, dstep = dstep)
+        machep = self.machar.machep
+        if epsfcn is None:
+            epsfcn = machep
+        if xall is None:
+            xall = x
+        if ifree is None:
+            ifree = numpy.arange(len(xall))
+        n = len(x)
+        eps = numpy.sqrt(max(epsfcn, machep))
+        # The steps are chosen as in mpfit.fdjac2
+        h = eps * numpy.abs(x)
+        if step is not None:
+            stepi = step[ifree]
+            h[stepi > 0] = stepi[stepi > 0]
+        if len(dstep) > 0:
+            dstepi = dstep[ifree]
+            wh = dstepi > 0
+            h[wh] = numpy.abs(dstepi[wh] * x[wh])
+        h[h == 0] = eps
+        mask = dside[ifree] == -1
+        if len(ulimited) > 0 and len(ulimit) > 0:
+            mask = mask | ((ulimited != 0) & (x > ulimit - h))
+        h[mask] = -h[mask]
+        # All the displaced parameters are evaluated at once
+        two_sided = numpy.abs(dside[ifree]) > 1
+        columns = numpy.arange(n)
+        xp = numpy.repeat(xall[numpy.newaxis], n, 0)
+        xp[columns, ifree] += h
+        xm = numpy.repeat(xall[numpy.newaxis], two_sided.sum(), 0)
+        xm[numpy.arange(len(xm)), ifree[two_sided]] -= h[two_sided]
+        [status, f] = self.call(fcn, numpy.vstack((xp, xm)), functkw)
+        if status < 0:
+            return None
+        f = numpy.asarray(f)
+        fjac = ((f[:n] - fvec) / h[:, numpy.newaxis]).T
+        if two_sided.any():
+            fjac[:, two_sided] = ((f[:n][two_sided] - f[n:]) /
+                                  (2 * h[two_sided, numpy.newaxis])).T
+        return fjac
+
+    def qrfac(self, a, pivot = 0):
+        """QR factorisation with column pivoting of `a` returned in the
+        format of MINPACK's qrfac, i.e. the Householder vectors in the
+        lower trapezoid of the unpermuted columns of `a` and the strict
+        upper triangle of R in its upper triangle."""
+        if self.debug: print 'Entering qrfac...'
+        m, n = a.shape
+        acnorm = numpy.sqrt(numpy.sum(a * a, 0))
+        if pivot != 0:
+            (qr, tau), r, ipvt = scipy.linalg.qr(a, mode = 'raw',
+                                                 pivoting = True)
+        else:
+            (qr, tau), r = scipy.linalg.qr(a, mode = 'raw')
+            ipvt = numpy.arange(n)
+        # LAPACK stores the Householder reflectors as I - tau * v * v.T
+        # with v[0] = 1, MINPACK as I - u * u.T / u[0]. Therefore, u =
+        # tau * v
+        k = min(m, n)
+        qr = numpy.array(qr[:, :n])
+        lower = numpy.tril_indices(m, -1, n)
+        qr[lower] *= tau[lower[1]]
+        rdiag = numpy.zeros(n)
+        rdiag[:k] = numpy.diagonal(qr)[:k]
+        qr[numpy.arange(k), numpy.arange(k)] = tau[:k]
+        a = numpy.empty((m, n))
+        a[:, ipvt] = qr
+        return [a, ipvt, rdiag, acnorm]
+
+    def qrsolv(self, r, ipvt, diag, qtb, sdiag):
+        """Solve the least squares problem [R; D] x = [qtb; 0] as MINPACK's
+        qrsolv, with the QR factorisation of the augmented system computed
+        by LAPACK."""
+        if self.debug:
+            print 'Entering qrsolv...'
+        n = r.shape[1]
+        # The last column of the R factor of the augmented matrix is
+        # (q transpose) * (qtb, 0)
+        augmented = numpy.zeros((2 * n, n + 1))
+        augmented[:n, :n] = numpy.triu(r[:n, :n])
+        augmented[n + numpy.arange(n), numpy.arange(n)] = diag[ipvt]
+        augmented[:n, n] = qtb
+        s = scipy.linalg.qr(augmented, mode = 'r')[0]
+        wa = s[:n, n].copy()
+        s = s[:n, :n]
+        sdiag[:] = numpy.diagonal(s)
+        # Solve the triangular system for z. If the system is singular
+        # then obtain a least squares solution
+        nsing = n
+        wh = (numpy.nonzero(sdiag == 0))[0]
+        if len(wh) > 0:
+            nsing = wh[0]
+            wa[nsing:] = 0
+        if nsing >= 1:
+            wa[:nsing] = scipy.linalg.solve_triangular(s[:nsing, :nsing],
+                                                       wa[:nsing])
+        # The strict lower triangle of r contains the strict upper
+        # triangle of s transposed
+        r = r.copy()
+        lower = numpy.tril_indices(n, -1)
+        r[lower] = s.T[lower]
+        x = numpy.zeros(n)
+        x[ipvt] = wa
+        return (r, x, sdiag)
+
+    def calc_covar(self, rr, ipvt = None, tol = 1.e-14):
+        """Covariance matrix from the R factor of the QR factorisation of
+        the jacobian as MINPACK's covar. The columns beyond the first 
+        negligible diagonal element of R are treated as singular and their
+        covariance is set to zero."""
+        if self.debug:
+            print 'Entering calc_covar...'
+        if numpy.ndim(rr) != 2:
+            print 'ERROR: r must be a two-dimensional matrix'
+            return -1
+        n = rr.shape[0]
+        if rr.shape[0] != rr.shape[1]:
+            print 'ERROR: r must be a square matrix'
+            return -1
+        if ipvt is None:
+            ipvt = numpy.arange(n)
+        r = numpy.triu(rr)
+        rdiag = numpy.abs(numpy.diagonal(r))
+        wh = (numpy.nonzero(rdiag <= tol * rdiag[0]))[0]
+        rank = wh[0] if len(wh) > 0 else n
+        covar = numpy.zeros((n, n))
+        if rank > 0:
+            rinv = scipy.linalg.solve_triangular(r[:rank, :rank], 
+                                                 numpy.eye(rank))
+            covar[numpy.ix_(ipvt[:rank], ipvt[:rank])] = numpy.dot(rinv, 
+                                                                   rinv.T)
+        return covar
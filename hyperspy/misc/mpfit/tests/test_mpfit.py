@@ -3,6 +3,7 @@ import numpy as N
 import copy
 
 from hyperspy.misc.mpfit.mpfit import mpfit
+from hyperspy.misc.mpfit import mpfit_lapack
 
 
 def Flin(x,p):
@@ -72,5 +73,65 @@ def test_rosenbrock():
     assert N.allclose(m.fnorm,0)
     return
 
+def myfunctlin_vectorized(p, fjac=None, x=None, y=None, err=None):
+    # One row of deviations per row of parameters
+    p = N.atleast_2d(p)
+    model = p[:, 0, N.newaxis] - p[:, 1, N.newaxis] * x
+    res = (y - model) / err
+    if res.shape[0] == 1:
+        res = res[0]
+    return [0, res]
+
+def test_linfit_lapack():
+    x=N.array([-1.7237128E+00,1.8712276E+00,-9.6608055E-01,
+		-2.8394297E-01,1.3416969E+00,1.3757038E+00,
+		-1.3703436E+00,4.2581975E-02,-1.4970151E-01,
+		8.2065094E-01])
+    y=N.array([1.9000429E-01,6.5807428E+00,1.4582725E+00,
+		2.7270851E+00,5.5969253E+00,5.6249280E+00,
+		0.787615,3.2599759E+00,2.9771762E+00,
+		4.5936475E+00])
+    ey=0.07*N.ones(y.shape,dtype='float64')
+    p0=N.array([1.0,1.0],dtype='float64')
+    fa = {'x':x, 'y':y, 'err':ey}
+    for vectorized in (False, True):
+        m = mpfit_lapack.mpfit(myfunctlin_vectorized, p0, functkw=fa,
+                               vectorized=vectorized)
+        assert m.status > 0
+        assert N.allclose(m.params,N.array([ 3.20996572, -1.7709542 ]))
+        assert N.allclose(m.perror,N.array([ 0.02221018,  0.01893756]))
+        assert m.dof==8
+
+def test_rosenbrock_lapack():
+    p0=N.array([-1,1.],dtype='float64')
+    m = mpfit_lapack.mpfit(myfunctrosenbrock, p0)
+    assert m.status > 0
+    assert N.allclose(m.params,N.array([1.,1.]))
+    assert N.allclose(m.fnorm,0)
+
+def test_lapack_as_original_with_limits():
+    x = N.linspace(-5, 5, 200)
+    def gaussian(p, fjac=None):
+        p = N.atleast_2d(p)
+        model = p[:, 0, N.newaxis] * N.exp(
+            -(x - p[:, 1, N.newaxis]) ** 2 / (2 * p[:, 2, N.newaxis] ** 2))
+        res = model - (3 * N.exp(-(x - 0.5) ** 2 / 2.) + 0.01 * N.sin(7 * x))
+        return [0, res if res.shape[0] > 1 else res[0]]
+    parinfo = [{'limited' : [0, 0], 'limits' : [0., 0.], 'mpside' : 0}
+               for i in range(3)]
+    parinfo[0]['limited'] = [1, 1]
+    parinfo[0]['limits'] = [0., 2.5]
+    parinfo[1]['mpside'] = 2
+    p0 = N.array([1., 0., 2.])
+    reference = mpfit(gaussian, p0, parinfo=copy.deepcopy(parinfo),
+                      quiet=1)
+    for vectorized in (False, True):
+        m = mpfit_lapack.mpfit(gaussian, p0, 
+                               parinfo=copy.deepcopy(parinfo), quiet=1,
+                               vectorized=vectorized)
+        assert m.status > 0
+        assert N.allclose(m.params, reference.params)
+        assert N.allclose(m.perror, reference.perror)
+
 if __name__ == "__main__":
     run_module_suite()
@@ -17,24 +17,118 @@
 # along with  Hyperspy.  If not, see <http://www.gnu.org/licenses/>.
 
 import copy
+import hashlib
 import os
 import tempfile
+import multiprocessing
 
 import numpy as np
 import traits.api as t
+try:
+    import h5py
+except ImportError:
+    h5py = None
 
+from hyperspy.component import _identity
 from hyperspy.estimators import Estimators
-from hyperspy.optimizers import Optimizers
+from hyperspy.optimizers import Optimizers, batch_leastsq
 from hyperspy import messages
 import hyperspy.drawing.spectrum
 from hyperspy.drawing.utils import on_figure_window_close
 from hyperspy.misc import progressbar
+from hyperspy.misc.utils import rebin
 from hyperspy.signals.eels import EELSSpectrum, Spectrum
+from hyperspy.signal import Signal
 from hyperspy.defaults_parser import preferences
 from hyperspy.axes import generate_axis
 from hyperspy.exceptions import WrongObjectError
 from hyperspy.decorators import interactive_range_selector
 
+# The model that the worker processes operate on. It is set just before 
+# forking the workers so that they inherit it instead of having to pickle 
+# it.
+_worker_model = None
+
+def _multifit_worker(args):
+    indexes, kwargs = args
+    return indexes, _worker_model._fit_pixels(indexes, **kwargs)
+    
+def _generate_data_worker(args):
+    slab, out_of_range_to_nan = args
+    return slab, _worker_model._generate_data_block(slab, 
+                                                    out_of_range_to_nan)
+    
+def _twinned_to_free(parameter):
+    """Returns True if the value of the parameter depends on the value of a
+    free parameter through its twins."""
+    while parameter.twin is not None:
+        parameter = parameter.twin
+        if parameter.free is True:
+            return True
+    return False
+    
+def _hyperslabs(shape, size):
+    """Split an array of the given shape in hyperslabs of at most `size`
+    elements (but at least one element of the last axis) in C order.
+    
+    Returns
+    -------
+    Generator of tuples of ints and slices that index the hyperslabs.
+    
+    """
+    shape = tuple(shape)
+    k = len(shape)
+    inner = 1
+    while k > 0 and inner * shape[k - 1] <= size:
+        k -= 1
+        inner *= shape[k]
+    if k == 0:
+        yield (slice(None),) * len(shape)
+        return
+    step = max(size // inner, 1)
+    for index in np.ndindex(shape[:k - 1]):
+        for start in xrange(0, shape[k - 1], step):
+            yield index + (slice(start, start + step),) + \
+                (slice(None),) * (len(shape) - k)
+    
+def _serpentine_indexes(shape):
+    """Returns the indexes of an array of the given shape in C order but
+    reversing the direction of the scan at every row, so that consecutive
+    indexes are always neighbours."""
+    if len(shape) <= 1:
+        return [(i,) for i in xrange(shape[0])] if shape else [()]
+    inner = _serpentine_indexes(shape[1:])
+    indexes = []
+    for i in xrange(shape[0]):
+        indexes.extend([(i,) + index for index in 
+                        (inner if i % 2 == 0 else inner[::-1])])
+    return indexes
+    
+def _hilbert_indexes(shape):
+    """Returns the indexes of a 2D array of the given shape in the order of
+    the Hilbert curve that covers the smallest square of power of two side
+    containing it."""
+    n = 2 ** int(np.ceil(np.log2(max(max(shape), 1))))
+    d = np.arange(n * n)
+    x = np.zeros(n * n, dtype = 'int')
+    y = np.zeros(n * n, dtype = 'int')
+    s = 1
+    while s < n:
+        rx = 1 & (d // 2)
+        ry = 1 & (d ^ rx)
+        # Rotate the quadrant
+        flip = (ry == 0) & (rx == 1)
+        x[flip] = s - 1 - x[flip]
+        y[flip] = s - 1 - y[flip]
+        swap = ry == 0
+        x[swap], y[swap] = y[swap], x[swap].copy()
+        x += s * rx
+        y += s * ry
+        d //= 4
+        s *= 2
+    inside = (x < shape[0]) & (y < shape[1])
+    return zip(x[inside].tolist(), y[inside].tolist())
+
 class Model(list, Optimizers, Estimators):
     """Build and fit a model
     
@@ -60,6 +154,32 @@ class Model(list, Optimizers, Estimators):
         self.model_cube[:] = np.nan
         self.channel_switches=np.array([True] * len(self.axis.axis))
         self._low_loss = None
+        self._jacobian_buffer = None
+        self._fitting_axis = None
+        self._signal_binning = None
+        self._fixed_baseline = {}
+        self._variable_projection = None
+        self._low_loss_fft = None
+        self._parameter_store = None
+        self._store_parameters = []
+        self._free_index = None
+        self._fixed_mask = None
+        self._evaluation_plan = None
+        # Increased when the free parameters or active components change
+        self._configuration_version = 0
+        self._twin_graph = None
+        self._nfev = 0
+        self._warm_start = None
+        self._checkpoint = None
+        # The digests state of the pixels fitted by multifit, see
+        # _get_hashing_state
+        self._hashing = None
+        self.fit_info = None
+        self.fit_success = None
+        self.fit_cost = None
+        self.chisq = None
+        self.red_chisq = None
+        self.rms_residual = None
 
     @property
     def spectrum(self):
@@ -78,6 +198,8 @@ class Model(list, Optimizers, Estimators):
         
     @low_loss.setter
     def low_loss(self, value):
+        self._low_loss_fft = None
+        self._evaluation_plan = None
         if value is not None:
             self._low_loss = value
             self.set_convolution_axis()
@@ -124,6 +246,9 @@ class Model(list, Optimizers, Estimators):
         from the model.
         """
         self.connect_parameters2update_plot()
+        self._jacobian_buffer = None
+        self._fixed_baseline = {}
+        self._invalidate_parameter_store()
         
     __touch = _touch
     
@@ -146,12 +271,14 @@ class Model(list, Optimizers, Estimators):
                 if self.spectrum._plot is not None:
                     parameter.connect(self.update_plot)
                 parameter.connection_active = False
+        self._evaluation_plan = None
     
     def disconnect_parameters2update_plot(self):
         for component in self:
             for parameter in component.parameters:
                 parameter.disconnect(self.update_plot)
                 parameter.connection_active = False
+        self._evaluation_plan = None
         self.set_auto_update_plot(False)
                             
     def set_auto_update_plot(self, tof):
@@ -159,61 +286,241 @@ class Model(list, Optimizers, Estimators):
             for parameter in component.parameters:
                 parameter.connection_active = tof
         self.auto_update_plot = tof
+        self._evaluation_plan = None
 
-    def generate_data_from_model(self, out_of_range_to_nan = True):
+    def generate_data_from_model(self, out_of_range_to_nan = True, 
+                                 out = None, batch_size = 1024, 
+                                 parallel = False, max_workers = None):
         """Generate a SI with the current model
         
-        The SI is stored in self.model_cube
+        The model is evaluated for blocks of pixels at once with the values
+        of the parameters maps. Where a parameter map is not set the 
+        current value of the parameter is used.
+        
+        The current values of the parameters are left unchanged, i.e. the
+        model is not charged at the last pixel anymore.
+        
+        Parameters
+        ----------
+        out_of_range_to_nan : bool
+            If True the channels outside the data range are set to nan, 
+            otherwise the model is also evaluated there.
+        out : {None, array}
+            The array in which the SI is stored. It must have the shape of 
+            the spectrum data and support slice assignment, e.g. a numpy 
+            array, a numpy.memmap or an h5py dataset, so that SIs larger 
+            than the memory can be generated. If None, the SI is stored in 
+            self.model_cube.
+        batch_size : int
+            The maximum number of pixels evaluated at once.
+        parallel : bool
+            If True the blocks of pixels are evaluated in `max_workers` 
+            worker processes. It requires a platform that supports forking
+            the current process.
+        max_workers : {None, int}
+            The number of worker processes. If None, the number of CPUs.
         """
-        pbar = progressbar.progressbar(
-        maxval = (np.cumprod(self.axes_manager.navigation_shape)[-1]))
-        i = 0
-        for index in np.ndindex(tuple(self.axes_manager.navigation_shape)):
-            self.axes_manager.set_not_slicing_indexes(index)
-            self.charge(only_fixed = False)
-            self.model_cube[self.axes_manager._getitem_tuple][
-            self.channel_switches] = self.__call__(
-                non_convolved = not self.convolved, onlyactive = True)
-            if out_of_range_to_nan is True:
-                self.model_cube[self.axes_manager._getitem_tuple][
-                self.channel_switches == False] = np.nan
-            i += 1
-            pbar.update(i)
+        global _worker_model
+        if out is None:
+            out = self.model_cube
+        shape = tuple(self.axes_manager.navigation_shape)
+        slabs = list(_hyperslabs(shape, batch_size))
+        pbar = progressbar.progressbar(maxval = len(slabs))
+        if parallel is True and not hasattr(os, 'fork'):
+            messages.information(
+            "Parallel evaluation is not supported in this platform, "
+            "evaluating serially instead")
+            parallel = False
+        switch_aap = self.auto_update_plot
+        if switch_aap is True:
+            self.set_auto_update_plot(False)
+        pool = None
+        try:
+            if parallel is True:
+                if max_workers is None:
+                    max_workers = multiprocessing.cpu_count()
+                _worker_model = self
+                pool = multiprocessing.Pool(processes = max_workers)
+                blocks = pool.imap_unordered(_generate_data_worker, 
+                    [(slab, out_of_range_to_nan) for slab in slabs])
+            else:
+                blocks = ((slab, self._generate_data_block(slab, 
+                    out_of_range_to_nan)) for slab in slabs)
+            for i, (slab, block) in enumerate(blocks):
+                out[slab + (slice(None),)] = block
+                pbar.update(i + 1)
+            if pool is not None:
+                pool.close()
+        except:
+            if pool is not None:
+                pool.terminate()
+            raise
+        finally:
+            if pool is not None:
+                pool.join()
+                _worker_model = None
+            if switch_aap is True:
+                self.set_auto_update_plot(True)
+        pbar.finish()
+        
+    def _generate_data_block(self, slab, out_of_range_to_nan = True):
+        """Evaluate the model at the pixels of the given hyperslab of the
+        navigation space.
+        
+        Returns
+        -------
+        Array with the shape of the hyperslab plus the signal axis.
+        
+        """
+        shape = tuple(self.axes_manager.navigation_shape)
+        ranges = [np.arange(size)[index] if isinstance(index, slice) 
+                  else np.array([index]) for size, index in zip(shape, slab)]
+        slab_shape = tuple([len(r) for r, index in zip(ranges, slab)
+                            if isinstance(index, slice)])
+        index_arrays = tuple([grid.ravel() for grid in 
+                              np.meshgrid(*ranges, indexing = 'ij')])
+        nrows = len(index_arrays[0])
+        values = self._get_batch_values(np.transpose(index_arrays))
+        backup = [(parameter, parameter.value) for parameter in 
+                  values.iterkeys()]
+        self._charge_batch_values(values)
+        try:
+            if self.convolved is False:
+                axis = self._get_fitting_axis() if out_of_range_to_nan \
+                    else self.axis.axis
+                sum_ = np.zeros((nrows, len(axis)))
+                for component in self:
+                    active = self._get_active_rows(component, index_arrays)
+                    if active is not None:
+                        sum_ += active * self._evaluate_batch(
+                            component.function, axis, values, nrows)
+                if out_of_range_to_nan is True:
+                    result = np.empty((nrows, len(self.axis.axis)))
+                    result[:] = np.nan
+                    result[:, self.channel_switches] = sum_
+                else:
+                    result = sum_
+            else:
+                sum_convolved = np.zeros((nrows, len(self.convolution_axis)))
+                result = np.zeros((nrows, len(self.axis.axis)))
+                for component in self:
+                    active = self._get_active_rows(component, index_arrays)
+                    if active is None:
+                        continue
+                    if component.convolved:
+                        sum_convolved += active * self._evaluate_batch(
+                            component.function, self.convolution_axis, 
+                            values, nrows)
+                    else:
+                        result += active * self._evaluate_batch(
+                            component.function, self.axis.axis, values, 
+                            nrows)
+                result += self._convolve(sum_convolved, 
+                    low_loss = self.low_loss.data[index_arrays])
+                if out_of_range_to_nan is True:
+                    result[:, self.channel_switches == False] = np.nan
+        finally:
+            for parameter, value in backup:
+                parameter.value = value
+        return result.reshape(slab_shape + (result.shape[-1],))
+            
+    def compute_goodness_of_fit(self, batch_size = 1024):
+        """Compute the chi-squared, the reduced chi-squared and the root 
+        mean square of the residuals at every pixel.
+        
+        The model is evaluated in blocks of `batch_size` pixels, therefore
+        the full model cube is never stored in memory. Only the channels 
+        inside the data range are used. The residuals are weighted by the
+        variance of the spectrum, which is estimated if it is not defined.
+        The number of degrees of freedom at every pixel is the number of 
+        channels in the data range minus the number of free parameters of
+        the components that are active at that pixel.
+        
+        The results are also stored in the chisq, red_chisq and 
+        rms_residual attributes.
+        
+        Parameters
+        ----------
+        batch_size : int
+            The maximum number of pixels evaluated at once.
             
-# TODO: port it                    
-#    def generate_chisq(self, degrees_of_freedom = 'auto') :
-#        if self.spectrum.variance is None:
-#            self.spectrum.estimate_variance()
-#        variance = self.spectrum.variance[self.channel_switches]
-#        differences = (self.model_cube - self.spectrum.data)[self.channel_switches]
-#        self.chisq = np.sum(differences**2 / variance, 0)
-#        if degrees_of_freedom == 'auto':
-#            self.red_chisq = self.chisq / \
-#            (np.sum(np.ones(self.spectrum.energydimension)[self.channel_switches]) \
-#            - len(self.p0) -1)
-#            print "Degrees of freedom set to auto"
-#            print "DoF = ", len(self.p0)
-#        elif type(degrees_of_freedom) is int :
-#            self.red_chisq = self.chisq / \
-#            (np.sum(np.ones(self.spectrum.energydimension)[self.channel_switches]) \
-#            - degrees_of_freedom -1)
-#        else:
-#            print "degrees_of_freedom must be on interger type."
-#            print "The red_chisq could not been calculated"
+        Returns
+        -------
+        chisq, red_chisq, rms_residual : Signal instances
+            Maps with the navigation shape.
+            
+        """
+        if self.spectrum.variance is None:
+            self.spectrum.estimate_variance()
+        variance = self.spectrum.variance
+        if variance is None:
+            messages.information(
+            "The variance could not be estimated, the chi-squared is "
+            "computed with unit variance")
+        shape = tuple(self.axes_manager.navigation_shape)
+        chisq = np.zeros(shape)
+        rms = np.zeros(shape)
+        switches = self.channel_switches
+        # Views of the data and variance with the signal axis last, as the
+        # blocks returned by _generate_data_block
+        signal_axis = self.axis.index_in_array
+        data = np.rollaxis(self.spectrum.data, signal_axis, 
+                           self.spectrum.data.ndim)
+        if variance is not None:
+            variance = np.rollaxis(variance, signal_axis, variance.ndim)
+        switch_aap = self.auto_update_plot
+        if switch_aap is True:
+            self.set_auto_update_plot(False)
+        try:
+            for slab in _hyperslabs(shape, batch_size):
+                residual = (data[slab][..., switches] - 
+                    self._generate_data_block(slab)[..., switches])
+                rms[slab] = np.sqrt((residual ** 2).mean(-1))
+                if variance is not None:
+                    residual /= np.sqrt(variance[slab][..., switches])
+                chisq[slab] = (residual ** 2).sum(-1)
+        finally:
+            if switch_aap is True:
+                self.set_auto_update_plot(True)
+        # The free parameters only count where their component is active
+        nfree = np.zeros(shape)
+        for component in self:
+            n = sum([parameter._number_of_elements 
+                     for parameter in component.free_parameters])
+            if component.active_map is not None:
+                nfree += n * component.active_map
+            elif component.active:
+                nfree += n
+        degrees_of_freedom = switches.sum() - nfree
+        results = []
+        for data, title in ((chisq, 'chi-squared'), 
+                            (chisq / degrees_of_freedom, 
+                             'reduced chi-squared'), 
+                            (rms, 'RMS residual')):
+            signal = Signal({'data' : data, 'axes' : 
+                self.axes_manager._get_non_slicing_axes_dicts()})
+            signal.mapped_parameters.title = title
+            for axis in signal.axes_manager.axes:
+                axis.navigate = False
+            results.append(signal)
+        self.chisq, self.red_chisq, self.rms_residual = results
+        return tuple(results)
 
+    def _get_active_rows(self, component, index_arrays):
+        """Returns None if the component is inactive in all the given 
+        pixels, otherwise True or, if the component has an active map, a
+        boolean column array that is True in the rows of the pixels where
+        it is active."""
+        if component.active_map is None:
+            return True if component.active else None
+        active = component.active_map[index_arrays]
+        if not active.any():
+            return None
+        return active[:, np.newaxis]
+        
     def _set_p0(self):
-        p0 = None
-        for component in self:
-            if component.active:
-                for param in component.free_parameters:
-                    if p0 is not None:
-                        p0 = (p0 + [param.value,] 
-                        if not isinstance(param.value, list) 
-                        else p0 + param.value)
-                    else:
-                        p0 = ([param.value,] 
-                        if not isinstance(param.value, list) 
-                        else param.value)
+        index, parameters, components = self._get_free_index()
+        p0 = self._get_store_values()[index]
         self.p0 = tuple(p0)
     
     def set_boundaries(self):
@@ -256,9 +563,14 @@ class Model(list, Optimizers, Estimators):
         
         If the parameters array has not being defined yet it creates it filling 
         it with the current parameters."""
-        for component in self:
-            component.store_current_parameters_in_map(
-            tuple(self.axes_manager._indexes))
+        store = self._get_parameter_store()
+        if not store.size:
+            return
+        indexes = tuple(self.axes_manager._indexes)
+        store['values'][indexes] = self._get_store_values()
+        store['is_set'][indexes] = True
+        is_std = np.isnan(self._parameter_std) == False
+        store['std'][indexes][is_std] = self._parameter_std[is_std]
 
     def charge(self, only_fixed = False):
         """Charge the parameters for the current spectrum from the parameters 
@@ -272,10 +584,43 @@ class Model(list, Optimizers, Estimators):
         switch_aap = (False != self.auto_update_plot)
         if switch_aap is True:
             self.set_auto_update_plot(False)
+        store = self._get_parameter_store()
+        if store.size:
+            indexes = tuple(self.axes_manager._indexes)
+            is_set = store['is_set'][indexes]
+            if only_fixed is True:
+                is_set = is_set & self._get_fixed_mask()
+            # The bounded and connected parameters are set through their 
+            # value property, as in _charge_free, so that they are clipped
+            # and their connected functions are called
+            decoerced = [self._store_parameters[i] 
+                         for i in np.nonzero(is_set)[0] 
+                         if self._store_parameters[i].ext_bounded is True or
+                         self._store_parameters[i].connection_active is True]
+            elements = np.repeat(is_set, self._store_sizes)
+            self._parameter_std[elements] = store['std'][indexes][elements]
+            if decoerced:
+                is_set = is_set.copy()
+                for parameter in decoerced:
+                    is_set[self._store_index[parameter]] = False
+                elements = np.repeat(is_set, self._store_sizes)
+            self._parameter_values[elements] = store['values'][indexes][
+                elements]
+            for parameter in list(self._store_detached):
+                if is_set[self._store_index[parameter]]:
+                    parameter._in_store = True
+                    self._store_detached.discard(parameter)
+            for parameter in decoerced:
+                n = parameter._number_of_elements
+                value = store['values'][indexes][
+                    parameter._store_offset:parameter._store_offset + n]
+                parameter.value = value[0] if n == 1 else value.tolist()
         for component in self:
-            component.charge_value_from_map(
-            tuple(self.axes_manager._indexes), only_fixed = 
-            only_fixed)
+            if component.active_map is not None and component.active_map.size:
+                active = bool(component.active_map[
+                    tuple(self.axes_manager._indexes)])
+                if component.active is not active:
+                    component.active = active
         if switch_aap is True:
             self.set_auto_update_plot(True)
             self.update_plot()
@@ -297,16 +642,257 @@ class Model(list, Optimizers, Estimators):
         p_std : array
             array containing the corresponding standard deviation
         """
-        comp_p_std = None
-        counter = 0
-        for component in self: # Cut the parameters list
-            if component.active is True:
-                if p_std is not None:
-                    comp_p_std = p_std[counter: counter + component._nfree_param]
-                component.charge(
-                self.p0[counter: counter + component._nfree_param], 
-                comp_p_std, onlyfree = True)
-                counter += component._nfree_param
+        self._charge_free(self.p0, p_std)
+        
+    def _charge_free(self, p, p_std = None):
+        """Charge the free parameters of the active components from an 
+        array in the p0 order.
+        
+        The values are written in the parameter store in a single 
+        operation unless some parameter needs to be set through its value
+        property because it is bounded or connected to a function.
+        
+        Returns
+        -------
+        The list of active components with free parameters.
+        
+        """
+        index, parameters, components = self._get_free_index()
+        for parameter in parameters:
+            if parameter.ext_bounded is True or \
+            parameter.connection_active is True:
+                comp_p_std = None
+                counter = 0
+                for component in components:
+                    if p_std is not None:
+                        comp_p_std = p_std[counter: 
+                                           counter + component._nfree_param]
+                    component.charge(
+                    p[counter: counter + component._nfree_param], 
+                    comp_p_std, onlyfree = True)
+                    counter += component._nfree_param
+                return components
+        self._parameter_values[index] = p
+        if p_std is not None:
+            self._parameter_std[index] = p_std
+        if self._store_detached:
+            for parameter in parameters:
+                if parameter in self._store_detached:
+                    parameter._in_store = True
+                    self._store_detached.discard(parameter)
+        return components
+        
+    def _invalidate_parameter_store(self):
+        self._invalidate_twin_graph()
+        for parameter in self._store_parameters:
+            parameter._unbind_store()
+        self._parameter_store = None
+        self._store_parameters = []
+        self._free_index = None
+        self._fixed_mask = None
+        self._evaluation_plan = None
+        
+    def _get_parameter_store(self):
+        """Returns the parameter store, building it if necessary.
+        
+        The parameter store is a structured array with the navigation shape
+        and the fields 'values' and 'std', which contain the values of all 
+        the elements of all the parameters of the model, and 'is_set', 
+        which contains one element per parameter. The map of every 
+        parameter is a view of the store and the current values and stds 
+        are stored in the contiguous arrays _parameter_values and 
+        _parameter_std. Therefore, charging or storing a pixel and charging 
+        p0 are single array copies.
+        
+        """
+        if self._parameter_store is None:
+            self._build_parameter_store()
+        return self._parameter_store
+        
+    def _build_parameter_store(self):
+        self._invalidate_parameter_store()
+        parameters = [parameter for component in self 
+                      for parameter in component.parameters]
+        sizes = np.array([parameter._number_of_elements 
+                          for parameter in parameters], dtype = 'int')
+        offsets = np.cumsum(sizes) - sizes
+        nelements = sizes.sum()
+        shape = tuple(self.axes_manager.navigation_shape)
+        dtype = np.dtype([
+            ('values', 'float', (nelements,)),
+            ('std', 'float', (nelements,)),
+            ('is_set', 'bool', (len(parameters),))])
+        store = np.zeros(shape, dtype = dtype)
+        store['std'][:] = np.nan
+        self._parameter_values = np.zeros(nelements)
+        self._parameter_std = np.zeros(nelements)
+        self._parameter_std[:] = np.nan
+        self._store_detached = set()
+        self._store_sizes = sizes
+        self._store_index = {}
+        for i, parameter in enumerate(parameters):
+            n = parameter._number_of_elements
+            offset = offsets[i]
+            map_ = parameter.map
+            if map_ is not None and map_.shape == shape and \
+            map_['values'].shape == shape + ((n,) if n > 1 else ()):
+                store['values'][..., offset:offset + n] = \
+                    map_['values'].reshape(shape + (n,))
+                store['std'][..., offset:offset + n] = \
+                    map_['std'].reshape(shape + (n,))
+                store['is_set'][..., i] = map_['is_set']
+            fmt = 'float' if n == 1 else ('float', (n,))
+            parameter.map = store.view(np.dtype({
+                'names' : ['values', 'std', 'is_set'],
+                'formats' : [fmt, fmt, 'bool'],
+                'offsets' : [dtype.fields['values'][1] + 8 * offset,
+                             dtype.fields['std'][1] + 8 * offset,
+                             dtype.fields['is_set'][1] + i],
+                'itemsize' : dtype.itemsize}))
+            parameter._bind_store(self, offset)
+            self._store_index[parameter] = i
+        self._parameter_store = store
+        self._store_parameters = parameters
+        
+    def _get_store_values(self):
+        """Returns a copy of _parameter_values where the values of the 
+        twinned parameters are expanded from their twins and the values 
+        that are not stored there (because they do not fit) are taken from
+        the parameters."""
+        self._get_parameter_store()
+        graph = self._get_twin_graph()
+        values = self._parameter_values[graph['source']]
+        for parameter in graph['functions'] + [
+            parameter for parameter in graph['rooted'] 
+            if parameter._twin_root._in_store is False] + [
+            parameter for parameter in self._store_detached 
+            if parameter.twin is None]:
+            offset = parameter._store_offset
+            values[offset:offset + parameter._number_of_elements] = \
+                parameter.value
+        return values
+        
+    def _invalidate_twin_graph(self):
+        graph = self._twin_graph
+        if graph is not None:
+            for parameter in graph['rooted']:
+                parameter._twin_root = None
+        self._twin_graph = None
+        self._evaluation_plan = None
+        
+    def _get_twin_graph(self):
+        """Returns the graph of the twins of the parameters of the model, 
+        building it if necessary.
+        
+        The graph is a dictionary with the keys:
+        
+        'order' : the twinned parameters in topological order, i.e. every 
+            parameter after the parameters in its chain of twins.
+        'source' : an array that expands the parameter store values to 
+            the values of all the parameters, i.e. the indexes of the 
+            elements of the store from which every element takes its value:
+            itself or, for the twinned parameters whose chain of twins only
+            has identity twin functions, the element of the root of the 
+            chain.
+        'rooted' : the twinned parameters expanded by 'source'. Their 
+            `_twin_root` is set to the root of the chain so that reading 
+            their value does not recurse through the chain.
+        'functions' : the other twinned parameters, whose value must be 
+            computed by their twin function.
+        'dependents' : a dictionary that maps every parameter to the 
+            parameters whose value depends on it through the twins, 
+            directly or through a chain. The rows of the jacobian are 
+            reduced to the free parameters by adding the gradients of 
+            the dependents.
+            
+        The graph is rebuilt when any twin or twin function changes.
+        
+        """
+        if self._twin_graph is not None:
+            return self._twin_graph
+        self._get_parameter_store()
+        chains = {}
+        for parameter in self._store_parameters:
+            if parameter.twin is None:
+                continue
+            chain = [parameter]
+            while chain[-1].twin is not None and chain[-1].twin not in chain:
+                chain.append(chain[-1].twin)
+            chains[parameter] = chain
+        order = sorted(chains.iterkeys(), 
+                       key = lambda parameter: len(chains[parameter]))
+        source = np.arange(len(self._parameter_values))
+        rooted = []
+        functions = []
+        dependents = {}
+        for parameter in order:
+            chain = chains[parameter]
+            root = chain[-1]
+            for twin in chain[1:]:
+                dependents.setdefault(twin, []).append(parameter)
+            n = parameter._number_of_elements
+            if root.twin is None and root._store_model is self and \
+            root._number_of_elements == n and not [
+                twinned for twinned in chain[:-1] 
+                if twinned.twin_function is not _identity]:
+                source[parameter._store_offset:
+                       parameter._store_offset + n] = np.arange(
+                    root._store_offset, root._store_offset + n)
+                parameter._twin_root = root
+                rooted.append(parameter)
+            else:
+                functions.append(parameter)
+        self._twin_graph = {
+            'order' : order,
+            'source' : source,
+            'rooted' : rooted,
+            'functions' : functions,
+            'dependents' : dependents,}
+        return self._twin_graph
+        
+    def _get_free_index(self):
+        """Returns the indexes of the elements of the free parameters of the
+        active components in _parameter_values in the p0 order, the 
+        free parameters and the active components with free parameters."""
+        self._get_parameter_store()
+        key = [(component.active, component.free_parameters) 
+               for component in self]
+        cached = self._free_index
+        if cached is None or len(cached[0]) != len(key) or \
+        any([a[0] != b[0] or a[1] is not b[1] 
+             for a, b in zip(cached[0], key)]):
+            index = []
+            parameters = []
+            components = []
+            for component in self:
+                if component.active:
+                    for parameter in component.free_parameters:
+                        offset = parameter._store_offset
+                        index.extend(range(offset, offset + 
+                                           parameter._number_of_elements))
+                        parameters.append(parameter)
+                    if component._nfree_param:
+                        components.append(component)
+            cached = (key, np.array(index, dtype = 'int'), parameters, 
+                      components)
+            self._free_index = cached
+        return cached[1:]
+
+    def _get_fixed_mask(self):
+        """Returns a boolean array that is True for the fixed parameters 
+        in the parameter store order."""
+        self._get_parameter_store()
+        key = [component.free_parameters for component in self]
+        cached = self._fixed_mask
+        if cached is None or len(cached[0]) != len(key) or \
+        [a for a, b in zip(cached[0], key) if a is not b]:
+            mask = np.array([parameter not in 
+                             parameter.component.free_parameters 
+                             for parameter in self._store_parameters], 
+                            dtype = 'bool')
+            cached = (key, mask)
+            self._fixed_mask = cached
+        return cached[1]
 
     # Defines the functions for the fitting process -------------------------
     def _model2plot(self, axes_manager, out_of_range2nans = True):
@@ -344,47 +930,26 @@ class Model(list, Optimizers, Estimators):
         """
             
         if self.convolved is False or non_convolved is True:
-            axis = self.axis.axis[self.channel_switches]
+            axis = self._get_fitting_axis()
             sum_ = np.zeros(len(axis))
-            if onlyactive is True:
-                for component in self: # Cut the parameters list
-                    if component.active:
-                        np.add(sum_, component.function(axis),
-                        sum_)
-                return sum_
-            else:
-                for component in self: # Cut the parameters list
-                    np.add(sum_, component.function(axis),
-                     sum_)
-                return sum_
+            for component in self: # Cut the parameters list
+                if onlyactive is False or component.active:
+                    np.add(sum_, component._function_cached(axis), sum_)
+            return sum_
 
         else: # convolved
-            counter = 0
             sum_convolved = np.zeros(len(self.convolution_axis))
             sum_ = np.zeros(len(self.axis.axis))
             for component in self: # Cut the parameters list
-                if onlyactive :
-                    if component.active:
-                        if component.convolved:
-                            np.add(sum_convolved,
-                            component.function(
-                            self.convolution_axis), sum_convolved)
-                        else:
-                            np.add(sum_,
-                            component.function(self.axis.axis), sum_)
-                        counter+=component._nfree_param
-                else :
+                if onlyactive is False or component.active:
                     if component.convolved:
                         np.add(sum_convolved,
-                        component.function(self.convolution_axis),
+                        component._function_cached(self.convolution_axis),
                         sum_convolved)
                     else:
-                        np.add(sum_, component.function(self.axis.axis),
-                        sum_)
-                    counter+=component._nfree_param
-            to_return = sum_ + np.convolve(
-                self.low_loss(self.axes_manager), 
-                sum_convolved, mode="valid")
+                        np.add(sum_, 
+                        component._function_cached(self.axis.axis), sum_)
+            to_return = sum_ + self._convolve(sum_convolved)
             to_return = to_return[self.channel_switches]
             return to_return
 
@@ -488,101 +1053,1136 @@ class Model(list, Optimizers, Estimators):
         if self.auto_update_plot is True:
             self.update_plot()
 
-    def _model_function(self,param):
+    def _get_low_loss_fft(self, size):
+        """Returns the real FFT of the low-loss spectrum at the current 
+        coordinates zero-padded to the given size.
+        
+        The FFT is only recomputed when the low-loss spectrum or the size
+        change.
+        """
+        low_loss = self.low_loss(self.axes_manager)
+        cached = self._low_loss_fft
+        if cached is None or cached[0] != size or \
+        not np.array_equal(cached[1], low_loss):
+            self._low_loss_fft = (size, np.array(low_loss, copy = True),
+                                  np.fft.rfft(low_loss, size))
+        return self._low_loss_fft[2]
+        
+    def _convolve(self, array, low_loss = None):
+        """Convolve with the low-loss spectrum at the current coordinates.
+        
+        It is equivalent to np.convolve(low_loss, array, mode="valid") but 
+        it is computed in the frequency domain and it operates on the last 
+        axis, so several arrays, e.g. the gradients of all the free 
+        parameters, can be convolved at once.
+        
+        Parameters
+        ----------
+        array : array
+            The last axis must have the size of the convolution axis.
+        low_loss : {None, array}
+            If not None, the low-loss spectra to convolve with, which must
+            broadcast with `array` except in the last axis, instead of the
+            low-loss spectrum at the current coordinates.
+            
+        """
+        n = array.shape[-1]
+        m = self.low_loss.axes_manager._slicing_axes[0].size
+        # The circular convolution of this size does not wrap around in
+        # the "valid" channels
+        size = 2 ** int(np.ceil(np.log2(n)))
+        if low_loss is None:
+            low_loss_fft = self._get_low_loss_fft(size)
+        else:
+            low_loss_fft = np.fft.rfft(low_loss, size, axis = -1)
+        convolved = np.fft.irfft(np.fft.rfft(array, size, axis = -1) * 
+                                 low_loss_fft, size, axis = -1)
+        return convolved[..., m - 1:n]
+        
+    def _get_fitting_axis(self):
+        """Returns the axis in the channels used for fitting.
+        
+        The same array is returned while neither the axis nor the 
+        channel_switches change so that it can be used to validate the
+        components evaluation cache. While fitting the data binned along 
+        the signal axis, the centres of the binned channels are returned.
+        """
+        if self._signal_binning is not None:
+            return self._signal_binning['axis']
+        if self._fitting_axis is None or \
+        self._fitting_axis[0] is not self.axis.axis or \
+        not np.array_equal(self._fitting_axis[1], self.channel_switches):
+            self._fitting_axis = (self.axis.axis, 
+                                  self.channel_switches.copy(),
+                                  self.axis.axis[self.channel_switches])
+        return self._fitting_axis[2]
+        
+    def _get_fit_data(self, weights = None):
+        """Returns the data and the weights at the current coordinates in
+        the channels used for fitting.
+        
+        While fitting the data binned along the signal axis, the mean of
+        the data in every bin and the corresponding weights are returned.
+        
+        Parameters
+        ----------
+        weights : {None, True, numpy.array}
+            If True, the weights are the inverse of the standard deviation 
+            of the data, which is estimated if the variance is not defined.
+            An array must have the shape of the spectrum data.
+            
+        Returns
+        -------
+        y, weights
+        
+        """
+        if weights is True:
+            if self.spectrum.variance is None:
+                self.spectrum.estimate_variance()
+            weights = 1. / np.sqrt(self.spectrum.variance.__getitem__(
+                self.axes_manager._getitem_tuple))
+        elif weights is not None:
+            weights = weights.__getitem__(self.axes_manager._getitem_tuple)
+        y = self.spectrum()
+        binning = self._signal_binning
+        if binning is None:
+            switches = self.channel_switches
+        else:
+            factor = binning['factor']
+            size = binning['size']
+            shape = (size // factor,)
+            y = rebin(y[:size], shape) / factor
+            if weights is not None:
+                # The variance of the mean of the bin
+                weights = factor / np.sqrt(rebin(weights[:size] ** -2., 
+                                                 shape))
+            switches = binning['switches']
+        if weights is not None:
+            weights = weights[switches]
+        return y[switches], weights
+        
+    def _fit_signal_binned(self, factor, **kwargs):
+        """Fits the model at the current coordinates to the data binned
+        by `factor` channels along the signal axis.
+        
+        The model is evaluated in the centres of the bins and fitted to the 
+        mean of the data in every bin, therefore the values of the 
+        parameters do not depend on the binning. The channels at the end 
+        of the axis that do not fill a bin are not used and a bin is only
+        used if all its channels are.
+        
+        Parameters
+        ----------
+        factor : int
+            The number of channels in every bin.
+        **kwargs : 
+            Passed to `fit`.
+            
+        Returns
+        -------
+        The number of function evaluations of the fit or 0 if there are 
+        fewer bins than free parameters, in which case the model is not 
+        fitted.
+        
+        """
+        size = len(self.axis.axis) // factor * factor
+        shape = (size // factor,)
+        switches = rebin(self.channel_switches[:size].astype('int'), 
+                         shape) == factor
+        if switches.sum() <= len(self._get_free_parameters()):
+            return 0
+        axis = rebin(self.axis.axis[:size], shape) / factor
+        self._signal_binning = {
+            'factor' : factor,
+            'size' : size,
+            'switches' : switches,
+            'axis' : axis[switches],}
+        kwargs['update_plot'] = False
+        try:
+            self.fit(**kwargs)
+        finally:
+            self._signal_binning = None
+        return self._nfev
+        
+    def _get_fixed_baseline(self, x, convolved = None):
+        """Returns the sum of the active components that have no free 
+        parameters evaluated in x.
+        
+        The components are evaluated using their evaluation cache and the 
+        sum is stored until the value of any of their parameters changes, 
+        therefore the returned array must not be modified.
+        
+        Parameters
+        ----------
+        x : array
+        convolved : {None, bool}
+            If not None, only the components whose `convolved` attribute 
+            matches are added.
+            
+        """
+        components = [component for component in self 
+                      if component.active and component._nfree_param == 0 
+                      and (convolved is None or 
+                           component.convolved is convolved)]
+        key = tuple([component._get_cache_key(x) 
+                     for component in components])
+        cached = self._fixed_baseline.get(convolved)
+        if cached is not None and cached[0] is x and \
+        cached[1] == components and cached[2] == key:
+            return cached[3]
+        baseline = np.zeros(len(x))
+        for component in components:
+            np.add(baseline, component._function_cached(x), baseline)
+        self._fixed_baseline[convolved] = (x, components, key, baseline)
+        return baseline
 
+    def _model_function(self,param):
+        if self._variable_projection is not None:
+            return self._model_function_variable_projection(param)
+        plan = self._get_evaluation_plan()
+        if plan is not None:
+            return self._model_function_compiled(plan, param)
+        # Charge all the free parameters before evaluating any component 
+        # because the value of the fixed ones may depend on them through 
+        # twins
+        free_components = self._charge_free(param)
+                
         if self.convolved is True:
-            counter = 0
-            sum_convolved = np.zeros(len(self.convolution_axis))
-            sum = np.zeros(len(self.axis.axis))
-            for component in self: # Cut the parameters list
-                if component.active is True:
-                    if component.convolved is True:
-                        np.add(sum_convolved, component(param[\
-                        counter:counter+component._nfree_param],
-                        self.convolution_axis), sum_convolved)
-                    else:
-                        np.add(sum, component(param[counter:counter + \
-                        component._nfree_param], self.axis.axis), sum)
-                    counter+=component._nfree_param
+            sum_convolved = self._get_fixed_baseline(self.convolution_axis,
+                                                     convolved = True).copy()
+            sum = self._get_fixed_baseline(self.axis.axis, 
+                                           convolved = False).copy()
+            for component in free_components:
+                if component.convolved is True:
+                    self._add_in_support(sum_convolved, component, 
+                                         component.function, 
+                                         self.convolution_axis)
+                else:
+                    self._add_in_support(sum, component, component.function,
+                                         self.axis.axis)
 
-            return (sum + np.convolve(self.low_loss(self.axes_manager), 
-                                      sum_convolved,mode="valid"))[
+            return (sum + self._convolve(sum_convolved))[
                                       self.channel_switches]
 
         else:
-            axis = self.axis.axis[self.channel_switches]
-            counter = 0
-            first = True
-            for component in self: # Cut the parameters list
-                if component.active is True:
-                    if first is True:
-                        sum = component(param[counter:counter + \
-                        component._nfree_param],axis)
-                        first = False
-                    else:
-                        sum += component(param[counter:counter + \
-                        component._nfree_param], axis)
-                    counter += component._nfree_param
+            axis = self._get_fitting_axis()
+            sum = self._get_fixed_baseline(axis).copy()
+            for component in free_components:
+                self._add_in_support(sum, component, component.function, 
+                                     axis)
             return sum
+            
+    def compile(self):
+        """Freeze the structure of the model in an evaluation plan so that
+        the evaluation of the model and its jacobian while fitting skips 
+        the per call bookkeeping.
+        
+        The plan contains the indexes of the free parameters in the 
+        parameter store, the active components split in those that must
+        be evaluated at every call and those that only depend on fixed 
+        parameters, which are summed in a baseline that is only 
+        recomputed when the value of a fixed parameter changes, the 
+        fitting axis and preallocated buffers. 
+        
+        The plan is discarded when components are added or removed, when
+        the `twin` attribute of a parameter changes, when the bounding or 
+        the plot connections are enabled or disabled and when the low-loss
+        spectrum is set. It is rebuilt when the channel switches change.
+        When the `active` attribute of a component or the `free` attribute
+        of a parameter change, a plan is compiled for the new 
+        configuration and the plans of the previous configurations are 
+        kept, so that switching back and forth between configurations, 
+        e.g. when solving the linear parameters by variable projection or 
+        when the components have active maps, does not compile the model 
+        again. After changing any other attribute of a component that 
+        affects its function, call `compile` again.
+        
+        `fit` and `multifit` compile the model for their duration if it 
+        has not been compiled.
+        
+        """
+        self._compile({})
+        
+    def _get_configuration_key(self):
+        """Returns the active state of the components and the free state 
+        of their parameters, which define the evaluation plan."""
+        return tuple([(component.active, tuple([
+            parameter.free for parameter in component.parameters]))
+            for component in self])
+        
+    def _compile(self, plans):
+        """Compile the model for the current configuration and add the plan
+        to the `plans` dictionary, which is shared by the plans of all the
+        configurations."""
+        index, parameters, components = self._get_free_index()
+        axis = self._get_fitting_axis()
+        is_free = np.zeros(len(self._parameter_values), dtype = 'bool')
+        is_free[index] = True
+        evaluate = []
+        fixed = []
+        for component in self:
+            if component.active is False:
+                continue
+            if component._nfree_param or [
+                parameter for parameter in component.parameters 
+                if _twinned_to_free(parameter)]:
+                evaluate.append(component)
+            else:
+                fixed.append(component)
+        if self.convolved is True:
+            fixed_axes = ((True, self.convolution_axis), 
+                          (False, self.axis.axis))
+        else:
+            fixed_axes = ((None, axis),)
+        grad_terms, convolved_rows = self._get_gradient_terms(components)
+        plan = {
+            'axis' : axis,
+            'index' : index,
+            'components' : components,
+            'direct' : not [parameter for parameter in parameters
+                            if parameter.ext_bounded is True or 
+                            parameter.connection_active is True],
+            'evaluate' : [(component, component.convolved is True) 
+                          for component in evaluate],
+            'fixed' : [(key, x, [component for component in fixed 
+                                 if key is None or 
+                                 (component.convolved is True) is key])
+                       for key, x in fixed_axes],
+            'fixed_index' : np.where(is_free == False)[0],
+            'baseline' : None,
+            'grad_terms' : grad_terms,
+            'convolved_rows' : convolved_rows,}
+        if self.convolved is True:
+            plan['sum_convolved'] = np.empty(len(self.convolution_axis))
+            plan['sum'] = np.empty(len(self.axis.axis))
+            plan['convolved_grad'] = np.empty((len(index), 
+                                               len(self.convolution_axis)))
+            plan['unconvolved_grad'] = np.empty((len(index), 
+                                                 len(self.axis.axis)))
+        plan['version'] = self._configuration_version
+        plan['plans'] = plans
+        plans[self._get_configuration_key()] = plan
+        self._evaluation_plan = plan
+        
+    def _get_evaluation_plan(self):
+        """Returns the evaluation plan if the model is compiled and it can 
+        be used, otherwise None."""
+        plan = self._evaluation_plan
+        if plan is None or self._store_detached:
+            # The values of the detached parameters are not in the store
+            return None
+        if plan['version'] != self._configuration_version:
+            # The free parameters or the active components changed
+            plans = plan['plans']
+            plan = plans.get(self._get_configuration_key())
+            if plan is None:
+                self._compile(plans)
+            else:
+                plan['version'] = self._configuration_version
+                self._evaluation_plan = plan
+            plan = self._evaluation_plan
+        if self._get_fitting_axis() is not plan['axis']:
+            self._compile(plan['plans'])
+            plan = self._evaluation_plan
+        return plan
+        
+    def _charge_free_compiled(self, plan, param):
+        if plan['direct'] is True:
+            self._parameter_values[plan['index']] = param
+        else:
+            self._charge_free(param)
+        
+    def _get_compiled_baseline(self, plan):
+        """Returns a dictionary with the sum of the components of the plan
+        that only depend on fixed parameters for every value of their 
+        `convolved` attribute (None if the model is not convolved). It is
+        only recomputed when the values of the fixed parameters change."""
+        key = self._parameter_values[plan['fixed_index']]
+        cached = plan['baseline']
+        if cached is None or not np.array_equal(cached[0], key):
+            baseline = {}
+            for convolved, x, components in plan['fixed']:
+                baseline[convolved] = np.zeros(len(x))
+                for component in components:
+                    np.add(baseline[convolved], component.function(x), 
+                           baseline[convolved])
+            cached = (key, baseline)
+            plan['baseline'] = cached
+        return cached[1]
+        
+    def _model_function_compiled(self, plan, param):
+        """`_model_function` using the evaluation plan, see `compile`."""
+        self._charge_free_compiled(plan, param)
+        baseline = self._get_compiled_baseline(plan)
+        if self.convolved is True:
+            sum_convolved = plan['sum_convolved']
+            sum_convolved[:] = baseline[True]
+            sum_ = plan['sum']
+            sum_[:] = baseline[False]
+            for component, convolved in plan['evaluate']:
+                if convolved is True:
+                    self._add_in_support(sum_convolved, component, 
+                                         component.function, 
+                                         self.convolution_axis)
+                else:
+                    self._add_in_support(sum_, component, component.function,
+                                         self.axis.axis)
+            return (sum_ + self._convolve(sum_convolved))[
+                self.channel_switches]
+        else:
+            axis = plan['axis']
+            sum_ = baseline[None].copy()
+            for component, convolved in plan['evaluate']:
+                self._add_in_support(sum_, component, component.function, 
+                                     axis)
+            return sum_
+        
+    def _get_gradient_terms(self, components):
+        """Returns the list of the gradients that make every row of the 
+        jacobian, as (rows, convolved, parameters) tuples, where parameters
+        are the free parameter and the parameters that depend on it through
+        twins (see `_get_twin_graph`), and the boolean array of the rows of
+        the convolved components."""
+        dependents = self._get_twin_graph()['dependents']
+        terms = []
+        counter = 0
+        for component in components:
+            convolved = self.convolved is True and component.convolved is True
+            for parameter in component.free_parameters:
+                n = parameter._number_of_elements
+                terms.append((slice(counter, counter + n), convolved, 
+                              [parameter,] + dependents.get(parameter, [])))
+                counter += n
+        convolved_rows = np.zeros(counter, dtype = 'bool')
+        for rows, convolved, parameters in terms:
+            convolved_rows[rows] = convolved
+        return terms, convolved_rows
+        
+    def _get_support_slice(self, component, x):
+        """Returns the slice of x inside the support of the component, see
+        :py:meth:`~.component.Component.get_support`, or None if the 
+        component must be evaluated in all x."""
+        support = component.get_support()
+        if support is None or len(x) < 2 or x[0] > x[-1]:
+            return None
+        return slice(np.searchsorted(x, support[0], 'left'), 
+                     np.searchsorted(x, support[1], 'right'))
+        
+    def _add_in_support(self, out, component, function, x):
+        """Add function(x) to out in place, evaluating the function only 
+        inside the support of the component.
+        
+        Parameters
+        ----------
+        out : array
+            The last axis must have the size of x.
+        component : Component
+        function : function
+            The function or a gradient of the component.
+        x : array
+        
+        """
+        window = self._get_support_slice(component, x)
+        if window is None:
+            np.add(out, function(x), out)
+        elif window.stop > window.start:
+            out[..., window] += function(x[window])
+        return out
+
+    def _get_linear_parameters(self, bounded = False):
+        """Returns the free parameters of the active components in which
+        the model is linear.
+        
+        The parameters that are twinned or have twins are excluded. 
+        
+        Parameters
+        ----------
+        bounded : bool
+            If True, the parameters with a bmin or bmax are also excluded 
+            because their value is not constrained when they are solved by
+            linear least squares.
+            
+        """
+        linear_parameters = []
+        for component in self:
+            if component.active is False:
+                continue
+            for parameter in component._get_linear_parameters():
+                if parameter.free is True and not parameter._twins and (
+                bounded is False or 
+                (parameter.bmin is None and parameter.bmax is None)):
+                    linear_parameters.append(parameter)
+        return linear_parameters
+        
+    def _start_variable_projection(self, parameters, y, weights = None):
+        """Fix the given linear parameters so that the optimizers only 
+        iterate over the nonlinear ones. Until `_stop_variable_projection` 
+        is called, `_model_function` sets the linear parameters to their
+        linear least squares solution for the given nonlinear parameters.
+        
+        """
+        for parameter in parameters:
+            parameter.free = False
+        self._variable_projection = {
+            'parameters' : parameters, 
+            'y' : y,
+            'weights' : weights,
+            'param' : None,
+            'basis' : None,}
+        
+    def _stop_variable_projection(self, grad = False):
+        """Sets the linear parameters to their solution for the current
+        nonlinear parameters, computes their standard deviation and frees
+        them.
+        
+        Parameters
+        ----------
+        grad : bool
+            If True and all the nonlinear parameters have analytical 
+            gradients, they are used to compute the standard deviation as
+            when the parameters are fitted without variable projection. 
+            Otherwise their jacobian is computed by forward differences.
+            
+        """
+        vp = self._variable_projection
+        p = np.array(self.p0, dtype = 'float')
+        self._model_function_variable_projection(p)
+        self._variable_projection = None
+        # The standard deviation is estimated from the jacobian of all the
+        # parameters
+        if grad is True and len(p) and self._has_analytical_jacobian():
+            nonlinear = self._jacobian(p, None).copy()
+        else:
+            nonlinear = self._approx_jacobian(p)
+        jacobian = np.vstack((nonlinear, vp['basis']))
+        if vp['weights'] is not None:
+            jacobian *= vp['weights']
+        try:
+            std = np.sqrt(np.diag(np.linalg.inv(
+                np.dot(jacobian, jacobian.T))))[len(p):]
+        except np.linalg.LinAlgError:
+            std = np.nan * np.ones(len(vp['basis']))
+        i = 0
+        for parameter in vp['parameters']:
+            n = parameter._number_of_elements
+            parameter.std = std[i] if n == 1 else std[i:i + n].tolist()
+            parameter.free = True
+            i += n
+            
+    def _get_linear_basis(self, parameters):
+        """Returns an array of shape (number of linear coefficients, 
+        number of channels) with the derivative of the model with respect to
+        each linear parameter, i.e. the model function of each parameter when
+        its value is one and the value of the other linear parameters is 
+        zero.
+        """
+        basis = []
+        for parameter in parameters:
+            component = parameter.component
+            if self.convolved is True and component.convolved is True:
+                x = self.convolution_axis
+            elif self.convolved is True:
+                x = self.axis.axis
+            else:
+                x = self._get_fitting_axis()
+            n = parameter._number_of_elements
+            value = parameter.value
+            if parameter.grad is not None:
+                # Some gradients are computed dividing the function by the
+                # parameter value
+                parameter.value = 1. if n == 1 else [1.] * n
+                grad = np.atleast_2d(parameter.grad(x))
+            else:
+                # The function is linear in the parameter, therefore the 
+                # gradient is the difference between unit and zero values
+                parameter.value = 0. if n == 1 else [0.] * n
+                f0 = component.function(x)
+                grad = np.empty((n, len(x)))
+                for i in xrange(n):
+                    if n == 1:
+                        parameter.value = 1.
+                    else:
+                        unit = [0.] * n
+                        unit[i] = 1.
+                        parameter.value = unit
+                    grad[i] = component.function(x) - f0
+            parameter.value = value
+            if self.convolved is True and component.convolved is True:
+                grad = self._convolve(grad)
+            if self.convolved is True:
+                grad = grad[:, self.channel_switches]
+            basis.append(grad)
+        return np.vstack(basis)
+        
+    def _model_function_variable_projection(self, param):
+        """Returns the model for the given nonlinear parameters with the 
+        linear parameters set to their linear least squares solution."""
+        vp = self._variable_projection
+        self._variable_projection = None
+        try:
+            for parameter in vp['parameters']:
+                n = parameter._number_of_elements
+                parameter.value = 0. if n == 1 else [0.] * n
+            nonlinear = self._model_function(param)
+            basis = self._get_linear_basis(vp['parameters'])
+            if vp['weights'] is None:
+                coefficients = np.linalg.lstsq(basis.T, vp['y'] - nonlinear,
+                                               rcond = -1)[0]
+            else:
+                coefficients = np.linalg.lstsq(
+                    basis.T * vp['weights'][:, np.newaxis], 
+                    (vp['y'] - nonlinear) * vp['weights'], rcond = -1)[0]
+            i = 0
+            for parameter in vp['parameters']:
+                n = parameter._number_of_elements
+                parameter.value = (coefficients[i] if n == 1 else 
+                                   coefficients[i:i + n].tolist())
+                i += n
+            vp['param'] = np.array(param, copy = True)
+            vp['basis'] = basis
+        finally:
+            self._variable_projection = vp
+        return nonlinear + np.dot(coefficients, basis)
+        
+    def _approx_jacobian(self, param, full_output = False):
+        """Returns the jacobian of the model computed by forward 
+        differences, an array of shape (number of free parameters, number 
+        of channels).
+        
+        All the displaced parameters are evaluated in a single call to
+        `_model_function_vectorized`. If `full_output` is True, the model
+        evaluated at `param` is also returned.
+        
+        """
+        param = np.array(param, dtype = 'float')
+        n = len(param)
+        h = np.sqrt(np.finfo(float).eps) * np.maximum(np.abs(param), 1.)
+        params = np.repeat(param[np.newaxis], n + 1, 0)
+        params[np.arange(1, n + 1), np.arange(n)] += h
+        f = self._model_function_vectorized(params)
+        jacobian = (f[1:] - f[0]) / h[:, np.newaxis]
+        if self._variable_projection is not None:
+            # Restore the linear parameters of `param`
+            self._model_function(param)
+        else:
+            self._charge_free(param)
+        if full_output is True:
+            return jacobian, f[0]
+        return jacobian
+        
+    def _get_jacobian_buffer(self, nrows, ncolumns):
+        """Returns the array in which the jacobian is assembled.
+        
+        The buffer is only reallocated when the number of free parameters or
+        of channels changes.
+        """
+        if self._jacobian_buffer is None or \
+        self._jacobian_buffer.shape != (nrows, ncolumns):
+            self._jacobian_buffer = np.empty((nrows, ncolumns))
+        return self._jacobian_buffer
 
     def _jacobian(self,param, y, weights = None):
+        """Returns the jacobian of the model, an array of shape (number of 
+        free parameters, number of channels).
+        
+        Note that the returned array is reused in the next call.
+        
+        When the linear parameters are solved by variable projection, the
+        jacobian of the nonlinear parameters is projected onto the 
+        orthogonal complement of the linear basis (Kaufman approximation).
+        """
+        vp = self._variable_projection
+        if vp is not None:
+            if vp['param'] is None or not np.array_equal(vp['param'], param):
+                self._model_function(param)
+            self._variable_projection = None
+            try:
+                grad = self._jacobian(param, y, weights)
+            finally:
+                self._variable_projection = vp
+            basis = vp['basis']
+            if weights is not None:
+                basis = basis * weights
+            q = np.linalg.qr(basis.T)[0]
+            grad -= np.dot(np.dot(grad, q), q.T)
+            return grad
+        plan = self._get_evaluation_plan()
+        if plan is None:
+            grad_terms, convolved_rows = self._get_gradient_terms(
+                self._charge_free(param))
+        else:
+            self._charge_free_compiled(plan, param)
+            grad_terms = plan['grad_terms']
+            convolved_rows = plan['convolved_rows']
         if self.convolved is True:
-            counter = 0
-            grad = np.zeros(len(self.axis.axis))
-            for component in self: # Cut the parameters list
-                if component.active:
-                    component.charge(param[counter:counter + \
-                    component._nfree_param] , onlyfree = True)
-                    if component.convolved:
-                        for parameter in component.free_parameters :
-                            par_grad = np.convolve(
-                            parameter.grad(self.convolution_axis), 
-                            self.low_loss(self.axes_manager), 
-                            mode="valid")
-                            if parameter._twins:
-                                for parameter in parameter._twins:
-                                    np.add(par_grad, np.convolve(
-                                    parameter.grad(
-                                    self.convolution_axis), 
-                                    self.low_loss(self.axes_manager), 
-                                    mode="valid"), par_grad)
-                            grad = np.vstack((grad, par_grad))
-                        counter += component._nfree_param
-                    else:
-                        for parameter in component.free_parameters :
-                            par_grad = parameter.grad(self.axis.axis)
-                            if parameter._twins:
-                                for parameter in parameter._twins:
-                                    np.add(par_grad, parameter.grad(
-                                    self.axis.axis), par_grad)
-                            grad = np.vstack((grad, par_grad))
-                        counter += component._nfree_param
-            if weights is None:
-                return grad[1:, self.channel_switches]
+            grad = self._get_jacobian_buffer(len(param), 
+                                             self.channel_switches.sum())
+            # The gradients are assembled in the full axes and the 
+            # gradients of the convolved components are convolved at once
+            if plan is None:
+                convolved_grad = np.zeros((len(param), 
+                                           len(self.convolution_axis)))
+                unconvolved_grad = np.zeros((len(param), 
+                                             len(self.axis.axis)))
             else:
-                return grad[1:, self.channel_switches] * weights
+                convolved_grad = plan['convolved_grad']
+                unconvolved_grad = plan['unconvolved_grad']
+                convolved_grad[:] = 0
+                unconvolved_grad[:] = 0
+            for rows, convolved, parameters in grad_terms:
+                if convolved is True:
+                    x = self.convolution_axis
+                    component_grad = convolved_grad
+                else:
+                    x = self.axis.axis
+                    component_grad = unconvolved_grad
+                for parameter in parameters:
+                    self._add_in_support(component_grad[rows], 
+                                         parameter.component, 
+                                         parameter.grad, x)
+            grad[:] = unconvolved_grad[:, self.channel_switches]
+            if convolved_rows.any():
+                grad[convolved_rows] = self._convolve(
+                    convolved_grad[convolved_rows])[:, self.channel_switches]
         else:
-            axis = self.axis.axis[self.channel_switches]
-            counter = 0
-            grad = axis
-            for component in self: # Cut the parameters list
-                if component.active:
-                    component.charge(param[counter:counter + \
-                    component._nfree_param] , onlyfree = True)
-                    for parameter in component.free_parameters :
-                        par_grad = parameter.grad(axis)
-                        if parameter._twins:
-                            for parameter in parameter._twins:
-                                np.add(par_grad, parameter.grad(
-                                axis), par_grad)
-                        grad = np.vstack((grad, par_grad))
-                    counter += component._nfree_param
+            axis = self._get_fitting_axis()
+            grad = self._get_jacobian_buffer(len(param), len(axis))
+            # The rows are zero outside of the support of the components
+            grad[:] = 0
+            for rows, convolved, parameters in grad_terms:
+                for parameter in parameters:
+                    self._add_in_support(grad[rows], parameter.component, 
+                                         parameter.grad, axis)
+        if weights is not None:
+            np.multiply(grad, weights, grad)
+        return grad
+        
+    def _get_free_parameters(self):
+        """Returns the free parameters of the active components in the same
+        order as in p0"""
+        return [parameter for component in self if component.active 
+                for parameter in component.free_parameters]
+                
+    def _has_analytical_jacobian(self):
+        """Returns True if all the free parameters and their twins have 
+        analytical gradients, i.e. if `_jacobian` can be used."""
+        dependents = self._get_twin_graph()['dependents']
+        return not [parameter for parameter in self._get_free_parameters() 
+                    if parameter.grad is None or 
+                    [twin for twin in dependents.get(parameter, []) 
+                     if twin.grad is None]]
+        
+    def _get_batch_values(self, indexes = None, only_fixed = False):
+        """Returns the values of the parameters of the active components at 
+        several pixels.
+        
+        Parameters
+        ----------
+        indexes : {None, list of tuples}
+            The navigation indexes of the pixels. The values are read from 
+            the parameters maps when they are set there, otherwise the 
+            current value is used. If None, only the current values are 
+            returned.
+        only_fixed : bool
+            If True, only the fixed parameters are read from the maps.
+            
+        Returns
+        -------
+        Dictionary with the parameters as keys and arrays of shape 
+        (number of pixels, number of elements of the parameter) as values.
+        The twinned parameters are not included because their value is 
+        defined by their twin.
+        
+        """
+        if indexes is not None:
+            index_arrays = tuple(np.array(indexes).T)
+        values = {}
+        for component in self:
+            if component.active is False:
+                continue
+            for parameter in component.parameters:
+                if parameter.twin is not None:
+                    continue
+                current = np.array(parameter.value, dtype = 'float').reshape(
+                    1, -1)
+                if indexes is None or (only_fixed is True and 
+                                       parameter.free is True):
+                    npixels = 1 if indexes is None else len(indexes)
+                    values[parameter] = np.repeat(current, npixels, 0)
+                else:
+                    map_ = parameter.map[index_arrays]
+                    value = map_['values'].reshape(len(indexes), -1).copy()
+                    value[map_['is_set'] == False] = current
+                    values[parameter] = value
+        return values
+        
+    def _charge_batch_values(self, values, row = None):
+        """Set the values of the parameters for batch evaluation.
+        
+        The parameters whose value is the same for all the pixels get a 
+        scalar value. Otherwise they are set to a column array so that the
+        components functions broadcast to (number of pixels, channels).
+        
+        Parameters
+        ----------
+        values : dictionary
+            As returned by `_get_batch_values`.
+        row : {None, int}
+            If not None, only the values of the given pixel are charged.
+            
+        """
+        for parameter, value in values.iteritems():
+            if row is not None:
+                value = value[row:row + 1]
+            if row is not None or (value == value[0]).all():
+                if parameter._number_of_elements == 1:
+                    parameter.value = value[0, 0]
+                else:
+                    parameter.value = value[0].tolist()
+            else:
+                parameter.value = value
+            
+    def _evaluate_batch(self, function, x, values, nrows):
+        """Evaluate a component function or gradient for several pixels.
+        
+        It first tries to broadcast the function over the pixels and, if 
+        the function does not support it, i.e. if it raises a ValueError 
+        or a TypeError or the result does not have one row per pixel, 
+        evaluates it pixel by pixel.
+        
+        """
+        try:
+            result = np.asarray(function(x), dtype = 'float')
+        except (ValueError, TypeError):
+            result = None
+        if result is not None and result.shape == (nrows, len(x)):
+            return result
+        result = np.empty((nrows, len(x)))
+        for row in xrange(nrows):
+            self._charge_batch_values(values, row = row)
+            result[row] = function(x)
+        self._charge_batch_values(values)
+        return result
+        
+    def _get_batch_values_at(self, param, rows):
+        values = {}
+        for parameter, value in self._batch_values.iteritems():
+            values[parameter] = value[rows]
+        i = 0
+        for parameter in self._batch_free_parameters:
+            n = parameter._number_of_elements
+            values[parameter] = param[:, i:i + n]
+            i += n
+        return values
+    
+    def _model_function_vectorized(self, param):
+        """Evaluate the model at the current coordinates for several sets 
+        of values of the free parameters at once.
+        
+        Every component is evaluated once with its free parameters set to
+        column arrays. The components whose function does not broadcast
+        are evaluated set by set. When the free parameters cannot hold 
+        arrays, i.e. when they are bounded, connected to a function or 
+        the linear parameters are solved by variable projection, the model
+        is evaluated set by set with `_model_function`.
+        
+        Parameters
+        ----------
+        param : array
+            Array of shape (number of sets, number of free parameters).
+            
+        Returns
+        -------
+        Array of shape (number of sets, number of channels)
+        
+        """
+        param = np.array(param, dtype = 'float', ndmin = 2)
+        free_parameters = self._get_free_parameters()
+        if self._variable_projection is not None or \
+        [parameter for parameter in free_parameters 
+         if parameter.ext_bounded is True or 
+         parameter.connection_active is True]:
+            return np.array([self._model_function(p) for p in param])
+        self._batch_values = self._get_batch_values()
+        self._batch_free_parameters = free_parameters
+        backup = [(parameter, parameter.value) for parameter in 
+                  self._batch_values.iterkeys()]
+        rows = np.zeros(len(param), 'int')
+        try:
+            if self.convolved is False:
+                return self._model_function_batch(param, rows)
+            values = self._get_batch_values_at(param, rows)
+            self._charge_batch_values(values)
+            sum_convolved = np.zeros((len(param), 
+                                      len(self.convolution_axis)))
+            sum_ = np.zeros((len(param), len(self.axis.axis)))
+            for component in self:
+                if component.active is False:
+                    continue
+                if component.convolved is True:
+                    sum_convolved += self._evaluate_batch(
+                        component.function, self.convolution_axis, values,
+                        len(param))
+                else:
+                    sum_ += self._evaluate_batch(component.function, 
+                        self.axis.axis, values, len(param))
+            return (sum_ + self._convolve(sum_convolved))[
+                :, self.channel_switches]
+        finally:
+            for parameter, value in backup:
+                parameter.value = value
+    
+    def _model_function_batch(self, param, rows):
+        """Evaluate the model for several pixels at once.
+        
+        Parameters
+        ----------
+        param : array
+            The free parameters of shape (len(rows), number of free 
+            parameters)
+        rows : array
+            The pixels of the current batch to evaluate.
+            
+        Returns
+        -------
+        Array of shape (len(rows), number of channels)
+        
+        """
+        values = self._get_batch_values_at(param, rows)
+        self._charge_batch_values(values)
+        axis = self._get_fitting_axis()
+        sum_ = np.zeros((len(rows), len(axis)))
+        for component in self:
+            if component.active:
+                sum_ += self._evaluate_batch(component.function, axis, 
+                                             values, len(rows))
+        return sum_
+        
+    def _jacobian_batch(self, param, rows):
+        """Jacobian of the model for several pixels at once.
+        
+        Returns
+        -------
+        Array of shape (len(rows), number of free parameters, number of
+        channels)
+        
+        """
+        values = self._get_batch_values_at(param, rows)
+        self._charge_batch_values(values)
+        axis = self._get_fitting_axis()
+        jacobian = np.empty((len(rows), param.shape[1], len(axis)))
+        dependents = self._get_twin_graph()['dependents']
+        i = 0
+        for parameter in self._batch_free_parameters:
+            n = parameter._number_of_elements
+            for par in [parameter,] + dependents.get(parameter, []):
+                if n == 1:
+                    grad = self._evaluate_batch(par.grad, axis, values, 
+                                                len(rows))[:, np.newaxis]
+                else:
+                    grad = np.empty((len(rows), n, len(axis)))
+                    for row in xrange(len(rows)):
+                        self._charge_batch_values(values, row = row)
+                        grad[row] = par.grad(axis)
+                    self._charge_batch_values(values)
+                if par is parameter:
+                    jacobian[:, i:i + n] = grad
+                else:
+                    jacobian[:, i:i + n] += grad
+            i += n
+        return jacobian
+        
+    def _approx_jacobian_batch(self, param, rows):
+        """Forward differences approximation of `_jacobian_batch`"""
+        f0 = self._model_function_batch(param, rows)
+        jacobian = np.empty((len(rows), param.shape[1], f0.shape[1]))
+        for i in xrange(param.shape[1]):
+            step = np.sqrt(np.finfo(float).eps) * np.maximum(
+                np.abs(param[:, i]), 1.)
+            param_ = param.copy()
+            param_[:, i] += step
+            jacobian[:, i] = (self._model_function_batch(param_, rows) - 
+                              f0) / step[:, np.newaxis]
+        return jacobian
+        
+    def _batch_fit(self, p0, y, weights = None, grad = False, **kwargs):
+        """Fit the model to several spectra at once using 
+        :py:func:`~.optimizers.batch_leastsq`.
+        
+        The values of the parameters of the pixels must be defined in 
+        self._batch_values before calling this method. On return the values
+        of the parameters are restored to the values that they had before
+        calling it.
+        
+        """
+        if kwargs.pop('linear_parameters', None) is not None:
+            messages.information(
+            "The batch_lm fitter does not solve the linear parameters "
+            "separately, fitting all the parameters instead")
+        self._batch_free_parameters = self._get_free_parameters()
+        backup = [(parameter, parameter.value) for parameter in 
+                  self._batch_values.iterkeys()]
+        try:
+            return batch_leastsq(self._model_function_batch, 
+                self._jacobian_batch if grad is True else 
+                self._approx_jacobian_batch, p0, y, weights = weights, 
+                **kwargs)
+        finally:
+            for parameter, value in backup:
+                parameter.value = value
+                
+    def _fit_pixels_batch(self, indexes, charge_only_fixed = False, 
+                          grad = False, weights = None, **kwargs):
+        """Fit the given pixels at once with the batch_lm fitter and store
+        the results in the parameters maps.
+        
+        Returns
+        -------
+        The number of function evaluations, the convergence status and the
+        final sum of squares of every pixel.
+        
+        """
+        switch_aap = (False != self.auto_update_plot)
+        if switch_aap is True:
+            self.set_auto_update_plot(False)
+        index_arrays = tuple(np.array(indexes).T)
+        self._batch_values = self._get_batch_values(indexes, 
+                                                only_fixed = charge_only_fixed)
+        free_parameters = self._get_free_parameters()
+        p0 = np.hstack([self._batch_values[parameter] for parameter in 
+                        free_parameters])
+        data = self.spectrum.data[index_arrays]
+        y = data[..., self.channel_switches]
+        if weights is True:
+            if self.spectrum.variance is None:
+                self.spectrum.estimate_variance()
+            weights = 1. / np.sqrt(self.spectrum.variance[index_arrays][...,
+                self.channel_switches])
+        elif weights is not None:
+            weights = weights[index_arrays][..., self.channel_switches]
+        p, p_std, nfev, success, cost = self._batch_fit(p0, y, 
+            weights = weights, grad = grad, full_output = True, **kwargs)
+        self._batch_values = self._get_batch_values_at(p, 
+                                                       np.arange(len(p)))
+        # Store the results
+        i = 0
+        for parameter in free_parameters:
+            n = parameter._number_of_elements
+            parameter.map['std'][index_arrays] = p_std[:, i:i + n].squeeze()
+            i += n
+        self._store_batch_values(self._batch_values, index_arrays)
+        if switch_aap is True:
+            self.set_auto_update_plot(True)
+        return nfev, success, cost
+        
+    def _store_batch_values(self, values, index_arrays):
+        """Store the values of all the parameters at several pixels in the
+        parameters maps.
+        
+        Parameters
+        ----------
+        values : dictionary
+            As returned by `_get_batch_values`.
+        index_arrays : tuple of arrays
+            The navigation indexes of the pixels.
+            
+        """
+        backup = [(parameter, parameter.value) for parameter in 
+                  values.iterkeys()]
+        self._charge_batch_values(values)
+        for component in self:
+            for parameter in component.parameters:
+                value = np.array(parameter.value, dtype = 'float')
+                if parameter._number_of_elements == 1:
+                    value = value.ravel()
+                parameter.map['values'][index_arrays] = value
+                parameter.map['is_set'][index_arrays] = True
+        for parameter, value in backup:
+            parameter.value = value
+            
+    def _fit_pixels_linear(self, indexes, weights = None, **kwargs):
+        """Solve the free parameters at the given pixels by linear least
+        squares and store the results in the parameters maps.
+        
+        All the free parameters must be linear. The pixels that share the 
+        values of the fixed parameters share the design matrix, therefore
+        they are solved at once.
+        
+        Returns
+        -------
+        The final sum of squares of every pixel.
+        
+        """
+        switch_aap = (False != self.auto_update_plot)
+        if switch_aap is True:
+            self.set_auto_update_plot(False)
+        index_arrays = tuple(np.array(indexes).T)
+        linear_parameters = self._get_linear_parameters()
+        values = self._get_batch_values(indexes, only_fixed = True)
+        y = self.spectrum.data[index_arrays][..., self.channel_switches]
+        if weights is True:
+            if self.spectrum.variance is None:
+                self.spectrum.estimate_variance()
+            weights = 1. / np.sqrt(self.spectrum.variance[index_arrays][...,
+                self.channel_switches])
+        elif weights is not None:
+            weights = weights[index_arrays][..., self.channel_switches]
+        # Group the pixels by the values of the fixed parameters
+        fixed = [parameter for parameter in values.iterkeys() 
+                 if parameter not in linear_parameters]
+        groups = {}
+        for row in xrange(len(indexes)):
+            key = tuple([values[parameter][row].tostring() 
+                         for parameter in fixed])
+            groups.setdefault(key, []).append(row)
+        backup = [(parameter, parameter.value) for parameter in 
+                  values.iterkeys()]
+        ncoefficients = sum([parameter._number_of_elements 
+                             for parameter in linear_parameters])
+        coefficients = np.empty((len(indexes), ncoefficients))
+        std = np.empty((len(indexes), ncoefficients))
+        cost = np.empty(len(indexes))
+        for rows in groups.itervalues():
+            self._charge_batch_values(values, row = rows[0])
+            for parameter in linear_parameters:
+                n = parameter._number_of_elements
+                parameter.value = 0. if n == 1 else [0.] * n
+            fixed_part = self.__call__(onlyactive = True)
+            basis = self._get_linear_basis(linear_parameters)
+            residual = y[rows] - fixed_part
             if weights is None:
-                return grad[1:,:]
+                coefficients[rows] = np.linalg.lstsq(basis.T, residual.T, 
+                                                     rcond = -1)[0].T
+                std[rows] = np.sqrt(np.diag(np.linalg.pinv(
+                    np.dot(basis, basis.T))))
             else:
-                return grad[1:,:] * weights
+                weighted_basis = basis * weights[rows][:, np.newaxis, :]
+                # Stacked normal equations, one per pixel
+                inverse = np.linalg.pinv(np.einsum('nki,nli->nkl', 
+                    weighted_basis, weighted_basis))
+                coefficients[rows] = np.einsum('nkl,nli,ni->nk', inverse, 
+                    weighted_basis, residual * weights[rows])
+                std[rows] = np.sqrt(np.diagonal(inverse, axis1 = 1, 
+                                                axis2 = 2))
+            residual -= np.dot(coefficients[rows], basis)
+            if weights is not None:
+                residual *= weights[rows]
+            cost[rows] = (residual ** 2).sum(-1)
+        for parameter, value in backup:
+            parameter.value = value
+        i = 0
+        for parameter in linear_parameters:
+            n = parameter._number_of_elements
+            values[parameter] = coefficients[:, i:i + n]
+            parameter.map['std'][index_arrays] = std[:, i:i + n].squeeze()
+            i += n
+        self._store_batch_values(values, index_arrays)
+        if switch_aap is True:
+            self.set_auto_update_plot(True)
+        return cost
         
     def _function4odr(self,param,x):
+        self._nfev += 1
         return self._model_function(param)
     
     def _jacobian4odr(self,param,x):
@@ -590,61 +2190,814 @@ class Model(list, Optimizers, Estimators):
                 
     def multifit(self, mask = None, fitter = None, 
                  charge_only_fixed = False, grad = False, autosave = False, 
-                 autosave_every = 10, bounded = False, **kwargs):
+                 autosave_every = 10, bounded = False, parallel = False,
+                 max_workers = None, linear = False, scan_order = 'C',
+                 warm_start = 'previous', binning = 2, resume = None, 
+                 only = None, estimate_std = False, **kwargs):
+        """Fit the data at all the navigation coordinates.
+        
+        The number of function evaluations used to fit every pixel, 
+        whether the fitter converged, the final cost and a digest of the 
+        data and model configuration are stored in the 'nfev', 'success', 
+        'cost' and 'hash' fields of the `fit_info` array, which has the 
+        navigation shape.
+        
+        Parameters
+        ----------
+        mask : {None, numpy.array}
+            Boolean array with the navigation shape. The pixels where mask
+            is True are not fitted.
+        fitter : {None, str}
+            The optimizer to use. If None, the default fitter defined in the
+            preferences is used.
+        charge_only_fixed : bool
+            If True, only the fixed parameters are charged from the 
+            parameters maps before fitting each pixel.
+        grad : bool
+            If True, the analytical gradient is used if defined.
+        autosave : bool
+            If True, the fitted pixels are saved to a temporary HDF5 
+            checkpoint file every `autosave_every` pixels. The file is 
+            deleted when multifit finishes. If h5py is not installed, the 
+            parameters maps are saved to a temporary npz file instead.
+        autosave_every : int
+        bounded : bool
+            If True, the fit is bounded (only for the mpfit, tnc and 
+            l_bfgs_b fitters).
+        parallel : bool
+            If True, the navigation space is split in chunks of contiguous
+            pixels that are fitted in `max_workers` worker processes. 
+            The results are identical to the serial ones for deterministic 
+            fitters, therefore the starting values of every pixel must not 
+            depend on the order in which the pixels are fitted: either the
+            values of the free parameters must be set in the parameters 
+            maps for all the pixels to fit (e.g. by `estimate_parameters`) 
+            and `charge_only_fixed` must be False, or `warm_start` must be
+            'binned', or the fitter must be 'batch_lm'. Otherwise, the 
+            pixels are fitted serially. The workers are forked from the 
+            current process, which must be supported by the platform.
+        max_workers : {None, int}
+            The number of worker processes. If None, the number of CPUs.
+        linear : bool
+            If True and all the free parameters are linear (see 
+            `fit`), the fit of every pixel is a linear least squares problem
+            and all the pixels are solved at once, in blocks of 
+            `batch_size` pixels (1024 by default), without using a 
+            nonlinear optimizer. The pixels that share the values of the 
+            fixed parameters share the design matrix. The `weights` 
+            keyword is supported. If any free parameter is not linear, the 
+            pixels are fitted serially with the leastsq fitter and
+            `linear_parameters` set to 'auto' instead.
+        scan_order : {'C', 'serpentine', 'hilbert'}
+            The order in which the pixels are visited. 'C' visits them in 
+            the order of the data in memory. 'serpentine' reverses the 
+            direction of the scan at every row so that consecutive pixels
+            are always neighbours. 'hilbert' follows a Hilbert curve, which
+            keeps consecutive pixels close in both directions. It is only
+            available for two navigation dimensions, otherwise 'serpentine'
+            is used.
+        warm_start : {'previous', 'neighbours', 'binned'}
+            The starting values of the free parameters of every pixel.
+            'previous' uses the values charged from the parameters maps 
+            or, where they are not set, the result of the previous pixel.
+            'neighbours' uses the average of the results of the 
+            neighbouring pixels (one step along every navigation axis) 
+            that have already been fitted in this run. 'binned' first fits
+            the data binned by `binning` pixels along every navigation 
+            axis using the batch_lm fitter and starts every pixel from the 
+            result of its bin. The warm start strategies are only used by 
+            the pixel by pixel fitters and 'binned' does not support 
+            convolved models, in which case 'neighbours' is used instead.
+        binning : int
+            The binning factor of the 'binned' warm start strategy.
+        resume : {None, str}
+            The name of an HDF5 checkpoint file. If it does not exist, it 
+            is created and the fitted pixels are saved to it every 
+            `autosave_every` pixels. If it exists, it must have been written
+            by a multifit of a model with the same components and 
+            navigation shape. The pixels that were fitted according to the
+            file are loaded and not fitted again and the new results 
+            are added to the file. Therefore, an interrupted multifit can be 
+            resumed by running it again with the same arguments. The file 
+            is not deleted when multifit finishes. It requires h5py.
+        only : {None, 'failed', 'changed', numpy.array}
+            If not None, only some pixels are fitted again, starting from 
+            the values stored in the parameters maps. 'failed' fits the 
+            pixels that have not been fitted or whose fit did not converge. 
+            'changed' fits the pixels whose data, low-loss spectrum, fixed
+            parameters values or model configuration (components, active
+            and free states, twins, bounds and channel switches) changed 
+            since they were fitted. A boolean array with the navigation 
+            shape fits the pixels where it is True. The pixels excluded by
+            `mask` are never fitted. The digests of the fitting problems
+            used by 'changed' are only stored in `fit_info` when `only` or
+            `resume` is not None, the pixels fitted otherwise are 
+            considered changed.
+        estimate_std : bool
+            If True, the standard deviation of the parameters fitted with 
+            the general optimizers (fmin, powell, cg, ncg, bfgs, tnc and 
+            l_bfgs_b) is estimated from the Fisher information matrix, 
+            which costs one evaluation of the jacobian per pixel. The other
+            fitters always estimate it.
+        **kwargs : 
+            Any extra keyword argument is passed to `fit`, e.g. 
+            `signal_binning` to fit every pixel on the binned signal axis 
+            first. The number of function evaluations stored in `fit_info` 
+            then includes those of the binned fit. When the fitter
+            is "batch_lm" the pixels are fitted in blocks of `batch_size`
+            pixels (1024 by default) and the `weights`, `maxiter`, `ftol` 
+            and `xtol` keywords are passed to 
+            :py:func:`~.optimizers.batch_leastsq`.
+        
+        """
         
         if fitter is None:
             fitter = preferences.Model.default_fitter
             print('Fitter: %s' % fitter) 
-        if autosave is not False:
-            fd, autosave_fn = tempfile.mkstemp(prefix = 'hyperspy_autosave-', 
-            dir = '.', suffix = '.npz')
-            os.close(fd)
-            autosave_fn = autosave_fn[:-4]
-            messages.information(
-            "Autosaving each %s pixels to %s.npz" % (autosave_every, 
-                                                     autosave_fn))
-            messages.information(
-            "When multifit finishes its job the file will be deleted")
         if mask is not None and \
         (mask.shape != tuple(self.axes_manager.navigation_shape)):
            messages.warning_exit(
            "The mask must be an array with the same espatial dimensions as the" 
            "navigation shape, %s" % self.axes_manager.navigation_shape)
-        masked_elements = 0 if mask is None else mask.sum()
-        pbar = progressbar.progressbar(
-        maxval = (np.cumprod(self.axes_manager.navigation_shape)[-1] - 
-        masked_elements))
-        if bounded is True:
-            if fitter == 'mpfit':
-                self.set_mpfit_parameters_info()
-                bounded = None
-            elif fitter in ("tnc", "l_bfgs_b"):
-                self.set_boundaries()
-                bounded = None
-            else:
+        if resume is not None and h5py is None:
+            messages.warning_exit(
+            "Resuming multifit requires h5py, which is not installed")
+        self._get_fit_info()
+        # The configuration is hashed once to select the changed pixels 
+        # and to store the digests of the fitted ones
+        hashing = None
+        if only is not None or resume is not None:
+            hashing = self._get_hashing_state()
+        if only is not None:
+            refit = self._get_pixels_to_refit(only, hashing = hashing)
+            mask = (refit == False) if mask is None else (mask | 
+                                                          (refit == False))
+        compiled = False
+        try:
+            if autosave is not False or resume is not None:
+                fitted = self._open_checkpoint(resume, autosave_every)
+                if fitted is not None:
+                    mask = fitted if mask is None else (mask | fitted)
+            if bounded is True:
+                if fitter == 'mpfit':
+                    self.set_mpfit_parameters_info()
+                    bounded = None
+                elif fitter in ("tnc", "l_bfgs_b"):
+                    self.set_boundaries()
+                    bounded = None
+                else:
+                    messages.information(
+                    "The chosen fitter does not suppport bounding."
+                    "If you require boundinig please select one of the "
+                    "following fitters instead: mpfit, tnc, l_bfgs_b")
+                    bounded = False
+            if fitter == 'batch_lm' and self.convolved is True:
                 messages.information(
-                "The chosen fitter does not suppport bounding."
-                "If you require boundinig please select one of the following"
-                "fitters instead: mpfit, tnc, l_bfgs_b")
-                bounded = False
-        i = 0
-        for index in np.ndindex(tuple(self.axes_manager.navigation_shape)):
-            if mask is None or not mask[index]:
-                self.axes_manager.set_not_slicing_indexes(index)
-                self.charge(only_fixed = charge_only_fixed)
-                self.fit(fitter = fitter, grad = grad, bounded = bounded, 
-                         **kwargs)
-                i += 1
-                pbar.update(i)
-            if autosave is True and i % autosave_every  == 0:
-                self.save_parameters2file(autosave_fn)
+                "The batch_lm fitter does not support convolved models, "
+                "using leastsq instead")
+                fitter = 'leastsq'
+            if linear is True:
+                if self.convolved is True or len(self._get_linear_parameters(
+                    bounded = bounded is not False)) < len(
+                    self._get_free_parameters()):
+                    messages.information(
+                    "Not all the free parameters are linear or the model is "
+                    "convolved, fitting every pixel with leastsq and "
+                    "linear_parameters='auto' instead")
+                    linear = False
+                    fitter = 'leastsq'
+                    kwargs['linear_parameters'] = 'auto'
+                else:
+                    parallel = False
+            if (fitter == 'batch_lm' or linear is True) and [
+                component for component in self 
+                if component.active_map is not None]:
+                messages.information(
+                "The batch_lm fitter and linear fitting do not support "
+                "components with active maps, fitting every pixel with "
+                "leastsq instead")
+                if linear is True:
+                    kwargs['linear_parameters'] = 'auto'
+                linear = False
+                fitter = 'leastsq'
+            if kwargs.get('signal_binning') is not None and (
+                fitter == 'batch_lm' or linear is True):
+                messages.information(
+                "Fitting the binned signal first is only supported by the "
+                "pixel by pixel fitters, ignoring signal_binning")
+                kwargs.pop('signal_binning')
+            if parallel is True and not hasattr(os, 'fork'):
+                messages.information(
+                "Parallel fitting is not supported in this platform, fitting "
+                "serially instead")
+                parallel = False
+            indexes = self._get_scan_indexes(scan_order, mask)
+            if not indexes:
+                messages.information("There are no pixels to fit")
+                self._close_checkpoint()
+                return
+            pbar = progressbar.progressbar(maxval = len(indexes))
+            if warm_start != 'previous':
+                if fitter == 'batch_lm' or linear is True:
+                    messages.information(
+                    "The warm start strategies are only used by the pixel by "
+                    "pixel fitters, ignoring warm_start")
+                else:
+                    self._start_warm_start(warm_start, indexes, 
+                        charge_only_fixed = charge_only_fixed, 
+                        binning = binning, grad = grad,
+                        batch_size = kwargs.get('batch_size', 1024))
+            if parallel is True and fitter != 'batch_lm' and not \
+            self._are_start_values_defined(indexes, charge_only_fixed):
+                messages.information(
+                "The starting values of the free parameters are not defined "
+                "in the parameters maps for all the pixels, therefore the "
+                "parallel fit would not reproduce the serial one. Fitting "
+                "serially instead")
+                parallel = False
+            if fitter != 'batch_lm' and linear is False:
+                kwargs['estimate_std'] = estimate_std
+                # The cost of every pixel is stored in fit_info
+                kwargs['compute_cost'] = True
+            self._hashing = hashing
+            # Freeze the structure of the model for all the pixels
+            compiled = self._evaluation_plan is None
+            if compiled is True:
+                self.compile()
+            if parallel is True:
+                self._multifit_parallel(indexes, max_workers = max_workers,
+                    pbar = pbar, charge_only_fixed = charge_only_fixed, 
+                    fitter = fitter, grad = grad, bounded = bounded, **kwargs)
+            elif fitter == 'batch_lm' or linear is True:
+                batch_size = kwargs.pop('batch_size', 1024)
+                i = 0
+                for block in xrange(0, len(indexes), batch_size):
+                    block = indexes[block:block + batch_size]
+                    if linear is True:
+                        cost = self._fit_pixels_linear(block, 
+                            weights = kwargs.get('weights'))
+                        nfev, success = 0, True
+                    else:
+                        nfev, success, cost = self._fit_pixels_batch(block,
+                            charge_only_fixed = charge_only_fixed, 
+                            grad = grad, **kwargs)
+                    self._store_fit_info(block, nfev, success, cost)
+                    i += len(block)
+                    pbar.update(i)
+                    self._checkpoint_pixels(block)
+                # Leave the model at the last pixel as the serial multifit
+                self.axes_manager.set_not_slicing_indexes(indexes[-1])
+                self.charge()
+            else:
+                i = 0
+                for index in indexes:
+                    self._fit_pixel(index, 
+                        charge_only_fixed = charge_only_fixed, 
+                        fitter = fitter, grad = grad, bounded = bounded, 
+                        **kwargs)
+                    i += 1
+                    pbar.update(i)
+                    self._checkpoint_pixels([index])
+        except:
+            # Keep the checkpoint file so that the fit can be resumed
+            self._warm_start = None
+            self._hashing = None
+            if compiled is True:
+                self._evaluation_plan = None
+            self._close_checkpoint(keep = True)
+            raise
+        self._warm_start = None
+        self._hashing = None
+        if compiled is True:
+            self._evaluation_plan = None
         pbar.finish()
-        if autosave is True:
+        self._close_checkpoint()
+        
+    def _open_checkpoint(self, filename = None, every = 10):
+        """Open the checkpoint file of multifit.
+        
+        Parameters
+        ----------
+        filename : {None, str}
+            The name of the HDF5 checkpoint file. If None, a temporary file
+            that is deleted by `_close_checkpoint` is created.
+        every : int
+            The number of fitted pixels between checkpoints.
+            
+        Returns
+        -------
+        If the file already existed, a boolean array with the navigation 
+        shape that is True for the pixels that were loaded from it, 
+        otherwise None.
+        
+        """
+        temporary = filename is None
+        self._checkpoint = {
+            'file' : None,
+            'temporary' : temporary,
+            'every' : every,
+            'pending' : [],}
+        if h5py is None:
+            fd, filename = tempfile.mkstemp(prefix = 'hyperspy_autosave-', 
+            dir = '.', suffix = '.npz')
+            os.close(fd)
+            self._checkpoint['filename'] = filename[:-4]
             messages.information(
-            'Deleting the temporary file %s pixels' % (autosave_fn + 'npz'))
-            os.remove(autosave_fn + '.npz')
-
+            "Autosaving each %s pixels to %s" % (every, filename))
+            messages.information(
+            "When multifit finishes its job the file will be deleted")
+            return None
+        if temporary:
+            fd, filename = tempfile.mkstemp(prefix = 'hyperspy_autosave-', 
+            dir = '.', suffix = '.hdf5')
+            os.close(fd)
+            os.remove(filename)
+        self._checkpoint['filename'] = filename
+        store = self._get_parameter_store()
+        shape = tuple(self.axes_manager.navigation_shape)
+        names = ['%i_%s.%s' % (i, component.name.lower().replace(' ', '_'), 
+                               parameter.name.lower().replace(' ', '_'))
+                 for i, component in enumerate(self) 
+                 for parameter in component.parameters]
+        fitted = None
+        if os.path.exists(filename):
+            f = h5py.File(filename, mode = 'r+')
+            # Close it if anything fails from now on
+            self._checkpoint['file'] = f
+            if 'parameters' not in f or 'fitted' not in f or \
+            tuple(f.attrs['navigation_shape']) != shape or \
+            list(f.attrs['parameters']) != names or \
+            list(f.attrs['sizes']) != list(self._store_sizes) or \
+            f['parameters'].dtype != store.dtype or \
+            f['fit_info'].dtype != self.fit_info.dtype:
+                f.close()
+                self._checkpoint = None
+                messages.warning_exit(
+                "%s is not a checkpoint file of a model with the same "
+                "components and navigation shape" % filename)
+            # Only the pixels that were fitted are loaded, not those whose
+            # parameters were set before fitting them
+            fitted = f['fitted'][...].reshape(shape)
+            store[fitted] = f['parameters'][...].reshape(shape)[fitted]
+            self.fit_info[fitted] = f['fit_info'][...].reshape(shape)[fitted]
+            messages.information(
+            "Resuming from %s, %i pixels were already fitted" % (
+                filename, fitted.sum()))
+        else:
+            f = h5py.File(filename, mode = 'w')
+            self._checkpoint['file'] = f
+            f.attrs['navigation_shape'] = shape
+            f.attrs['parameters'] = names
+            f.attrs['sizes'] = self._store_sizes
+            # The model structure
+            for i, component in enumerate(self):
+                group = f.create_group('model/%i_%s' % (i, 
+                    component.name.lower().replace(' ', '_')))
+                group.attrs['class'] = component.__class__.__name__
+                group.attrs['active'] = component.active
+                group.attrs['parameters'] = [parameter.name for parameter in
+                                             component.parameters]
+            npixels = int(np.prod(shape))
+            f.create_dataset('parameters', (npixels,), dtype = store.dtype,
+                             chunks = True)
+            f.create_dataset('fit_info', (npixels,), 
+                             dtype = self.fit_info.dtype, chunks = True)
+            f.create_dataset('fitted', (npixels,), dtype = 'bool', 
+                             chunks = True)
+            messages.information(
+            "Saving the fitted pixels each %s pixels to %s" % (every, 
+                                                               filename))
+            if temporary is True:
+                messages.information(
+                "When multifit finishes its job the file will be deleted")
+        return fitted
+        
+    def _checkpoint_pixels(self, indexes):
+        """Add the given fitted pixels to the checkpoint, writing them to
+        the checkpoint file once there are enough of them."""
+        checkpoint = self._checkpoint
+        if checkpoint is None:
+            return
+        checkpoint['pending'].extend(indexes)
+        if len(checkpoint['pending']) >= checkpoint['every']:
+            self._write_checkpoint()
+            
+    def _write_checkpoint(self):
+        """Write the pending pixels to the checkpoint file.
+        
+        Only the pending pixels are written to the HDF5 file, in one write 
+        per run of consecutive pixels in memory.
+        
+        """
+        checkpoint = self._checkpoint
+        if not checkpoint['pending']:
+            return
+        f = checkpoint['file']
+        if f is None:
+            self.save_parameters2file(checkpoint['filename'])
+        else:
+            shape = tuple(self.axes_manager.navigation_shape)
+            if shape:
+                pixels = np.unique(np.ravel_multi_index(
+                    tuple(np.array(checkpoint['pending']).T), shape))
+            else:
+                pixels = np.zeros(1, dtype = 'int')
+            parameters = self._get_parameter_store().reshape(-1)
+            fit_info = self.fit_info.reshape(-1)
+            for run in np.split(pixels, 
+                                np.nonzero(np.diff(pixels) != 1)[0] + 1):
+                pixel_slice = slice(run[0], run[-1] + 1)
+                f['parameters'][pixel_slice] = parameters[pixel_slice]
+                f['fit_info'][pixel_slice] = fit_info[pixel_slice]
+                f['fitted'][pixel_slice] = True
+            f.flush()
+        checkpoint['pending'] = []
+        
+    def _close_checkpoint(self, keep = False):
+        """Write the pending pixels and close the checkpoint file, deleting
+        it if it is temporary unless `keep` is True."""
+        checkpoint = self._checkpoint
+        if checkpoint is None:
+            return
+        if keep is True or checkpoint['temporary'] is False:
+            self._write_checkpoint()
+        self._checkpoint = None
+        if checkpoint['file'] is None:
+            filename = checkpoint['filename'] + '.npz'
+        else:
+            checkpoint['file'].close()
+            filename = checkpoint['filename']
+        if keep is True and checkpoint['file'] is not None:
+            messages.information(
+            "The fitted pixels were saved to %s, the fit can be resumed "
+            "with multifit(resume='%s')" % (filename, filename))
+        elif checkpoint['temporary'] is True and os.path.exists(filename):
+            messages.information(
+            'Deleting the temporary file %s' % filename)
+            os.remove(filename)
+            
+    def _fit_pixels(self, indexes, charge_only_fixed = False, **kwargs):
+        """Fit the given pixels in order and return the resulting parameters
+        maps at those pixels.
+        
+        Parameters
+        ----------
+        indexes : list of tuples
+            The navigation indexes of the pixels to fit.
+        charge_only_fixed : bool
+        **kwargs : 
+            Passed to `fit`.
             
+        Returns
+        -------
+        List with the parameters maps records of the given pixels for all
+        the parameters of all the components of the model and the 
+        `fit_info` records of the given pixels.
+        
+        """
+        index_arrays = tuple(np.array(indexes).T)
+        if kwargs.get('fitter') == 'batch_lm':
+            kwargs.pop('fitter')
+            kwargs.pop('bounded', None)
+            batch_size = kwargs.pop('batch_size', 1024)
+            for block in xrange(0, len(indexes), batch_size):
+                block = indexes[block:block + batch_size]
+                self._store_fit_info(block, *self._fit_pixels_batch(block,
+                    charge_only_fixed = charge_only_fixed, **kwargs))
+        else:
+            for index in indexes:
+                self._fit_pixel(index, charge_only_fixed = charge_only_fixed,
+                                **kwargs)
+        return ([parameter.map[index_arrays] for component in self 
+                 for parameter in component.parameters], 
+                self.fit_info[index_arrays])
+                
+    def _fit_pixel(self, index, charge_only_fixed = False, **kwargs):
+        """Charge the given pixel, set the starting values of the free 
+        parameters according to the warm start strategy and fit it.
+        
+        """
+        self.axes_manager.set_not_slicing_indexes(index)
+        self.charge(only_fixed = charge_only_fixed)
+        if self._warm_start is not None:
+            self._charge_warm_start(index)
+        self.fit(**kwargs)
+        self._store_fit_info([index], self._nfev, self.fit_success, 
+                             self.fit_cost)
+        if self._warm_start is not None:
+            self._warm_start['visited'][index] = True
+            
+    def _get_fit_info(self):
+        """Returns the fit_info array, creating it if necessary.
+        
+        fit_info is a structured array with the navigation shape that 
+        stores information about the fit of every pixel. The 'nfev' field
+        contains the number of function evaluations, 'success' whether 
+        the fitter converged, 'cost' the final sum of squares or negative
+        log-likelihood and 'hash' a digest of the fitting problem (see 
+        `_get_pixel_hashes`), which is only stored when multifit is run 
+        with `only` or `resume` and is empty otherwise.
+        
+        """
+        shape = tuple(self.axes_manager.navigation_shape)
+        if self.fit_info is None or self.fit_info.shape != shape:
+            self.fit_info = np.zeros(shape, dtype = [
+                ('nfev', 'int'), 
+                ('success', 'bool'),
+                ('cost', 'float'),
+                ('hash', 'S32')])
+            self.fit_info['cost'] = np.nan
+        return self.fit_info
+        
+    def _store_fit_info(self, indexes, nfev, success, cost):
+        """Store the number of function evaluations, the convergence 
+        status and the final cost of the given fitted pixels in fit_info,
+        together with the digest of their fitting problem if multifit 
+        computes them."""
+        fit_info = self._get_fit_info()
+        index_arrays = tuple(np.array(indexes).T)
+        fit_info['nfev'][index_arrays] = nfev
+        fit_info['success'][index_arrays] = success
+        fit_info['cost'][index_arrays] = cost
+        if self._hashing is not None:
+            fit_info['hash'][index_arrays] = self._get_pixel_hashes(indexes,
+                hashing = self._hashing)
+        else:
+            fit_info['hash'][index_arrays] = ''
+        
+    def _get_configuration_hash(self):
+        """Returns a digest of the structure of the model: the components,
+        their active state, the free state, twins and bounds of their 
+        parameters, the channel switches and whether it is convolved."""
+        self._get_parameter_store()
+        position = dict([(parameter, i) for i, parameter in 
+                         enumerate(self._store_parameters)])
+        description = [self.convolved, self.channel_switches.tostring()]
+        for component in self:
+            description.append((component.__class__.__name__, 
+                'map' if component.active_map is not None else 
+                component.active, 
+                [(parameter.name, parameter.free, 
+                  position.get(parameter.twin), parameter.bmin, 
+                  parameter.bmax) for parameter in component.parameters]))
+        return hashlib.md5(repr(description)).hexdigest()
+        
+    def _get_hashing_state(self):
+        """Returns the parts of the digests of the pixels that do not 
+        depend on the pixel: the configuration hash, the mask of the fixed
+        parameters in the store and the active maps. multifit computes it
+        once before fitting, as the configuration does not change while 
+        fitting."""
+        configuration = self._get_configuration_hash()
+        self._get_parameter_store()
+        fixed = np.zeros(len(self._parameter_values), dtype = 'bool')
+        for parameter in self._store_parameters:
+            if parameter.twin is None and parameter.free is False:
+                fixed[parameter._store_offset:parameter._store_offset + 
+                      parameter._number_of_elements] = True
+        active_maps = [component.active_map for component in self 
+                       if component.active_map is not None]
+        return {'configuration' : configuration,
+                'fixed' : fixed,
+                'active_maps' : active_maps}
+        
+    def _get_pixel_hashes(self, indexes, hashing = None):
+        """Returns the digests that identify the fitting problem of the 
+        given pixels: the structure of the model, the data, the low-loss
+        spectrum if the model is convolved and the values of the fixed 
+        parameters and the active maps of the components in the parameters
+        maps.
+        
+        If the digest of a pixel differs from the one stored in fit_info
+        when it was fitted, the pixel must be fitted again.
+        
+        Parameters
+        ----------
+        indexes : list of tuples
+        hashing : {None, dict}
+            The state returned by `_get_hashing_state`. If None, it is 
+            computed.
+        
+        """
+        if hashing is None:
+            hashing = self._get_hashing_state()
+        configuration = hashing['configuration']
+        fixed = hashing['fixed']
+        active_maps = hashing['active_maps']
+        store = self._get_parameter_store()
+        hashes = []
+        for index in indexes:
+            index = tuple(index)
+            md5 = hashlib.md5(configuration)
+            md5.update(np.ascontiguousarray(
+                self.spectrum.data[index]).tostring())
+            if self.convolved is True:
+                md5.update(np.ascontiguousarray(
+                    self.low_loss.data[index]).tostring())
+            md5.update(store['values'][index][fixed].tostring())
+            if active_maps:
+                md5.update(np.array([active_map[index] for active_map in 
+                                     active_maps]).tostring())
+            hashes.append(md5.hexdigest())
+        return hashes
+        
+    def _get_pixels_to_refit(self, only, hashing = None):
+        """Returns a boolean array with the navigation shape that is True
+        for the pixels selected by the `only` argument of multifit.
+        
+        `hashing` is the state returned by `_get_hashing_state`. It is 
+        only used when `only` is 'changed' and computed if it is None.
+        
+        """
+        fit_info = self._get_fit_info()
+        shape = fit_info.shape
+        if isinstance(only, np.ndarray):
+            if only.shape != shape:
+                raise ValueError(
+                    "The only mask must have the navigation shape, %s" % 
+                    (shape,))
+            return only.astype('bool')
+        elif only == 'failed':
+            return fit_info['success'] == False
+        elif only == 'changed':
+            indexes = list(np.ndindex(shape))
+            hashes = np.array(self._get_pixel_hashes(indexes, 
+                hashing = hashing), dtype = fit_info['hash'].dtype)
+            return (hashes != fit_info['hash'].ravel()).reshape(shape)
+        else:
+            raise ValueError("Unknown value of only: %s" % only)
+        
+    def _get_scan_indexes(self, scan_order = 'C', mask = None):
+        """Returns the list of the navigation indexes in the given scan 
+        order skipping the masked pixels.
+        
+        Parameters
+        ----------
+        scan_order : {'C', 'serpentine', 'hilbert'}
+        mask : {None, numpy.array}
+        
+        """
+        shape = tuple(self.axes_manager.navigation_shape)
+        if scan_order == 'hilbert' and len(shape) != 2:
+            messages.information(
+            "The hilbert scan order is only available for two navigation "
+            "dimensions, using the serpentine scan order instead")
+            scan_order = 'serpentine'
+        if scan_order == 'C':
+            indexes = list(np.ndindex(shape))
+        elif scan_order == 'serpentine':
+            indexes = _serpentine_indexes(shape)
+        elif scan_order == 'hilbert':
+            indexes = _hilbert_indexes(shape)
+        else:
+            raise ValueError("Unknown scan order: %s" % scan_order)
+        if mask is not None:
+            indexes = [index for index in indexes if not mask[index]]
+        return indexes
+        
+    def _start_warm_start(self, strategy, indexes, charge_only_fixed = False,
+                          binning = 2, grad = False, batch_size = 1024):
+        """Prepare the warm start strategy used by `_fit_pixel`.
+        
+        For the 'binned' strategy the data of the given pixels is binned 
+        and fitted with the batch_lm fitter.
+        
+        """
+        if strategy not in ('neighbours', 'binned'):
+            raise ValueError("Unknown warm start strategy: %s" % strategy)
+        if strategy == 'binned' and self.convolved is True:
+            messages.information(
+            "The binned warm start does not support convolved models, "
+            "using the neighbours warm start instead")
+            strategy = 'neighbours'
+        shape = tuple(self.axes_manager.navigation_shape)
+        self._warm_start = {
+            'strategy' : strategy,
+            'visited' : np.zeros(shape, dtype = 'bool'),}
+        if strategy == 'binned' and indexes:
+            index_array = np.array(indexes)
+            coarse_shape = tuple(-(-np.array(shape) // binning))
+            block_ids = np.ravel_multi_index(tuple((index_array // binning).T),
+                                             coarse_shape)
+            block_ids, first, inverse = np.unique(block_ids, 
+                return_index = True, return_inverse = True)
+            # Average the spectra of every bin
+            y = np.zeros((len(block_ids), self.channel_switches.sum()))
+            for start in xrange(0, len(indexes), batch_size):
+                rows = slice(start, start + batch_size)
+                np.add.at(y, inverse[rows], self.spectrum.data[tuple(
+                    index_array[rows].T)][..., self.channel_switches])
+            y /= np.bincount(inverse)[:, np.newaxis]
+            # The starting values of every bin are those of its first pixel
+            first_indexes = [indexes[i] for i in first]
+            coarse = []
+            for start in xrange(0, len(block_ids), batch_size):
+                self._batch_values = self._get_batch_values(
+                    first_indexes[start:start + batch_size], 
+                    only_fixed = charge_only_fixed)
+                p0 = np.hstack([self._batch_values[parameter] for parameter
+                                in self._get_free_parameters()])
+                coarse.append(self._batch_fit(p0, 
+                    y[start:start + batch_size], grad = grad)[0])
+            rows = -np.ones(coarse_shape, dtype = 'int')
+            rows.flat[block_ids] = np.arange(len(block_ids))
+            self._warm_start['binning'] = binning
+            self._warm_start['coarse'] = np.vstack(coarse)
+            self._warm_start['rows'] = rows
+            
+    def _charge_warm_start(self, index):
+        """Charge the starting values of the free parameters at the given 
+        pixel according to the current warm start strategy."""
+        warm_start = self._warm_start
+        free_index = self._get_free_index()[0]
+        if warm_start['strategy'] == 'binned':
+            row = warm_start['rows'][tuple(np.array(index) // 
+                                           warm_start['binning'])]
+            if row >= 0:
+                self._charge_free(warm_start['coarse'][row])
+        elif warm_start['strategy'] == 'neighbours':
+            visited = warm_start['visited']
+            neighbours = []
+            for axis in xrange(len(index)):
+                for step in (-1, 1):
+                    neighbour = list(index)
+                    neighbour[axis] += step
+                    neighbour = tuple(neighbour)
+                    if 0 <= neighbour[axis] < visited.shape[axis] and \
+                    visited[neighbour]:
+                        neighbours.append(neighbour)
+            if neighbours:
+                store = self._get_parameter_store()
+                values = store['values'][tuple(np.array(neighbours).T)]
+                self._charge_free(values[:, free_index].mean(0))
+    
+    def _are_start_values_defined(self, indexes, charge_only_fixed = False):
+        """Returns True if the starting values of the free parameters of 
+        the given pixels do not depend on the result of the previously 
+        fitted pixels, i.e. if they are taken from the 'binned' warm start
+        or charged from the parameters maps."""
+        warm_start = self._warm_start
+        if warm_start is not None:
+            return warm_start['strategy'] == 'binned'
+        if charge_only_fixed is True:
+            return False
+        is_set = self._get_parameter_store()['is_set'][
+            tuple(np.array(indexes).T)]
+        free = [self._store_index[parameter] for parameter in 
+                self._get_free_parameters()]
+        return bool(is_set[..., free].all())
+        
+    def _multifit_parallel(self, indexes, max_workers = None, pbar = None,
+                           **kwargs):
+        """Fit the given pixels using a pool of worker processes.
+        
+        The pixels are split in chunks of contiguous pixels that are fitted
+        by `_fit_pixels` in the workers. The results are stored in the 
+        parameters maps as soon as each chunk is done.
+        
+        """
+        global _worker_model
+        if not indexes:
+            return
+        if max_workers is None:
+            max_workers = multiprocessing.cpu_count()
+        # Several chunks per worker to balance the load
+        nchunks = min(len(indexes), max_workers * 4)
+        chunks = [[tuple(index) for index in chunk] 
+                  for chunk in np.array_split(np.array(indexes), nchunks)]
+        # The workers must not try to update the plot
+        switch_aap = self.auto_update_plot
+        if switch_aap is True:
+            self.set_auto_update_plot(False)
+        _worker_model = self
+        pool = multiprocessing.Pool(processes = max_workers)
+        try:
+            i = 0
+            for chunk, (maps, fit_info) in pool.imap_unordered(
+                    _multifit_worker, [(chunk, kwargs) for chunk in chunks]):
+                index_arrays = tuple(np.array(chunk).T)
+                parameters = [parameter for component in self 
+                              for parameter in component.parameters]
+                for parameter, map_ in zip(parameters, maps):
+                    parameter.map[index_arrays] = map_
+                self.fit_info[index_arrays] = fit_info
+                i += len(chunk)
+                if pbar is not None:
+                    pbar.update(i)
+                self._checkpoint_pixels(chunk)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            _worker_model = None
+            if switch_aap is True:
+                self.set_auto_update_plot(True)
+        # Leave the model at the last pixel as the serial multifit does
+        self.axes_manager.set_not_slicing_indexes(indexes[-1])
+        self.charge()
+
     def save_parameters2file(self,filename):
         """Save the parameters array in binary format"""
         kwds = {}
@@ -653,7 +3006,12 @@ class Model(list, Optimizers, Estimators):
             cname = component.name.lower().replace(' ', '_')
             for param in component.parameters:
                 pname = param.name.lower().replace(' ', '_')
-                kwds['%s_%s.%s' % (i, cname, pname)] = param.map
+                # The map can be a view of the parameter store with a
+                # padded dtype
+                kwds['%s_%s.%s' % (i, cname, pname)] = np.array(param.map, 
+                    dtype = param._get_map_dtype())
+            if component.active_map is not None:
+                kwds['%s_%s.active' % (i, cname)] = component.active_map
             i += 1
         np.savez(filename, **kwds)
 
@@ -668,8 +3026,10 @@ class Model(list, Optimizers, Estimators):
             for param in component.parameters:
                 pname = param.name.lower().replace(' ', '_')
                 param.map = f['%s_%s.%s' % (i, cname, pname)]
+            if '%s_%s.active' % (i, cname) in f.files:
+                component.active_map = f['%s_%s.active' % (i, cname)]
             i += 1
-                
+        self._invalidate_parameter_store()
         self.charge()
            
     def plot(self, auto_update_plot = True):
@@ -717,6 +3077,7 @@ class Model(list, Optimizers, Estimators):
         for component in components:
             for parameter in component.parameters:
                 parameter.ext_bounded = True
+        self._evaluation_plan = None
     def _disable_ext_bounding(self,components = None):
         """
         """
@@ -725,6 +3086,7 @@ class Model(list, Optimizers, Estimators):
         for component in components:
             for parameter in component.parameters:
                 parameter.ext_bounded = False
+        self._evaluation_plan = None
                 
     def export_results(self, folder=None, format=None, save_std=False,
                        only_free=True, only_active = True):
@@ -22,7 +22,7 @@ import numpy as np
 import traits.api as t
 
 from hyperspy.model import Model
-from hyperspy.components.eels_cl_edge import EELSCLEdge
+from hyperspy.components.eels_cl_edge import EELSCLEdge, cross_sections
 from hyperspy.components import PowerLaw
 from hyperspy.misc.interactive_ns import interactive_ns
 from hyperspy.defaults_parser import preferences
@@ -47,6 +47,12 @@ class EELSModel(Model):
     auto_add_edges : boolean
         If True, and if spectrum is an EELS instance, it will automatically add the ionization edges as 
         defined in the Spectrum instance.
+        
+    The cross sections of the edges are taken from the 
+    `eels_cl_edge.cross_sections` registry when another model already 
+    integrated them with the same microscope parameters. If the registry
+    stores them on disk, the new ones are saved when the edges are 
+    configured, never while fitting.
     """
     
     def __init__(self, spectrum, auto_background = True, auto_add_edges = True, 
@@ -164,6 +170,8 @@ class EELSModel(Model):
             elif isinstance(component,PowerLaw) or component.isbackground is True:
                 self._background_components.append(component)
 
+        if cross_sections.on_disk is True:
+            cross_sections.save()
         if not self.edges:
             messages.warning("The model contains no edges")
         else:
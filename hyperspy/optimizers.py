@@ -23,67 +23,277 @@ fmin_cobyla, fmin_l_bfgs_b, fmin_tnc, fmin_powell
 
 from hyperspy.defaults_parser import preferences
 from hyperspy.estimators import Estimators
-from hyperspy.misc.mpfit.mpfit import mpfit
+from hyperspy import messages
+from hyperspy.misc.mpfit.mpfit_lapack import mpfit
 
 def vst(x, kind = 'ascombe'):
     if kind == 'ascombe':
         return 2*np.sqrt(x+3/8.)
 
+def _solve_stacked(A, b):
+    """Solve the stacked linear systems A[i] x[i] = b[i].
+    
+    Singular systems are solved in the least squares sense.
+    """
+    try:
+        return np.linalg.solve(A, b[..., np.newaxis])[..., 0]
+    except np.linalg.LinAlgError:
+        return np.array([np.linalg.lstsq(Ai, bi)[0] for Ai, bi in zip(A, b)])
+        
+def batch_leastsq(function, jacobian, p0, y, weights = None, maxiter = 100,
+                  ftol = 1.49012e-08, xtol = 1.49012e-08, factor = 1e-3,
+                  full_output = False):
+    """Minimize the sum of squares of many independent problems at once 
+    using the Levenberg-Marquardt algorithm.
+    
+    All the problems share the same model and therefore the same number of
+    parameters and data points. All the linear algebra is performed for all
+    the problems in the same numpy operation and the problems that have 
+    converged are not evaluated any more.
+    
+    Parameters
+    ----------
+    function : callable
+        `function(p, rows)` must return the model for the parameters `p`, an
+        array of shape (len(rows), n_parameters), of the problems `rows` as 
+        an array of shape (len(rows), n_datapoints).
+    jacobian : callable
+        `jacobian(p, rows)` must return the jacobian of the model as an 
+        array of shape (len(rows), n_parameters, n_datapoints).
+    p0 : array
+        The starting parameters of shape (n_problems, n_parameters).
+    y : array
+        The data of shape (n_problems, n_datapoints).
+    weights : {None, array}
+        Weights of the residuals, broadcastable to the shape of `y`.
+    maxiter : int
+        The maximum number of iterations.
+    ftol : float
+        Relative error desired in the sum of squares.
+    xtol : float
+        Relative error desired in the approximate solution.
+    factor : float
+        Initial value of the damping factor.
+    full_output : bool
+        If True, the final sum of squares of every problem is also 
+        returned.
+        
+    Returns
+    -------
+    p : array
+        The solution of each problem.
+    p_std : array
+        The estimated standard deviation of the parameters calculated from 
+        the diagonal of the inverse of the approximate hessian as in 
+        scipy.optimize.leastsq.
+    nfev : array
+        Number of function evaluations of each problem.
+    success : array
+        Boolean array that is True for the problems that converged.
+    cost : array
+        The final sum of squares of each problem, only returned if 
+        `full_output` is True.
+    
+    """
+    p = np.array(p0, dtype = 'float', ndmin = 2).copy()
+    y = np.asarray(y)
+    nproblems = p.shape[0]
+    if weights is not None:
+        weights = np.ones(y.shape) * weights
+    def residuals(p, rows):
+        r = y[rows] - function(p, rows)
+        if weights is not None:
+            r *= weights[rows]
+        return r
+    def weighted_jacobian(p, rows):
+        jac = jacobian(p, rows)
+        if weights is not None:
+            jac = jac * weights[rows][:, np.newaxis, :]
+        return jac
+    all_rows = np.arange(nproblems)
+    r = residuals(p, all_rows)
+    cost = (r**2).sum(-1)
+    nfev = np.ones(nproblems, dtype = 'int')
+    damping = np.ones(nproblems) * factor
+    converged = np.zeros(nproblems, dtype = 'bool')
+    success = np.zeros(nproblems, dtype = 'bool')
+    rows = all_rows
+    # The jacobian only needs to be updated after a successful step
+    jac = weighted_jacobian(p, rows)
+    for iteration in xrange(maxiter):
+        jtj = np.einsum('ikn,iln->ikl', jac, jac)
+        jtr = np.einsum('ikn,in->ik', jac, r[rows])
+        diagonal = np.diagonal(jtj, axis1 = 1, axis2 = 2).copy()
+        diagonal[diagonal == 0] = 1.
+        A = jtj.copy()
+        k = np.arange(p.shape[1])
+        A[:, k, k] += damping[rows][:, np.newaxis] * diagonal
+        step = _solve_stacked(A, jtr)
+        p_new = p[rows] + step
+        r_new = residuals(p_new, rows)
+        nfev[rows] += 1
+        cost_new = (r_new**2).sum(-1)
+        improved = cost_new < cost[rows]
+        improved_rows = rows[improved]
+        small_step = np.all(np.abs(step) <= xtol * (np.abs(p_new) + xtol), -1)
+        small_reduction = (cost[rows] - cost_new) <= \
+            ftol * cost[rows]
+        done = (improved & (small_step | small_reduction)) | \
+            (~improved & small_step) | (cost_new == 0)
+        p[improved_rows] = p_new[improved]
+        r[improved_rows] = r_new[improved]
+        cost[improved_rows] = cost_new[improved]
+        damping[improved_rows] /= 10.
+        damping[rows[~improved]] *= 10.
+        converged[rows[done]] = True
+        success[rows[done]] = True
+        # Give up on the problems that cannot be improved any more
+        converged[rows[damping[rows] > 1e16]] = True
+        still_active = ~converged[rows]
+        if not still_active.any():
+            break
+        # Only recompute the jacobian of the problems that moved
+        new_rows = rows[still_active]
+        moved = improved[still_active]
+        jac = jac[still_active]
+        if moved.any():
+            jac[moved] = weighted_jacobian(p[new_rows[moved]], new_rows[moved])
+        rows = new_rows
+    jac = weighted_jacobian(p, all_rows)
+    jtj = np.einsum('ikn,iln->ikl', jac, jac)
+    p_std = np.empty(p.shape)
+    p_std[:] = np.nan
+    for i in xrange(nproblems):
+        try:
+            p_std[i] = np.sqrt(np.diag(np.linalg.inv(jtj[i])))
+        except np.linalg.LinAlgError:
+            pass
+    if full_output is True:
+        return p, p_std, nfev, success, cost
+    return p, p_std, nfev, success
+
 class Optimizers(Estimators):
     """
     """
 
     def fit(self, fitter = None, method = 'ls',
     	    grad = False, weights = None, ext_bounding = False, ascombe = True,
-    	    update_plot = False, bounded = False, **kwargs):
+    	    update_plot = False, bounded = False, linear_parameters = None,
+    	    signal_binning = None, estimate_std = False, compute_cost = False,
+    	    **kwargs):
         """
         Fits the model to the experimental data using the fitter e
         The covariance matrix calculated by the 'leastsq' fitter is not always
         reliable
+        
+        If `linear_parameters` is 'auto', the free parameters in which the 
+        model is linear (those with `is_linear` True, e.g. the amplitude 
+        of a Gaussian) are solved by linear least squares at every step 
+        and the optimizer only iterates over the nonlinear ones (variable 
+        projection). A list of parameters can also be given. It is only 
+        supported for the least squares method and it is ignored by the 
+        batch_lm fitter. When fitting with bounds, the linear parameters 
+        with bmin or bmax are not projected.
+        
+        If `signal_binning` is an integer larger than one, the model is 
+        first fitted to the data binned by `signal_binning` channels along 
+        the signal axis, which is cheaper to evaluate and usually has fewer
+        local minima, and then it is refined at full resolution starting 
+        from the result. The number of function evaluations of both fits 
+        is added. It is not supported for convolved models.
+        
+        The general optimizers (fmin, powell, cg, ncg, bfgs, tnc and 
+        l_bfgs_b) do not estimate the standard deviation of the parameters.
+        If `estimate_std` is True it is computed from the Fisher 
+        information matrix after fitting, which costs one evaluation of 
+        the jacobian.
+        
+        If `compute_cost` is True, the final sum of squares or negative 
+        log-likelihood is stored in `fit_cost`, which costs one evaluation
+        of the model. Otherwise `fit_cost` is None.
         """
         if fitter is None:
             fitter = preferences.Model.default_fitter
             print('Fitter: %s' % fitter)
+        if fitter == 'batch_lm' and self.convolved is True:
+            messages.information(
+            "The batch_lm fitter does not support convolved models, "
+            "using leastsq instead")
+            fitter = 'leastsq'
         switch_aap = (update_plot != self.auto_update_plot)
         if switch_aap is True:
             self.set_auto_update_plot(update_plot)
         self.p_std = None
+        self._nfev = 0
+        coarse_nfev = 0
+        success = True
+        if self._variable_projection is not None:
+            # A previous fit was interrupted
+            for parameter in self._variable_projection['parameters']:
+                parameter.free = True
+            self._variable_projection = None
+        if linear_parameters is not None and (method != 'ls' or 
+                                              fitter == 'batch_lm'):
+            messages.information(
+            "Solving the linear parameters is only supported for the least "
+            "squares method and fitters other than batch_lm, fitting all "
+            "the parameters with %s instead" % fitter)
+            linear_parameters = None
+        if signal_binning is not None and signal_binning > 1:
+            if self.convolved is True:
+                messages.information(
+                "Fitting the binned signal is not supported for convolved "
+                "models, fitting at full resolution only")
+            else:
+                coarse_nfev = self._fit_signal_binned(signal_binning, 
+                    fitter = fitter, method = method, grad = grad, 
+                    weights = weights, ext_bounding = ext_bounding, 
+                    bounded = bounded, linear_parameters = linear_parameters,
+                    estimate_std = False, **kwargs)
+        if linear_parameters == 'auto':
+            linear_parameters = self._get_linear_parameters(
+                bounded = bool(bounded or ext_bounding))
         self._set_p0()
         if ext_bounding:
             self._enable_ext_bounding()
         if grad is False :
-            approx_grad = True
-            jacobian = None
+            # The derivatives are approximated by finite differences
+            # evaluating all the displaced parameters at once
+            jacobian = self._approx_jacobian_ls
             odr_jacobian = None
-            grad_ml = None
-            grad_ls = None
+            grad_ml = self._approx_gradient_ml
+            grad_ls = self._approx_gradient_ls
         else :
-            approx_grad = False
             jacobian = self._jacobian
             odr_jacobian = self._jacobian4odr
             grad_ml = self._gradient_ml
             grad_ls = self._gradient_ls
         if method == 'ml':
             weights = None
-        if weights is True:
-            if self.spectrum.variance is None:
-                self.spectrum.estimate_variance()
-            weights = 1. / np.sqrt(self.spectrum.variance.__getitem__(
-            self.axes_manager._getitem_tuple)[self.channel_switches])
-        elif weights is not None:
-            weights = weights.__getitem__(self.axes_manager._getitem_tuple)[
-            self.channel_switches]
-        args = (self.spectrum()[self.channel_switches], 
-        weights)
+        y, weights = self._get_fit_data(weights)
+        args = (y, weights)
+        if linear_parameters:
+            self._start_variable_projection(linear_parameters, args[0], 
+                                            weights)
+            self._set_p0()
+        # Freeze the structure of the model while fitting
+        compiled = self._evaluation_plan is None
+        if compiled is True:
+            self.compile()
         
+        if linear_parameters and not self.p0:
+            # All the free parameters are linear
+            self.p_std = np.array([])
+            self.fit_output = None
         # Least squares "dedicated" fitters
-        if fitter == "leastsq":
+        elif fitter == "leastsq":
             output = \
             leastsq(self._errfunc, self.p0[:], Dfun = jacobian,
             col_deriv=1, args = args, full_output = True, **kwargs)
             
             self.p0 = output[0]
             var_matrix = output[1]
+            success = output[4] in (1, 2, 3, 4)
             # In Scipy 0.7 sometimes the variance matrix is None (maybe a 
             # bug?) so...
             if var_matrix is not None:
@@ -93,8 +303,7 @@ class Optimizers(Estimators):
         elif fitter == "odr":
             modelo = odr.Model(fcn = self._function4odr, 
             fjacb = odr_jacobian)
-            mydata = odr.RealData(self.axis.axis[self.channel_switches],
-            self.spectrum()[self.channel_switches],
+            mydata = odr.RealData(self._get_fitting_axis(), y,
             sx = None,
             sy = (1/weights if weights is not None else None))
             myodr = odr.ODR(mydata, modelo, beta0=self.p0[:])
@@ -103,6 +312,18 @@ class Optimizers(Estimators):
             self.p_std = myoutput.sd_beta
             self.p0 = result
             self.fit_output = myoutput
+            success = myoutput.info in (1, 2, 3)
+            
+        elif fitter == 'batch_lm':
+            self._batch_values = self._get_batch_values()
+            p, p_std, nfev, success = self._batch_fit(
+                np.array(self.p0, ndmin = 2), args[0][np.newaxis], 
+                weights = weights, grad = grad, **kwargs)
+            self.p0 = p[0]
+            self.p_std = p_std[0]
+            self.fit_output = (nfev[0], success[0])
+            success = success[0]
+            self._nfev = nfev[0]
             
         elif fitter == 'mpfit':
             autoderivative = 1
@@ -113,12 +334,17 @@ class Optimizers(Estimators):
                 self.set_mpfit_parameters_info()
             elif bounded is False:
                 self.mpfit_parinfo = None
+            # The finite differences jacobian is computed in one batch 
+            # evaluation of the model when possible
+            vectorized = autoderivative == 1 and \
+                self._variable_projection is None
             m = mpfit(self._errfunc4mpfit, self.p0[:], 
                 parinfo=self.mpfit_parinfo, functkw= {
-                'y': self.spectrum()[self.channel_switches], 
+                'y': y, 
                 'weights' :weights}, autoderivative = autoderivative,
-                quiet = 1)
+                quiet = 1, vectorized = vectorized)
             self.p0 = m.params
+            success = 0 < m.status < 5
             self.p_std = m.perror
             self.fit_output = m
             
@@ -133,7 +359,7 @@ class Optimizers(Estimators):
                 fprime = grad_ls
                         
             # OPTIMIZERS
-            
+            general = True
             # Simple (don't use gradient)
             if fitter == "fmin" :
                 self.p0 = fmin(tominimize, self.p0, args = args, **kwargs)
@@ -159,18 +385,20 @@ class Optimizers(Estimators):
                 if bounded is True:
                     self.set_boundaries()
                 elif bounded is False:
-                    self.self.free_parameters_boundaries = None
-                self.p0 = fmin_tnc(tominimize, self.p0, fprime = fprime,
-                args = args, bounds = self.free_parameters_boundaries, 
-                approx_grad = approx_grad, **kwargs)[0]
+                    self.free_parameters_boundaries = None
+                self.p0, nfeval, rc = fmin_tnc(tominimize, self.p0, 
+                fprime = fprime, args = args, approx_grad = False,
+                bounds = self.free_parameters_boundaries, **kwargs)
+                success = rc in (0, 1, 2)
             elif fitter == "l_bfgs_b":
                 if bounded is True:
                     self.set_boundaries()
                 elif bounded is False:
-                    self.self.free_parameters_boundaries = None
-                self.p0 = fmin_l_bfgs_b(tominimize, self.p0, fprime = fprime, 
-                args =  args,  bounds = self.free_parameters_boundaries, 
-                approx_grad = approx_grad, **kwargs)[0]
+                    self.free_parameters_boundaries = None
+                self.p0, f, d = fmin_l_bfgs_b(tominimize, self.p0, 
+                fprime = fprime, args =  args, approx_grad = False,
+                bounds = self.free_parameters_boundaries, **kwargs)
+                success = d['warnflag'] == 0
             else:
                 print \
                 """
@@ -179,19 +407,50 @@ class Optimizers(Estimators):
                 Available optimizers:
                 Unconstrained:
                 --------------
-                Only least Squares: leastsq and odr
+                Only least Squares: leastsq, odr and batch_lm
                 General: fmin, powell, cg, ncg, bfgs
 
                 Cosntrained:
                 ------------
                 tnc and l_bfgs_b
                 """ % fitter
+                general = False
+            # The general optimizers do not estimate the standard deviation
+            if general is True and estimate_std is True:
+                self.p_std = self.calculate_p_std(self.p0, method, *args)
                 
         
         if np.iterable(self.p0) == 0:
             self.p0 = (self.p0,)
+        if linear_parameters:
+            self._charge_p0(p_std = self.p_std)
+            self._stop_variable_projection(grad = grad)
+            self._set_p0()
+            self.p0 = np.array(self.p0)
+            self.p_std = None if self.p_std is None else np.array([
+                std for component in self if component.active 
+                for parameter in component.free_parameters 
+                for std in np.ravel(parameter.std)])
         self._charge_p0(p_std = self.p_std)
         self.set()
+        # The final cost and convergence status, which multifit stores in 
+        # fit_info. Computing the cost is not counted as a function 
+        # evaluation of the fit.
+        nfev = self._nfev + coarse_nfev
+        if compute_cost is True:
+            if method == 'ml':
+                self.fit_cost = self._poisson_likelihood_function(
+                    np.array(self.p0, dtype = 'float'), *args)
+            else:
+                self.fit_cost = self._errfunc2(np.array(self.p0, 
+                    dtype = 'float'), *args)
+            self.fit_success = bool(success) and np.isfinite(self.fit_cost)
+        else:
+            self.fit_cost = None
+            self.fit_success = bool(success)
+        self._nfev = nfev
+        if compiled is True:
+            self._evaluation_plan = None
         if ext_bounding is True:
             self._disable_ext_bounding()
         if switch_aap is True:
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# Copyright 2007-2012 The Hyperspy developers
+#
+# This file is part of  Hyperspy.
+#
+#  Hyperspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+#  Hyperspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with  Hyperspy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Synthetic Hartree-Slater GOS table and edges database used by the 
+EELSCLEdge tests."""
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from hyperspy.defaults_parser import preferences
+from hyperspy.components import eels_cl_edge
+
+nrow = 100
+ncol = 100
+onset_energy = 284.
+
+def write_gos_table(filename):
+    """Writes a GOS table in the Gatan format of the fictitious element Xx
+    that decreases smoothly with the energy and with q."""
+    info1 = (0.01, 0.1, 0.)
+    info2 = (100., 1.)
+    q = info1[0] * (np.exp(np.linspace(1, ncol, ncol) * info1[1]) - 1.) \
+        * 1e10
+    x = np.log((eels_cl_edge.a0 * q) ** 2)
+    energy = np.arange(nrow, dtype = 'float')
+    gos = np.exp(-(x + 2.) ** 2 / 8.) / (1. + 0.01 * energy[:, np.newaxis])
+    f = open(filename, 'w')
+    try:
+        f.write('Xx 0 %s %s %s %i\n' % (info1 + (ncol,)))
+        f.write('%s %s %i\n' % (info2 + (nrow,)))
+        for row in gos:
+            f.write(' '.join(['%.12e' % value for value in row]) + '\n')
+    finally:
+        f.close()
+
+def setup_edges():
+    """Creates a folder with the GOS table of the K edge of Xx and an edges
+    database that only contains it, and points the preferences and the 
+    eels_cl_edge module to them.
+    
+    Returns
+    -------
+    The state that `teardown_edges` restores.
+    
+    """
+    folder = tempfile.mkdtemp()
+    write_gos_table(os.path.join(folder, 'Xx.K1'))
+    f = open(os.path.join(folder, 'edges_db.csv'), 'w')
+    try:
+        f.write('"Xx.K1",99,%i,,"Major"\n' % onset_energy)
+    finally:
+        f.close()
+    state = (folder, preferences.EELS.eels_gos_files_path, 
+             eels_cl_edge.file_path, eels_cl_edge.cache_path, 
+             eels_cl_edge.edges_dict)
+    preferences.EELS.eels_gos_files_path = folder
+    eels_cl_edge.file_path = os.path.join(folder, 'edges_db.csv')
+    eels_cl_edge.cache_path = os.path.join(folder, 'cache')
+    eels_cl_edge.edges_dict = eels_cl_edge._EdgesDatabase()
+    return state
+    
+def teardown_edges(state):
+    folder = state[0]
+    preferences.EELS.eels_gos_files_path = state[1]
+    eels_cl_edge.file_path = state[2]
+    eels_cl_edge.cache_path = state[3]
+    eels_cl_edge.edges_dict = state[4]
+    eels_cl_edge.cross_sections.clear()
+    shutil.rmtree(folder)
+    
+def get_edge(E0 = 100e3, alpha = 10., beta = 20., energy_scale = 0.5):
+    """The K edge of Xx with the given microscope parameters."""
+    edge = eels_cl_edge.EELSCLEdge('Xx_K')
+    edge.set_microscope_parameters(E0, alpha, beta, energy_scale)
+    return edge
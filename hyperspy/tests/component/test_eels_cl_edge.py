@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+# Copyright 2007-2012 The Hyperspy developers
+#
+# This file is part of  Hyperspy.
+#
+#  Hyperspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+#  Hyperspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with  Hyperspy.  If not, see <http://www.gnu.org/licenses/>.
+
+import math
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from nose.tools import assert_true
+from scipy.interpolate import splrep, splint
+
+from hyperspy.defaults_parser import preferences
+from hyperspy.components import eels_cl_edge
+from hyperspy.components.eels_cl_edge import R, EELSCLEdge
+from hyperspy.tests.component.eels_synthetic import (setup_edges, 
+    teardown_edges, get_edge)
+
+def splint_cross_section(edge, delta, effective_angle):
+    """Integrates every row of the GOS table over q with splint, as 
+    integrategos did before the rows were integrated at once."""
+    x = edge._EELSCLEdge__logsqa0qaxis
+    sqa0qaxis = edge._EELSCLEdge__sqa0qaxis
+    gos = edge._EELSCLEdge__gos_array
+    qint = np.zeros(len(gos))
+    for i in xrange(len(gos)):
+        qtck = splrep(x, gos[i], s=0)
+        emax = edge.energyaxis[i] + edge.edgeenergy + delta
+        qa0sqmin = emax ** 2 / (4.0 * R * edge.T) + emax ** 3 / (
+            8.0 * edge.gamma ** 3.0 * R * edge.T ** 2)
+        qa0sqmax = qa0sqmin + 4.0 * edge.gamma ** 2 * (edge.T / R) * \
+            math.sin(effective_angle / 2.0) ** 2.0
+        qa0sqmin = max(qa0sqmin, sqa0qaxis[0])
+        qa0sqmax = min(qa0sqmax, sqa0qaxis[-1])
+        qint[i] = splint(math.log(qa0sqmin), math.log(qa0sqmax), qtck)
+    return qint
+
+def count_integrations(function, *args):
+    """Calls the function and returns the number of times that the GOS
+    table was integrated over q."""
+    integrate_q = EELSCLEdge.__dict__['_integrate_q']
+    calls = []
+    def counting_integrate_q(self, *args):
+        calls.append(args)
+        return integrate_q(self, *args)
+    EELSCLEdge._integrate_q = counting_integrate_q
+    try:
+        function(*args)
+    finally:
+        EELSCLEdge._integrate_q = integrate_q
+    return len(calls)
+    
+def get_eels_model():
+    from hyperspy.signals.eels import EELSSpectrum
+    from hyperspy.models.eelsmodel import EELSModel
+    s = EELSSpectrum({
+        'data' : np.ones((1, 400)), 
+        'mapped_parameters' : {'TEM' : {
+            'beam_energy' : 100e3,
+            'convergence_angle' : 10.,
+            'EELS' : {'collection_angle' : 20.}}}})
+    axis = s.axes_manager._slicing_axes[0]
+    axis.offset = 250.
+    axis.scale = 0.5
+    m = EELSModel(s, auto_background = False, auto_add_edges = False)
+    m.append(EELSCLEdge('Xx_K'))
+    return m
+
+class TestEELSCLEdge:
+    def setUp(self):
+        self.state = setup_edges()
+        
+    def tearDown(self):
+        teardown_edges(self.state)
+        
+    def test_integrate_q_equals_splint(self):
+        edge = get_edge()
+        # The last angle exceeds the maximum tabulated q in some rows
+        for delta, effective_angle in ((0., 0.02), (3.5, 0.005), 
+                                       (-2., 0.02), (0., 2.)):
+            np.testing.assert_allclose(
+                edge._integrate_q(delta, effective_angle),
+                splint_cross_section(edge, delta, effective_angle), 
+                rtol = 1e-9)
+            
+    def test_edges_database_loaded_on_first_use(self):
+        for use in (repr, len, lambda edges: edges.copy(), 
+                    lambda edges: list(edges.iterkeys()), 
+                    lambda edges: list(edges.itervalues()), 
+                    lambda edges: edges.update({})):
+            edges = eels_cl_edge._EdgesDatabase()
+            assert_true(edges._loaded is False)
+            use(edges)
+            assert_true(edges._loaded is True)
+            assert_true(edges.keys() == ['Xx'])
+        edges = eels_cl_edge._EdgesDatabase()
+        assert_true(type(edges.copy()) is dict)
+        assert_true(edges['Xx']['subshells']['K1']['onset_energy'] == 284.)
+        # The database is parsed directly, it is not cached
+        assert_true(not os.path.exists(eels_cl_edge.cache_path))
+        
+    def test_gos_table_cache_round_trip(self):
+        filename = os.path.join(preferences.EELS.eels_gos_files_path, 
+                                'Xx.K1')
+        table = eels_cl_edge.read_gos_table(filename)
+        cached = eels_cl_edge._load_cache(filename)
+        assert_true(cached is not None)
+        assert_true(not [key for key in cached 
+                         if cached[key].dtype.hasobject])
+        assert_true(str(cached['material']) == table['material'] == 'Xx')
+        for key in ('info1', 'info2', 'gos', 'energy_axis', 'q_axis'):
+            np.testing.assert_array_equal(cached[key], table[key])
+        # A new session reads the table from the cache
+        del eels_cl_edge._gos_tables[filename]
+        np.testing.assert_array_equal(
+            eels_cl_edge.read_gos_table(filename)['gos'], table['gos'])
+        # Modifying the source invalidates the cache
+        mtime = os.path.getmtime(filename) + 10.
+        os.utime(filename, (mtime, mtime))
+        assert_true(eels_cl_edge._load_cache(filename) is None)
+        
+    def test_edges_share_cross_sections(self):
+        edges = []
+        assert_true(count_integrations(lambda : edges.append(get_edge())) 
+                    == 1)
+        assert_true(count_integrations(lambda : edges.append(get_edge())) 
+                    == 0)
+        def set_delta(edge, delta):
+            edge.delta.value = delta
+            edge.integrategos(delta)
+        # The same delta within the tolerance
+        assert_true(count_integrations(set_delta, edges[1], 4e-4) == 0)
+        assert_true(count_integrations(set_delta, edges[1], 0.5) == 1)
+        assert_true(count_integrations(set_delta, edges[0], 0.5) == 0)
+        assert_true(count_integrations(get_edge, 120e3) == 1)
+        
+    def test_eels_models_share_cross_sections(self):
+        assert_true(count_integrations(get_eels_model) == 1)
+        assert_true(count_integrations(get_eels_model) == 0)
+        
+    def test_cross_sections_on_disk(self):
+        registry = eels_cl_edge.cross_sections
+        folder = tempfile.mkdtemp()
+        path, registry.path, registry.on_disk = registry.path, folder, True
+        try:
+            edge = get_edge()
+            for delta in np.linspace(0., 2., 5):
+                edge.delta.value = delta
+                edge.integrategos(delta)
+            # The new cross sections are only written by save
+            assert_true(os.listdir(folder) == [])
+            registry.save()
+            assert_true(len(os.listdir(folder)) == 5)
+            key = edge._EELSCLEdge__gos_file + ('Xx', 'K', 100e3, 10., 
+                                                20., 2000)
+            qint, goscoeff = registry.get(key)
+            # Another session reads them from disk
+            registry.clear()
+            read_qint, read_goscoeff = registry.get(key)
+            np.testing.assert_array_equal(read_qint, qint)
+            for read, written in zip(read_goscoeff, goscoeff):
+                np.testing.assert_array_equal(read, written)
+            assert_true(count_integrations(get_edge) == 0)
+            registry.save()
+            assert_true(len(os.listdir(folder)) == 5)
+        finally:
+            registry.path, registry.on_disk = path, False
+            shutil.rmtree(folder)
+            
+    def check_fs_basis(self, edge, E, coefficients):
+        start = edge.edgeenergy + edge.delta.value
+        window = (E >= start) & (E < start + edge.fs_emax)
+        fine_structure = edge._get_fs_basis(E).dot(coefficients)
+        np.testing.assert_allclose(fine_structure[window], 
+            edge._fine_structure(E[window], coefficients), rtol = 1e-10, 
+            atol = 1e-12 * np.abs(fine_structure).max())
+        assert_true((fine_structure[~window] == 0).all())
+            
+    def test_fs_basis_equals_fine_structure(self):
+        edge = get_edge()
+        edge.fs_state = True
+        edge.setfslist()
+        E = np.arange(250., 450., 0.5)
+        coefficients = np.random.RandomState(0).normal(
+            size = edge.fslist._number_of_elements)
+        for fs_mode in ('new_spline', 'spline', 'spline_times_edge'):
+            edge.fs_mode = fs_mode
+            self.check_fs_basis(edge, E, coefficients)
+        # The basis of the same energy axis is computed again when the
+        # parameters of the spline change
+        edge.fs_mode = 'spline'
+        edge.knots_factor = 0.5
+        self.check_fs_basis(edge, E, coefficients)
+        edge.energy_scale = 0.25
+        self.check_fs_basis(edge, E, coefficients)
+        edge.delta.value = 1.5
+        edge.calculate_knots()
+        edge.fs_mode = 'new_spline'
+        self.check_fs_basis(edge, E, coefficients)
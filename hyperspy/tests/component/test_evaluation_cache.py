@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+# Copyright 2007-2012 The Hyperspy developers
+#
+# This file is part of  Hyperspy.
+#
+#  Hyperspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+#  Hyperspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with  Hyperspy.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+from nose.tools import assert_true
+
+from hyperspy.components import Gaussian, Voigt
+
+x = np.linspace(-10, 10, 101)
+
+def test_cache_hit():
+    g = Gaussian()
+    result = g._function_cached(x)
+    assert_true(g._function_cached(x) is result)
+    np.testing.assert_equal(result, g.function(x))
+    
+def test_parameter_value_invalidates():
+    g = Gaussian()
+    result = g._function_cached(x)
+    g.A.value = 2.
+    new_result = g._function_cached(x)
+    assert_true(new_result is not result)
+    np.testing.assert_equal(new_result, g.function(x))
+    
+def test_axis_identity():
+    g = Gaussian()
+    result = g._function_cached(x)
+    assert_true(g._function_cached(x.copy()) is not result)
+    
+def test_attribute_invalidates():
+    v = Voigt()
+    result = v._function_cached(x)
+    # Setting the same value keeps the cache
+    v.spin_orbit_splitting = False
+    assert_true(v._function_cached(x) is result)
+    v.spin_orbit_splitting = True
+    new_result = v._function_cached(x)
+    assert_true(new_result is not result)
+    np.testing.assert_equal(new_result, v.function(x))
+    
+def test_in_place_modification():
+    g = Gaussian()
+    g.data = np.zeros(3)
+    result = g._function_cached(x)
+    version = g._state_version
+    g.data[:] = 1
+    g._clear_evaluation_cache()
+    assert_true(g._state_version > version)
+    assert_true(g._function_cached(x) is not result)
+    
+def test_voigt_shirley_background_hits_cache():
+    v = Voigt()
+    v.shirley_background.active = True
+    v.shirley_background.value = 0.1
+    result = v._function_cached(x)
+    # Storing the Shirley background in cf does not invalidate the cache
+    assert_true(v.cf.shape == x.shape)
+    assert_true(v._function_cached(x) is result)
+    
+def test_freeing_parameters_keeps_cache():
+    g = Gaussian()
+    result = g._function_cached(x)
+    g.A.free = False
+    g.A.free = True
+    assert_true(g._function_cached(x) is result)
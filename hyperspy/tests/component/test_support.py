@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+# Copyright 2007-2012 The Hyperspy developers
+#
+# This file is part of  Hyperspy.
+#
+#  Hyperspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+#  Hyperspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with  Hyperspy.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+from nose.tools import assert_true
+
+from hyperspy.components import Gaussian, Lorentzian
+from hyperspy.tests.model.synthetic import (get_model, get_values, 
+    assert_same_values)
+
+def test_support_disabled_by_default():
+    for component in (Gaussian(), Lorentzian()):
+        assert_true(component.support_widths is None)
+        assert_true(component.get_support() is None)
+        
+def test_gaussian_support():
+    g = Gaussian(A = 1., sigma = 2., centre = 5.)
+    g.support_widths = 8.
+    assert_true(g.get_support() == (-11., 21.))
+
+def test_truncated_gaussian_model():
+    m = get_model()
+    m._set_p0()
+    p0 = np.array(m.p0)
+    full = np.array(m._model_function(p0))
+    peak = m[0].A.value / (m[0].sigma.value * np.sqrt(2 * np.pi))
+    m[0].support_widths = 8.
+    truncated = np.array(m._model_function(p0))
+    assert_true(np.abs(truncated - full).max() <= 1e-13 * peak)
+    
+def test_truncated_gaussian_multifit():
+    m = get_model()
+    m.multifit(fitter = 'leastsq', grad = True)
+    full = get_values(m)
+    m = get_model()
+    m[0].support_widths = 8.
+    m.multifit(fitter = 'leastsq', grad = True)
+    assert_same_values(full, get_values(m), rtol = 1e-7)
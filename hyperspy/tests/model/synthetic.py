@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+# Copyright 2007-2012 The Hyperspy developers
+#
+# This file is part of  Hyperspy.
+#
+#  Hyperspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+#  Hyperspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with  Hyperspy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Synthetic spectrum images used by the model tests."""
+
+import numpy as np
+
+from hyperspy.signals.spectrum import Spectrum
+from hyperspy.model import Model
+from hyperspy.components import Gaussian, Offset
+
+nchannels = 200
+
+def get_gaussian_parameters(shape = (2, 3)):
+    """Returns the A, sigma, centre and offset maps used to generate the 
+    spectrum image."""
+    i = np.arange(np.prod(shape), dtype = 'float').reshape(shape)
+    A = 1000. + 100. * i
+    sigma = 8. + 0.5 * i
+    centre = 90. + 2. * i
+    offset = 5. + i
+    return A, sigma, centre, offset
+
+def get_spectrum_image(shape = (2, 3), noise = 1., seed = 0):
+    """Gaussian on a constant background with known parameters at every
+    pixel and, optionally, normal noise of the given standard deviation."""
+    A, sigma, centre, offset = [p[..., np.newaxis] for p in 
+                                get_gaussian_parameters(shape)]
+    x = np.arange(nchannels, dtype = 'float')
+    data = offset + A / (sigma * np.sqrt(2 * np.pi)) * np.exp(
+        -(x - centre) ** 2 / (2 * sigma ** 2))
+    if noise:
+        data += np.random.RandomState(seed).normal(scale = noise, 
+                                                   size = data.shape)
+    return Spectrum({'data' : data})
+
+def get_model(shape = (2, 3), noise = 1., seed = 0, set_maps = True):
+    """Gaussian + Offset model of `get_spectrum_image`. 
+    
+    The starting values are close to, but not at, the true values. If 
+    `set_maps` is True they are assigned to all the pixels.
+    
+    """
+    m = Model(get_spectrum_image(shape, noise = noise, seed = seed))
+    m.append(Gaussian(A = 900., sigma = 10., centre = 95.))
+    m.append(Offset())
+    m[1].offset.value = 4.
+    if set_maps is True:
+        assign_current_values_to_all(m)
+    return m
+    
+def assign_current_values_to_all(m):
+    for component in m:
+        for parameter in component.parameters:
+            parameter.assign_current_value_to_all()
+            
+def get_values(m):
+    """The values maps of all the parameters of the model."""
+    return dict([(parameter.name + str(i), parameter.map['values'].copy())
+                 for i, component in enumerate(m) 
+                 for parameter in component.parameters])
+                 
+def assert_same_values(values1, values2, **kwargs):
+    for name in values1:
+        np.testing.assert_allclose(values1[name], values2[name], 
+                                   err_msg = name, **kwargs)
+
+def central_jacobian(m, param, epsilon = 1e-5):
+    """The jacobian of the model function computed by central differences,
+    which are exact enough to compare with the analytical jacobian also 
+    where it vanishes."""
+    param = np.array(param, dtype = 'float')
+    jacobian = []
+    for i in xrange(len(param)):
+        h = epsilon * max(abs(param[i]), 1.)
+        p = param.copy()
+        p[i] += h
+        f1 = np.array(m._model_function(p))
+        p[i] -= 2 * h
+        f2 = np.array(m._model_function(p))
+        jacobian.append((f1 - f2) / (2 * h))
+    m._model_function(param)
+    return np.array(jacobian)
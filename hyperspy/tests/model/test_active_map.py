@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# Copyright 2007-2012 The Hyperspy developers
+#
+# This file is part of  Hyperspy.
+#
+#  Hyperspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+#  Hyperspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with  Hyperspy.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+from nose.tools import assert_true
+
+from hyperspy.tests.model.synthetic import (get_model, 
+    get_gaussian_parameters)
+
+def get_true_model():
+    """The model with the parameters used to generate the data without 
+    noise, with the gaussian inactive at (0, 1)."""
+    m = get_model(noise = 0.)
+    A, sigma, centre, offset = get_gaussian_parameters()
+    for parameter, value in ((m[0].A, A), (m[0].sigma, sigma), 
+                             (m[0].centre, centre), (m[1].offset, offset)):
+        parameter.map['values'] = value
+        parameter.map['is_set'] = True
+    m[0].active_is_multidimensional = True
+    m[0].active_map[0, 1] = False
+    return m
+
+def test_active_map_created_from_active():
+    m = get_model()
+    m[0].active = False
+    m[0].active_is_multidimensional = True
+    assert_true(m[0].active_map.shape == (2, 3))
+    assert_true(not m[0].active_map.any())
+    m[0].active_is_multidimensional = False
+    assert_true(m[0].active_map is None)
+
+def test_charge_active_map():
+    m = get_true_model()
+    m.axes_manager.set_not_slicing_indexes((0, 1))
+    assert_true(m[0].active is False)
+    m.axes_manager.set_not_slicing_indexes((1, 1))
+    assert_true(m[0].active is True)
+    # Setting active stores it in the current pixel
+    m[0].active = False
+    assert_true(not m[0].active_map[1, 1])
+    assert_true(m[0].active_map.sum() == 4)
+    
+def test_inactive_pixels_zeroed():
+    m = get_true_model()
+    m.generate_data_from_model()
+    offset = get_gaussian_parameters()[3]
+    np.testing.assert_allclose(m.model_cube[0, 1], offset[0, 1])
+    np.testing.assert_allclose(m.model_cube[1, 1], m.spectrum.data[1, 1])
+    m[0].active_map[:] = False
+    m.generate_data_from_model()
+    np.testing.assert_allclose(m.model_cube, 
+        offset[..., np.newaxis] * np.ones(m.spectrum.data.shape))
+        
+def test_multifit_inactive_pixels():
+    m = get_model()
+    m[0].active_is_multidimensional = True
+    m[0].active_map[0, 1] = False
+    # Only the offset is in the data of (0, 1)
+    m.spectrum.data[0, 1] = 5. + np.random.RandomState(0).normal(
+        size = m.spectrum.data.shape[-1])
+    A = m[0].A.map['values'].copy()
+    fit_pixel = m._fit_pixel
+    nfree = {}
+    def recording_fit_pixel(index, **kwargs):
+        fit_pixel(index, **kwargs)
+        nfree[tuple(index)] = len(m.p0)
+    m._fit_pixel = recording_fit_pixel
+    try:
+        m.multifit(fitter = 'leastsq')
+    finally:
+        del m._fit_pixel
+    assert_true(nfree.pop((0, 1)) == 1)
+    assert_true(set(nfree.values()) == set([4]))
+    # The parameters of the inactive component are not fitted
+    assert_true(m[0].A.map['values'][0, 1] == A[0, 1])
+    np.testing.assert_allclose(m[1].offset.map['values'][0, 1], 5., 
+                               atol = 0.2)
+    assert_true(m.fit_info['success'].all())
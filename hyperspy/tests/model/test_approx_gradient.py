@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+# Copyright 2007-2012 The Hyperspy developers
+#
+# This file is part of  Hyperspy.
+#
+#  Hyperspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+#  Hyperspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with  Hyperspy.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+from nose.tools import assert_true
+
+from hyperspy.tests.model.synthetic import (get_model, get_values, 
+    assert_same_values)
+
+def get_model_at_p0():
+    m = get_model(shape = (1,))
+    m._set_p0()
+    y, weights = m._get_fit_data()
+    return m, np.array(m.p0, dtype = 'float'), y
+    
+def test_approx_jacobian_equals_analytical():
+    m, p0, y = get_model_at_p0()
+    jacobian, f0 = m._approx_jacobian(p0, full_output = True)
+    np.testing.assert_allclose(jacobian, m._jacobian(p0, y), rtol = 1e-4, 
+                               atol = 1e-6)
+    np.testing.assert_allclose(f0, m._model_function(p0))
+    
+def check_approx_gradient_ls(weights):
+    m, p0, y = get_model_at_p0()
+    m._nfev = 0
+    gradient = m._approx_gradient_ls(p0, y, weights)
+    # One vectorized evaluation of the displaced parameters and p0
+    assert_true(m._nfev == len(p0) + 1)
+    residual = m._model_function(p0) - y
+    jacobian = m._jacobian(p0, y)
+    if weights is not None:
+        residual = residual * weights
+        jacobian = jacobian * weights
+    np.testing.assert_allclose(gradient, 
+        (2 * residual * jacobian).sum(1), rtol = 1e-4)
+        
+def test_approx_gradient_ls():
+    for weights in (None, np.linspace(0.5, 2., 200)):
+        yield check_approx_gradient_ls, weights
+        
+def test_approx_gradient_ml():
+    m, p0, y = get_model_at_p0()
+    m._nfev = 0
+    gradient = m._approx_gradient_ml(p0, y)
+    assert_true(m._nfev == len(p0) + 1)
+    np.testing.assert_allclose(gradient, m._gradient_ml(p0, y), rtol = 1e-4)
+    
+def check_fitter(fitter):
+    m = get_model(shape = (1,))
+    m.fit(fitter = 'leastsq', grad = True)
+    reference = get_values(m)
+    m = get_model(shape = (1,))
+    m.fit(fitter = fitter)
+    # The order of p0 depends on the free_parameters sets of every 
+    # instance, therefore the parameters are compared by name
+    assert_same_values(reference, get_values(m), rtol = 1e-3)
+    
+def test_gradient_fitters_without_grad():
+    for fitter in ('leastsq', 'tnc', 'l_bfgs_b', 'bfgs'):
+        yield check_fitter, fitter
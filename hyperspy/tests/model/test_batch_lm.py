@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+# Copyright 2007-2012 The Hyperspy developers
+#
+# This file is part of  Hyperspy.
+#
+#  Hyperspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+#  Hyperspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with  Hyperspy.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+from nose.tools import assert_true
+
+from hyperspy.tests.model.synthetic import (get_model, get_values, 
+    assert_same_values, nchannels)
+
+def test_batch_lm_equals_leastsq():
+    m = get_model()
+    m.multifit(fitter = 'leastsq')
+    leastsq = get_values(m)
+    m = get_model()
+    m.multifit(fitter = 'batch_lm')
+    assert_same_values(leastsq, get_values(m), rtol = 1e-5)
+    assert_true(m.fit_info['success'].all())
+    
+def test_batch_lm_equals_leastsq_grad():
+    m = get_model()
+    m.multifit(fitter = 'leastsq', grad = True)
+    leastsq = get_values(m)
+    m = get_model()
+    m.multifit(fitter = 'batch_lm', grad = True, batch_size = 4)
+    assert_same_values(leastsq, get_values(m), rtol = 1e-5)
+    
+def test_evaluate_batch_falls_back_to_rows():
+    m = get_model()
+    gaussian = m[0]
+    x = np.arange(nchannels, dtype = 'float')
+    values = {gaussian.A : np.array([[1.], [2.], [3.]])}
+    m._charge_batch_values(values)
+    # A function that ignores the rows must be evaluated row by row
+    function = lambda x: np.ones(len(x)) * np.mean(gaussian.A.value)
+    result = m._evaluate_batch(function, x, values, 3)
+    np.testing.assert_equal(result[:, 0], [1., 2., 3.])
+    # A function that raises a different exception is not hidden
+    def function(x):
+        raise RuntimeError
+    try:
+        m._evaluate_batch(function, x, values, 3)
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError("RuntimeError not raised")
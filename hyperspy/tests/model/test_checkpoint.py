@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+# Copyright 2007-2012 The Hyperspy developers
+#
+# This file is part of  Hyperspy.
+#
+#  Hyperspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+#  Hyperspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with  Hyperspy.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_true
+from nose.plugins.skip import SkipTest
+
+from hyperspy import model
+from hyperspy.tests.model.synthetic import (get_model, get_values, 
+    assert_same_values)
+
+def interrupted_multifit(m, npixels, **kwargs):
+    """Run multifit raising KeyboardInterrupt after fitting npixels."""
+    fit_pixel = m._fit_pixel
+    fitted = []
+    def interrupted_fit_pixel(index, **kwargs):
+        if len(fitted) == npixels:
+            raise KeyboardInterrupt
+        fit_pixel(index, **kwargs)
+        fitted.append(index)
+    m._fit_pixel = interrupted_fit_pixel
+    try:
+        m.multifit(**kwargs)
+    except KeyboardInterrupt:
+        pass
+    else:
+        raise AssertionError("multifit was not interrupted")
+    finally:
+        del m._fit_pixel
+    return fitted
+
+class TestResume:
+    def setUp(self):
+        if model.h5py is None:
+            raise SkipTest("h5py is not installed")
+        self.folder = tempfile.mkdtemp()
+        self.filename = os.path.join(self.folder, 'checkpoint.hdf5')
+        
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+        
+    def test_resumed_equals_uninterrupted(self):
+        m = get_model()
+        m.multifit(fitter = 'leastsq')
+        reference = get_values(m)
+        m = get_model()
+        fitted = interrupted_multifit(m, 3, fitter = 'leastsq', 
+                                      resume = self.filename)
+        assert_true(os.path.exists(self.filename))
+        f = model.h5py.File(self.filename, mode = 'r')
+        try:
+            # Only the fitted pixels are recorded, although the parameters
+            # of all the pixels were set before fitting
+            recorded = f['fitted'][...].reshape((2, 3))
+        finally:
+            f.close()
+        assert_true(recorded.sum() == 3)
+        assert_true(all([recorded[index] for index in fitted]))
+        m = get_model()
+        m.multifit(fitter = 'leastsq', resume = self.filename)
+        assert_same_values(reference, get_values(m))
+        assert_true(m.fit_info['success'].all())
+        # The file is kept and records all the pixels
+        f = model.h5py.File(self.filename, mode = 'r')
+        try:
+            assert_true(f['fitted'][...].all())
+        finally:
+            f.close()
+            
+    def test_checkpoint_closed_on_error(self):
+        m = get_model()
+        try:
+            m.multifit(fitter = 'leastsq', resume = self.filename, 
+                       warm_start = 'unknown')
+        except ValueError:
+            pass
+        assert_true(m._checkpoint is None)
+        # The file can be opened again
+        m.multifit(fitter = 'leastsq', resume = self.filename)
+        assert_true(m.fit_info['success'].all())
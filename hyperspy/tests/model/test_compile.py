@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+# Copyright 2007-2012 The Hyperspy developers
+#
+# This file is part of  Hyperspy.
+#
+#  Hyperspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+#  Hyperspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with  Hyperspy.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+from nose.tools import assert_true
+
+from hyperspy.tests.model.synthetic import (get_model, get_values, 
+    assert_same_values)
+
+def count_compilations(m):
+    calls = []
+    compile_ = m._compile
+    def counted_compile(plans):
+        calls.append(plans)
+        compile_(plans)
+    m._compile = counted_compile
+    return calls
+
+def test_compiled_equals_uncompiled():
+    m = get_model()
+    m._set_p0()
+    p0 = np.array(m.p0)
+    y = m.spectrum()
+    model = np.array(m._model_function(p0))
+    jacobian = np.array(m._jacobian(p0, y))
+    m.compile()
+    assert_true(m._get_evaluation_plan() is not None)
+    np.testing.assert_allclose(m._model_function(p0), model)
+    np.testing.assert_allclose(m._jacobian(p0, y), jacobian)
+    
+def test_plans_are_kept_per_configuration():
+    m = get_model()
+    m.compile()
+    plan = m._get_evaluation_plan()
+    m[0].A.free = False
+    fixed_plan = m._get_evaluation_plan()
+    assert_true(fixed_plan is not plan)
+    assert_true(len(fixed_plan['index']) == len(plan['index']) - 1)
+    m[0].A.free = True
+    assert_true(m._get_evaluation_plan() is plan)
+    m[0].A.free = False
+    assert_true(m._get_evaluation_plan() is fixed_plan)
+    # Changing a twin discards all the plans
+    m[0].A.free = True
+    m[1].offset.twin = m[0].A
+    assert_true(m._get_evaluation_plan() is None)
+    
+def test_multifit_compiles_once_per_configuration():
+    m = get_model()
+    calls = count_compilations(m)
+    m.multifit(fitter = 'leastsq', linear_parameters = 'auto')
+    # The full configuration and the one of the variable projection
+    assert_true(len(calls) == 2)
+    assert_true(m._evaluation_plan is None)
+    
+def test_multifit_compiled_results():
+    m = get_model()
+    m.multifit(fitter = 'leastsq', linear_parameters = 'auto')
+    compiled = get_values(m)
+    m = get_model()
+    m.compile = lambda : None
+    m.multifit(fitter = 'leastsq', linear_parameters = 'auto')
+    assert_same_values(compiled, get_values(m), rtol = 1e-6)
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+# Copyright 2007-2012 The Hyperspy developers
+#
+# This file is part of  Hyperspy.
+#
+#  Hyperspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+#  Hyperspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with  Hyperspy.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+from nose.tools import assert_true
+
+from hyperspy.signals.spectrum import Spectrum
+from hyperspy.tests.model.synthetic import get_model
+
+def get_convolved_model():
+    m = get_model()
+    x = np.arange(31, dtype = 'float')
+    low_loss = np.exp(-(x - 10.) ** 2 / 8.) * np.arange(1, 7).reshape(
+        (2, 3, 1))
+    m.low_loss = Spectrum({'data' : low_loss})
+    return m
+
+def test_convolve_equals_np_convolve():
+    m = get_convolved_model()
+    array = np.random.RandomState(0).random_sample(
+        (4, len(m.convolution_axis)))
+    low_loss = m.low_loss(m.axes_manager)
+    convolved = m._convolve(array)
+    assert_true(convolved.shape == (4, m.axis.size))
+    for row, result in zip(array, convolved):
+        np.testing.assert_allclose(result, 
+            np.convolve(low_loss, row, mode = 'valid'), atol = 1e-10)
+        
+def test_convolve_low_loss_argument():
+    m = get_convolved_model()
+    array = np.random.RandomState(1).random_sample(
+        (6, len(m.convolution_axis)))
+    low_loss = m.low_loss.data.reshape((6, -1))
+    convolved = m._convolve(array, low_loss = low_loss)
+    for i in xrange(6):
+        np.testing.assert_allclose(convolved[i], 
+            np.convolve(low_loss[i], array[i], mode = 'valid'), atol = 1e-10)
+            
+def test_low_loss_fft_follows_coordinates():
+    m = get_convolved_model()
+    array = np.random.RandomState(2).random_sample(len(m.convolution_axis))
+    for index in ((0, 0), (1, 2)):
+        m.axes_manager.set_not_slicing_indexes(index)
+        np.testing.assert_allclose(m._convolve(array), np.convolve(
+            m.low_loss.data[index], array, mode = 'valid'), atol = 1e-10)
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+# Copyright 2007-2012 The Hyperspy developers
+#
+# This file is part of  Hyperspy.
+#
+#  Hyperspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+#  Hyperspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with  Hyperspy.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+from nose.tools import assert_true
+
+from hyperspy.signals.spectrum import Spectrum
+from hyperspy.tests.model.synthetic import (get_model, 
+    get_gaussian_parameters)
+
+def get_true_model():
+    """The model with the parameters used to generate the data without 
+    noise."""
+    m = get_model(noise = 0.)
+    A, sigma, centre, offset = get_gaussian_parameters()
+    for parameter, value in ((m[0].A, A), (m[0].sigma, sigma), 
+                             (m[0].centre, centre), (m[1].offset, offset)):
+        parameter.map['values'] = value
+        parameter.map['is_set'] = True
+    return m
+    
+def get_pixel_by_pixel(m):
+    result = np.empty(m.spectrum.data.shape)
+    for index in np.ndindex(result.shape[:-1]):
+        m.axes_manager.set_not_slicing_indexes(index)
+        # The indexes may not change, e.g. at the first pixel, in which 
+        # case the model is not charged
+        m.charge()
+        result[index] = m.__call__(onlyactive = True)
+    return result
+
+def check_generate_data(batch_size, parallel):
+    m = get_true_model()
+    m.generate_data_from_model(batch_size = batch_size, parallel = parallel)
+    np.testing.assert_allclose(m.model_cube, m.spectrum.data)
+    
+def test_generate_data_equals_data():
+    for batch_size in (1, 2, 4, 1024):
+        for parallel in (False, True):
+            yield check_generate_data, batch_size, parallel
+            
+def test_generate_data_channel_switches():
+    m = get_true_model()
+    m.channel_switches[:10] = False
+    m.generate_data_from_model()
+    assert_true(np.isnan(m.model_cube[..., :10]).all())
+    np.testing.assert_allclose(m.model_cube[..., 10:], 
+                               m.spectrum.data[..., 10:])
+    out = np.empty(m.spectrum.data.shape)
+    m.generate_data_from_model(out_of_range_to_nan = False, out = out)
+    np.testing.assert_allclose(out, m.spectrum.data)
+    
+def test_generate_data_equals_pixel_by_pixel():
+    m = get_true_model()
+    m[0].active_is_multidimensional = True
+    m[0].active_map[0, 1] = False
+    x = np.arange(31, dtype = 'float')
+    m.low_loss = Spectrum({'data' : np.exp(-(x - 10.) ** 2 / 8.) * 
+                           np.arange(1, 7).reshape((2, 3, 1))})
+    m.generate_data_from_model(batch_size = 4)
+    np.testing.assert_allclose(m.model_cube, get_pixel_by_pixel(m))
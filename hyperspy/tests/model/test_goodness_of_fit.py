@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+# Copyright 2007-2012 The Hyperspy developers
+#
+# This file is part of  Hyperspy.
+#
+#  Hyperspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+#  Hyperspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with  Hyperspy.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+from nose.tools import assert_true
+
+from hyperspy.tests.model.synthetic import get_model, nchannels
+
+def get_fitted_model():
+    m = get_model()
+    m.multifit(fitter = 'leastsq')
+    # Non trivial variance
+    m.spectrum.variance = np.abs(m.spectrum.data) + 1.
+    return m
+    
+def test_goodness_of_fit_equals_hand_computed():
+    m = get_fitted_model()
+    m.channel_switches[:5] = False
+    chisq, red_chisq, rms = m.compute_goodness_of_fit(batch_size = 4)
+    switches = m.channel_switches
+    for index in np.ndindex((2, 3)):
+        m.axes_manager.set_not_slicing_indexes(index)
+        m.charge()
+        # The model is only evaluated in the channels that are switched on
+        residual = m.spectrum.data[index][switches] - m.__call__(
+            onlyactive = True)
+        expected = (residual ** 2 / m.spectrum.variance[index][switches]
+                    ).sum()
+        np.testing.assert_allclose(chisq.data[index], expected)
+        np.testing.assert_allclose(red_chisq.data[index], 
+                                   expected / (nchannels - 5 - 4))
+        np.testing.assert_allclose(rms.data[index], 
+                                   np.sqrt((residual ** 2).mean()))
+    assert_true(m.chisq is chisq)
+    
+def test_degrees_of_freedom_active_map():
+    m = get_fitted_model()
+    m[0].active_is_multidimensional = True
+    m[0].active_map[1, 2] = False
+    chisq, red_chisq, rms = m.compute_goodness_of_fit()
+    dof = (chisq.data / red_chisq.data)
+    # The gaussian has three free parameters and the offset one
+    expected = np.ones((2, 3)) * (nchannels - 4)
+    expected[1, 2] = nchannels - 1
+    np.testing.assert_allclose(dof, expected)
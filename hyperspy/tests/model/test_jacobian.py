@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+# Copyright 2007-2012 The Hyperspy developers
+#
+# This file is part of  Hyperspy.
+#
+#  Hyperspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+#  Hyperspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with  Hyperspy.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+from nose.tools import assert_true
+
+from hyperspy.tests.model.synthetic import get_model, central_jacobian
+
+def test_jacobian_equals_finite_differences():
+    m = get_model()
+    m._set_p0()
+    y = m.spectrum()[m.channel_switches]
+    grad = np.array(m._jacobian(m.p0, y))
+    np.testing.assert_allclose(grad, central_jacobian(m, m.p0), 
+                               rtol = 1e-4, atol = 1e-6)
+    
+def test_jacobian_weights():
+    m = get_model()
+    m._set_p0()
+    y = m.spectrum()[m.channel_switches]
+    weights = np.linspace(0.5, 2., len(y))
+    grad = np.array(m._jacobian(m.p0, y))
+    np.testing.assert_allclose(m._jacobian(m.p0, y, weights), 
+                               grad * weights)
+    
+def test_jacobian_buffer_is_reused():
+    m = get_model()
+    m._set_p0()
+    y = m.spectrum()[m.channel_switches]
+    grad = m._jacobian(m.p0, y)
+    assert_true(m._jacobian(m.p0, y) is grad)
+    # The buffer is reallocated when the number of free parameters changes
+    m[1].offset.free = False
+    m._set_p0()
+    grad = m._jacobian(m.p0, y)
+    assert_true(grad.shape == (3, len(y)))
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+# Copyright 2007-2012 The Hyperspy developers
+#
+# This file is part of  Hyperspy.
+#
+#  Hyperspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+#  Hyperspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with  Hyperspy.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+
+from hyperspy.tests.model.synthetic import (get_model, get_values, 
+    assert_same_values, get_gaussian_parameters)
+
+def get_linear_model():
+    m = get_model()
+    A, sigma, centre, offset = get_gaussian_parameters()
+    # Only the linear parameters are free
+    m[0].sigma.free = False
+    m[0].centre.free = False
+    m[0].sigma.map['values'] = sigma
+    m[0].centre.map['values'] = centre
+    return m
+    
+def test_linear_equals_nonlinear():
+    m = get_linear_model()
+    m.multifit(fitter = 'leastsq')
+    nonlinear = get_values(m)
+    m = get_linear_model()
+    m.multifit(linear = True)
+    assert_same_values(nonlinear, get_values(m), rtol = 1e-6)
+    
+def test_linear_weights():
+    weights = np.linspace(0.5, 2., 200) * np.ones((2, 3, 200))
+    m = get_linear_model()
+    m.multifit(fitter = 'leastsq', weights = weights)
+    nonlinear = get_values(m)
+    m = get_linear_model()
+    m.multifit(linear = True, weights = weights)
+    assert_same_values(nonlinear, get_values(m), rtol = 1e-6)
+    
+def test_linear_falls_back_to_leastsq():
+    # sigma and centre are not linear
+    m = get_model()
+    m.multifit(fitter = 'leastsq')
+    nonlinear = get_values(m)
+    m = get_model()
+    m.multifit(linear = True)
+    assert_same_values(nonlinear, get_values(m), rtol = 1e-5)
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+# Copyright 2007-2012 The Hyperspy developers
+#
+# This file is part of  Hyperspy.
+#
+#  Hyperspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+#  Hyperspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with  Hyperspy.  If not, see <http://www.gnu.org/licenses/>.
+
+from nose.tools import assert_true
+
+from hyperspy.tests.model.synthetic import (get_model, get_values, 
+    assert_same_values)
+
+def test_parallel_equals_serial():
+    m = get_model()
+    m.multifit(fitter = 'leastsq')
+    serial = get_values(m)
+    m = get_model()
+    m.multifit(fitter = 'leastsq', parallel = True, max_workers = 2)
+    assert_same_values(serial, get_values(m))
+    assert_true(m.fit_info['success'].all())
+    
+def test_parallel_equals_serial_binned_warm_start():
+    m = get_model(shape = (4, 4))
+    m.multifit(fitter = 'leastsq', warm_start = 'binned')
+    serial = get_values(m)
+    m = get_model(shape = (4, 4))
+    m.multifit(fitter = 'leastsq', warm_start = 'binned', parallel = True,
+               max_workers = 2)
+    assert_same_values(serial, get_values(m))
+    
+def test_parallel_falls_back_to_serial():
+    # The starting values of the first pixel of every chunk would differ
+    # from the serial ones, therefore the pixels are fitted serially
+    m = get_model(set_maps = False)
+    indexes = m._get_scan_indexes('C', None)
+    assert_true(not m._are_start_values_defined(indexes))
+    m.multifit(fitter = 'leastsq')
+    serial = get_values(m)
+    m = get_model(set_maps = False)
+    m.multifit(fitter = 'leastsq', parallel = True, max_workers = 2)
+    assert_same_values(serial, get_values(m))
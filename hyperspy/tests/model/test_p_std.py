@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+# Copyright 2007-2012 The Hyperspy developers
+#
+# This file is part of  Hyperspy.
+#
+#  Hyperspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+#  Hyperspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with  Hyperspy.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+from nose.tools import assert_true
+
+from hyperspy.tests.model.synthetic import get_model
+
+def get_fitted_model():
+    m = get_model(shape = (1,))
+    m.fit(fitter = 'leastsq', grad = True)
+    return m
+
+def check_fisher_information_std(grad):
+    m = get_fitted_model()
+    if grad is False:
+        # Use the finite differences jacobian
+        m[0].A.grad = None
+    y, weights = m._get_fit_data()
+    std = m.calculate_p_std(np.array(m.p0), 'ls', y)
+    np.testing.assert_allclose(std, m.p_std, rtol = 1e-3)
+    
+def test_fisher_information_std_equals_leastsq():
+    for grad in (True, False):
+        yield check_fisher_information_std, grad
+        
+def test_weights():
+    m = get_fitted_model()
+    y, weights = m._get_fit_data()
+    weights = np.ones(len(y)) * 2.
+    std = m.calculate_p_std(np.array(m.p0), 'ls', y, weights)
+    np.testing.assert_allclose(std, m.p_std / 2., rtol = 1e-3)
+    
+def test_general_optimizer_std():
+    m = get_fitted_model()
+    leastsq_std = m.p_std
+    m.fit(fitter = 'bfgs', grad = True, estimate_std = True)
+    np.testing.assert_allclose(m.p_std, leastsq_std, rtol = 1e-2)
+    # Opt-in, as in multifit
+    m.fit(fitter = 'bfgs', grad = True)
+    assert_true(m.p_std is None)
+    
+def test_fit_cost_opt_in():
+    m = get_fitted_model()
+    assert_true(m.fit_cost is None)
+    assert_true(m.fit_success is True)
+    m.fit(fitter = 'leastsq', grad = True, compute_cost = True)
+    y, weights = m._get_fit_data()
+    np.testing.assert_allclose(m.fit_cost, 
+        m._errfunc2(np.array(m.p0, dtype = 'float'), y, weights))
+    
+def test_multifit_estimate_std_opt_in():
+    m = get_model()
+    m.multifit(fitter = 'bfgs', grad = True)
+    assert_true(np.isnan(m[0].A.map['std']).all())
+    m = get_model()
+    m.multifit(fitter = 'bfgs', grad = True, estimate_std = True)
+    assert_true(np.isfinite(m[0].A.map['std']).all())
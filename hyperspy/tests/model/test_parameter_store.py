@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+# Copyright 2007-2012 The Hyperspy developers
+#
+# This file is part of  Hyperspy.
+#
+#  Hyperspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+#  Hyperspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with  Hyperspy.  If not, see <http://www.gnu.org/licenses/>.
+
+from nose.tools import assert_true
+
+from hyperspy.components import Gaussian, Polynomial
+from hyperspy.tests.model.synthetic import get_model
+
+def test_maps_are_views_of_the_store():
+    m = get_model()
+    store = m._get_parameter_store()
+    m[0].A.map['values'][1, 2] = 123.
+    assert_true(store['values'][1, 2, m[0].A._store_offset] == 123.)
+    m.axes_manager.set_not_slicing_indexes((1, 2))
+    assert_true(m[0].A.value == 123.)
+    
+def test_charge_only_fixed():
+    m = get_model()
+    m[0].sigma.free = False
+    m[0].sigma.map['values'][1, 1] = 7.
+    m[0].A.map['values'][1, 1] = 7.
+    m.axes_manager.set_not_slicing_indexes((1, 1))
+    m[0].A.value = 1.
+    m[0].sigma.value = 1.
+    m.charge(only_fixed = True)
+    assert_true(m[0].sigma.value == 7.)
+    assert_true(m[0].A.value == 1.)
+    m.charge()
+    assert_true(m[0].A.value == 7.)
+    
+def test_twins_after_rebuild():
+    m = get_model()
+    g = Gaussian()
+    m.append(g)
+    g.A.twin = m[0].A
+    m[0].A.value = 10.
+    assert_true(g.A.value == 10.)
+    values = m._get_store_values()
+    assert_true(values[g.A._store_offset] == 10.)
+    # Rebuild the store by appending a component
+    m.append(Gaussian())
+    m._get_parameter_store()
+    m[0].A.value = 20.
+    assert_true(g.A.value == 20.)
+    assert_true(m._get_store_values()[g.A._store_offset] == 20.)
+    # Untwinning restores the own value of the parameter
+    g.A.twin = None
+    m[0].A.value = 30.
+    assert_true(g.A.value != 30.)
+    
+def test_ext_bounded():
+    m = get_model()
+    m._get_parameter_store()
+    A = m[0].A
+    A.ext_bounded = True
+    A.bmin = 0.
+    A.value = -5.
+    assert_true(A.value == 0.)
+    assert_true(m._parameter_values[A._store_offset] == 0.)
+    
+def test_charge_bounded_and_connected():
+    m = get_model()
+    A, centre = m[0].A, m[0].centre
+    A.map['values'][0, 1] = -5.
+    centre.map['values'][0, 1] = 80.
+    A.ext_bounded = True
+    A.bmin = 0.
+    charged = []
+    centre.connect(lambda : charged.append(centre.value))
+    centre.connection_active = True
+    m.axes_manager.set_not_slicing_indexes((0, 1))
+    m.charge()
+    # The values are clipped and the connected functions are called as
+    # when they are set through the value property
+    assert_true(A.value == 0.)
+    assert_true(m._parameter_values[A._store_offset] == 0.)
+    assert_true(charged[-1] == 80.)
+    assert_true(m[0].sigma.value == m[0].sigma.map['values'][0, 1])
+    
+def test_component_removal():
+    m = get_model()
+    m[0].A.map['values'][0, 1] = 55.
+    m[1].offset.value = 3.
+    m._get_parameter_store()
+    offset = m[1]
+    m.remove(offset)
+    # The removed parameters keep their value outside of the store
+    assert_true(offset.offset._store_model is None)
+    assert_true(offset.offset.value == 3.)
+    offset.offset.value = 4.
+    assert_true(offset.offset.value == 4.)
+    # The maps of the other parameters are kept
+    m._get_parameter_store()
+    assert_true(m[0].A.map['values'][0, 1] == 55.)
+    assert_true(len(m._store_parameters) == 3)
+    # Binding it again
+    m.append(offset)
+    m._get_parameter_store()
+    assert_true(offset.offset._store_model is m)
+    assert_true(offset.offset.value == 4.)
+    assert_true(m[0].A.map['values'][0, 1] == 55.)
+    
+def test_number_of_elements_change():
+    m = get_model()
+    polynomial = Polynomial(order = 1)
+    m.append(polynomial)
+    m.append(Gaussian(A = 2., sigma = 3., centre = 4.))
+    polynomial.coefficients.value = [1., 2.]
+    m._get_parameter_store()
+    # The same steps as changing the order of the polynomial
+    coefficients = polynomial.coefficients
+    coefficients._number_of_elements = 4
+    coefficients.value = [1., 2., 3., 4.]
+    coefficients.create_array(m.axes_manager.navigation_shape)
+    m._get_parameter_store()
+    assert_true(coefficients.value == [1., 2., 3., 4.])
+    assert_true(m[3].A.value == 2.)
+    assert_true(m[3].sigma.value == 3.)
+    assert_true(m[3].centre.value == 4.)
+    assert_true(len(m._parameter_values) == 3 + 1 + 4 + 3)
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# Copyright 2007-2012 The Hyperspy developers
+#
+# This file is part of  Hyperspy.
+#
+#  Hyperspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+#  Hyperspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with  Hyperspy.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+from nose.tools import assert_true
+
+from hyperspy.tests.model.synthetic import get_model
+
+def fitted_pixels(m, **kwargs):
+    """Run multifit and return the indexes of the pixels it fitted."""
+    fit_pixel = m._fit_pixel
+    fitted = []
+    def recording_fit_pixel(index, **kwargs):
+        fitted.append(tuple(index))
+        fit_pixel(index, **kwargs)
+    m._fit_pixel = recording_fit_pixel
+    try:
+        m.multifit(fitter = 'leastsq', **kwargs)
+    finally:
+        del m._fit_pixel
+    return fitted
+    
+def count_configuration_hashes(m, **kwargs):
+    """Run multifit and return the number of configuration hashes it 
+    computed."""
+    get_configuration_hash = m._get_configuration_hash
+    calls = []
+    def counting_get_configuration_hash():
+        calls.append(None)
+        return get_configuration_hash()
+    m._get_configuration_hash = counting_get_configuration_hash
+    try:
+        m.multifit(fitter = 'leastsq', **kwargs)
+    finally:
+        del m._get_configuration_hash
+    return len(calls)
+
+def test_hashes_not_stored_by_default():
+    m = get_model()
+    assert_true(count_configuration_hashes(m) == 0)
+    assert_true((m.fit_info['hash'] == '').all())
+    
+def test_configuration_hashed_once():
+    m = get_model()
+    assert_true(count_configuration_hashes(m, only = 'failed') == 1)
+    assert_true((m.fit_info['hash'] != '').all())
+    # The same hash selects the changed pixels and is stored for them
+    m.spectrum.data[1, 2] += 10.
+    assert_true(count_configuration_hashes(m, only = 'changed') == 1)
+    # Also when there are no pixels to refit
+    assert_true(count_configuration_hashes(m, only = 'changed') == 1)
+    
+def test_only_failed():
+    m = get_model()
+    assert_true(len(fitted_pixels(m, only = 'failed')) == 6)
+    m.fit_info['success'][0, 1] = False
+    assert_true(fitted_pixels(m, only = 'failed') == [(0, 1)])
+    
+def test_only_changed_data():
+    m = get_model()
+    fitted_pixels(m, only = 'failed')
+    assert_true(fitted_pixels(m, only = 'changed') == [])
+    m.spectrum.data[1, 2] += 10.
+    assert_true(fitted_pixels(m, only = 'changed') == [(1, 2)])
+    assert_true(fitted_pixels(m, only = 'changed') == [])
+    
+def test_only_changed_fixed_parameter():
+    m = get_model()
+    fitted_pixels(m, only = 'failed')
+    offset = m[1].offset
+    offset.free = False
+    # The configuration changed
+    assert_true(len(fitted_pixels(m, only = 'changed')) == 6)
+    offset.map['values'][0, 2] += 1.
+    assert_true(fitted_pixels(m, only = 'changed') == [(0, 2)])
+    
+def test_unhashed_pixels_are_changed():
+    m = get_model()
+    m.multifit(fitter = 'leastsq')
+    assert_true(len(fitted_pixels(m, only = 'changed')) == 6)
+    
+def test_only_mask():
+    m = get_model()
+    only = np.zeros((2, 3), dtype = 'bool')
+    only[1, 0] = only[0, 2] = True
+    assert_true(sorted(fitted_pixels(m, only = only)) == [(0, 2), (1, 0)])
+    mask = np.zeros((2, 3), dtype = 'bool')
+    mask[1, 0] = True
+    assert_true(fitted_pixels(m, only = only, mask = mask) == [(0, 2)])
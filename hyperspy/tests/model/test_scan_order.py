@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+# Copyright 2007-2012 The Hyperspy developers
+#
+# This file is part of  Hyperspy.
+#
+#  Hyperspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+#  Hyperspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with  Hyperspy.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+from nose.tools import assert_true
+
+from hyperspy.model import _serpentine_indexes, _hilbert_indexes
+from hyperspy.tests.model.synthetic import (get_model, get_values, 
+    assert_same_values)
+
+def check_visits_every_index_once(function, shape):
+    indexes = function(shape)
+    assert_true(len(indexes) == np.prod(shape))
+    assert_true(sorted(indexes) == list(np.ndindex(shape)))
+    
+def check_neighbours(function, shape):
+    indexes = np.array(function(shape))
+    assert_true((np.abs(np.diff(indexes, axis = 0)).sum(1) == 1).all())
+        
+def test_scan_orders():
+    for shape in ((5,), (3, 4), (4, 4), (7, 3), (1, 6), (2, 3, 4)):
+        yield check_visits_every_index_once, _serpentine_indexes, shape
+        yield check_neighbours, _serpentine_indexes, shape
+    for shape in ((3, 4), (4, 4), (7, 3), (1, 6), (8, 8), (5, 9)):
+        yield check_visits_every_index_once, _hilbert_indexes, shape
+    # In a square of power of two side the Hilbert curve only moves to
+    # neighbours
+    for shape in ((2, 2), (4, 4), (8, 8)):
+        yield check_neighbours, _hilbert_indexes, shape
+        
+def test_scan_indexes_mask():
+    m = get_model()
+    mask = np.zeros((2, 3), dtype = 'bool')
+    mask[0, 1] = True
+    for scan_order in ('C', 'serpentine', 'hilbert'):
+        indexes = m._get_scan_indexes(scan_order, mask)
+        assert_true(len(indexes) == 5)
+        assert_true((0, 1) not in indexes)
+        
+def check_scan_order_result(scan_order, warm_start):
+    m = get_model(shape = (4, 4))
+    m.multifit(fitter = 'leastsq')
+    reference = get_values(m)
+    m = get_model(shape = (4, 4), set_maps = False)
+    m.multifit(fitter = 'leastsq', scan_order = scan_order, 
+               warm_start = warm_start)
+    assert_same_values(reference, get_values(m), rtol = 1e-4)
+    assert_true(m.fit_info['success'].all())
+        
+def test_scan_orders_and_warm_starts_converge():
+    for scan_order in ('C', 'serpentine', 'hilbert'):
+        for warm_start in ('previous', 'neighbours', 'binned'):
+            yield check_scan_order_result, scan_order, warm_start
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# Copyright 2007-2012 The Hyperspy developers
+#
+# This file is part of  Hyperspy.
+#
+#  Hyperspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+#  Hyperspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with  Hyperspy.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+from nose.tools import assert_true
+
+from hyperspy.tests.model.synthetic import get_model, nchannels
+
+def get_parameter_values(m):
+    return np.array([parameter.value for component in m 
+                     for parameter in component.parameters])
+                     
+def get_binned_problem(m, factor):
+    """Returns the data, weights and axis that `_fit_signal_binned` 
+    fits, without fitting."""
+    problem = {}
+    def fit(**kwargs):
+        problem['data'], problem['weights'] = m._get_fit_data(
+            kwargs.get('weights'))
+        problem['axis'] = m._get_fitting_axis()
+    m.fit = fit
+    try:
+        m._fit_signal_binned(factor, weights = np.ones(
+            m.spectrum.data.shape))
+    finally:
+        del m.fit
+    return problem
+
+def test_binned_problem():
+    m = get_model(shape = (1,))
+    m.axes_manager.set_not_slicing_indexes((0,))
+    # 200 channels in 66 bins of 3 channels, the last 2 channels are 
+    # dropped
+    problem = get_binned_problem(m, 3)
+    data = m.spectrum()[:198].reshape((66, 3))
+    np.testing.assert_allclose(problem['data'], data.mean(-1))
+    np.testing.assert_allclose(problem['axis'], 
+                               np.arange(198.).reshape((66, 3)).mean(-1))
+    # The weights of the mean of 3 channels of unit weight
+    np.testing.assert_allclose(problem['weights'], np.sqrt(3.))
+    # The binned problem is only used while fitting
+    assert_true(m._signal_binning is None)
+    assert_true(len(m._get_fitting_axis()) == nchannels)
+    
+def test_binned_problem_channel_switches():
+    m = get_model(shape = (1,))
+    m.axes_manager.set_not_slicing_indexes((0,))
+    m.channel_switches[10] = False
+    problem = get_binned_problem(m, 4)
+    # The bin of channels 8-11 is not used
+    axis = np.arange(200.).reshape((50, 4)).mean(-1)
+    np.testing.assert_allclose(problem['axis'], np.delete(axis, 2))
+    assert_true(len(problem['data']) == 49)
+    
+def test_too_few_bins():
+    m = get_model(shape = (1,))
+    m.axes_manager.set_not_slicing_indexes((0,))
+    # 4 bins for 4 free parameters
+    assert_true(m._fit_signal_binned(50, fitter = 'leastsq') == 0)
+    
+def test_same_result_as_full_resolution():
+    m = get_model(shape = (1,))
+    m.fit(fitter = 'leastsq')
+    reference = get_parameter_values(m)
+    m = get_model(shape = (1,))
+    fit_signal_binned = m._fit_signal_binned
+    coarse_nfev = []
+    def recording_fit_signal_binned(factor, **kwargs):
+        coarse_nfev.append(fit_signal_binned(factor, **kwargs))
+        return coarse_nfev[-1]
+    m._fit_signal_binned = recording_fit_signal_binned
+    m.fit(fitter = 'leastsq', signal_binning = 4)
+    np.testing.assert_allclose(get_parameter_values(m), reference, 
+                               rtol = 1e-5)
+    assert_true(len(coarse_nfev) == 1 and coarse_nfev[0] > 0)
+    # The function evaluations of both fits are added
+    assert_true(m._nfev > coarse_nfev[0])
+    assert_true(m._signal_binning is None)
+    
+def test_multifit():
+    m = get_model()
+    m.multifit(fitter = 'leastsq', signal_binning = 4)
+    reference = get_model()
+    reference.multifit(fitter = 'leastsq')
+    for name in ('A', 'sigma', 'centre'):
+        np.testing.assert_allclose(
+            getattr(m[0], name).map['values'],
+            getattr(reference[0], name).map['values'], rtol = 1e-4)
+    assert_true(m.fit_info['success'].all())
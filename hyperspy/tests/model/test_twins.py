@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+# Copyright 2007-2012 The Hyperspy developers
+#
+# This file is part of  Hyperspy.
+#
+#  Hyperspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+#  Hyperspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with  Hyperspy.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+from nose.tools import assert_true
+
+from hyperspy.components import Gaussian
+from hyperspy.tests.model.synthetic import get_model, central_jacobian
+
+def get_twinned_model():
+    m = get_model()
+    g2 = Gaussian(A = 100., sigma = 5., centre = 150.)
+    g3 = Gaussian(A = 50., sigma = 5., centre = 30.)
+    m.extend((g2, g3))
+    # A chain of identity twins and a twin with a twin function
+    g3.sigma.twin = g2.sigma
+    g2.sigma.twin = m[0].sigma
+    g3.A.twin = g2.A
+    g3.A.twin_function = lambda x: 0.5 * x
+    return m, g2, g3
+
+def test_twin_graph():
+    m, g2, g3 = get_twinned_model()
+    graph = m._get_twin_graph()
+    order = graph['order']
+    assert_true(order.index(g2.sigma) < order.index(g3.sigma))
+    assert_true(g3.sigma in graph['rooted'])
+    assert_true(g3.sigma._twin_root is m[0].sigma)
+    assert_true(g3.A in graph['functions'])
+    dependents = graph['dependents']
+    assert_true(set(dependents[m[0].sigma]) == set([g2.sigma, g3.sigma]))
+    assert_true(dependents[g2.A] == [g3.A])
+    
+def test_twin_values():
+    m, g2, g3 = get_twinned_model()
+    m[0].sigma.value = 7.
+    g2.A.value = 80.
+    assert_true(g3.sigma.value == 7.)
+    assert_true(g3.A.value == 40.)
+    values = m._get_store_values()
+    assert_true(values[g3.sigma._store_offset] == 7.)
+    assert_true(values[g3.A._store_offset] == 40.)
+    # The graph is rebuilt when a twin changes
+    g3.sigma.twin = None
+    g3.sigma.value = 3.
+    assert_true(g3.sigma not in m._get_twin_graph()['rooted'])
+    assert_true(m._get_store_values()[g3.sigma._store_offset] == 3.)
+    
+def test_twin_jacobian():
+    m, g2, g3 = get_twinned_model()
+    # The gradients of the twins are added without the derivative of the
+    # twin function, therefore it is only exact for identity functions
+    g3.A.twin_function = lambda x: x
+    m._set_p0()
+    p0 = np.array(m.p0, dtype = 'float')
+    y = m.spectrum()
+    # The free parameters exclude the twinned ones
+    assert_true(len(p0) == 4 + 2 + 1)
+    assert_true(g3.free_parameters == set([g3.centre]))
+    np.testing.assert_allclose(m._jacobian(p0, y), central_jacobian(m, p0),
+                               rtol = 1e-4, atol = 1e-6)
+    # Untwinning frees the parameter again
+    g3.sigma.twin = None
+    assert_true(g3.sigma in g3.free_parameters)
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+# Copyright 2007-2012 The Hyperspy developers
+#
+# This file is part of  Hyperspy.
+#
+#  Hyperspy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+#  Hyperspy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with  Hyperspy.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+from nose.tools import assert_true
+
+from hyperspy.tests.model.synthetic import get_model
+
+def fit(linear_parameters = None, grad = False):
+    m = get_model(shape = (1,))
+    m.fit(fitter = 'leastsq', grad = grad, 
+          linear_parameters = linear_parameters)
+    return m
+    
+def check_variable_projection(grad):
+    m = fit(grad = grad)
+    m_vp = fit('auto', grad = grad)
+    for component, component_vp in zip(m, m_vp):
+        for parameter, parameter_vp in zip(component.parameters, 
+                                           component_vp.parameters):
+            np.testing.assert_allclose(parameter_vp.value, parameter.value, 
+                                       rtol = 1e-5)
+            assert_true(parameter_vp.free)
+    # The std of the linear parameters is computed in the same way
+    for parameter, parameter_vp in ((m[0].A, m_vp[0].A), 
+                                    (m[1].offset, m_vp[1].offset)):
+        np.testing.assert_allclose(parameter_vp.std, parameter.std, 
+                                   rtol = 1e-3)
+    
+def test_variable_projection_equals_full_fit():
+    for grad in (False, True):
+        yield check_variable_projection, grad
+        
+def test_linear_parameters_auto():
+    m = get_model(shape = (1,))
+    parameters = m._get_linear_parameters()
+    assert_true(m[0].A in parameters)
+    assert_true(m[1].offset in parameters)
+    assert_true(m[0].sigma not in parameters)